@@ -0,0 +1,167 @@
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import io
+import queue
+import struct
+import threading
+import zlib
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Fixed part of a gzip member header: magic, method, flags, mtime,
+# extra flags, OS and the length of the extra field
+GZIP_HEADER = struct.Struct('<2sBBIBBH')
+BGZF_SUBFIELD = struct.Struct('<2sHH')
+FEXTRA = 4
+
+def _bgzf_block_size(header, extra):
+    # Total block size from the BC subfield, None if this is not a BGZF block
+    magic, method, flags, _, _, _, _ = GZIP_HEADER.unpack(header)
+
+    if magic != GZIP_MAGIC or method != 8 or not flags & FEXTRA:
+        return None
+
+    pos = 0
+
+    while pos + 4 <= len(extra):
+        tag, size = struct.unpack_from('<2sH', extra, pos)
+
+        if tag == b'BC' and size == 2:
+            return struct.unpack_from('<H', extra, pos + 4)[0] + 1
+
+        pos += 4 + size
+
+    return None
+
+def is_bgzf(path):
+    with open(path, 'rb') as f:
+        header = f.read(GZIP_HEADER.size)
+
+        if len(header) < GZIP_HEADER.size:
+            return False
+
+        return _bgzf_block_size(header, f.read(GZIP_HEADER.unpack(header)[-1])) is not None
+
+def _inflate(payload, crc, isize):
+    data = zlib.decompress(payload, -zlib.MAX_WBITS)
+
+    if len(data) != isize or zlib.crc32(data) != crc:
+        raise OSError('Corrupted BGZF block')
+
+    return data
+
+class BgzfReader(io.RawIOBase):
+    """
+    Decompresses BGZF blocks in worker threads.
+
+    A reader thread splits the file into blocks and queues one decompression
+    job per block, in file order; at most queue_size blocks are in flight.
+    """
+
+    def __init__(self, path, threads=2, queue_size=None):
+        self._file = open(path, 'rb')
+        self._executor = ThreadPoolExecutor(max_workers=max(threads, 1))
+        self._jobs = queue.Queue(maxsize=queue_size or max(threads, 1) * 4)
+        self._stop = threading.Event()
+        self._view = memoryview(b'')
+        self._reader = threading.Thread(target=self._read_blocks, daemon=True)
+        self._reader.start()
+
+    def _put(self, item):
+        # Returns whether the item was queued before the reader was stopped
+        while not self._stop.is_set():
+            try:
+                self._jobs.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def _read_blocks(self):
+        try:
+            while not self._stop.is_set():
+                header = self._file.read(GZIP_HEADER.size)
+
+                if not header:
+                    break
+                elif len(header) < GZIP_HEADER.size:
+                    raise OSError('Truncated BGZF block')
+
+                extra = self._file.read(GZIP_HEADER.unpack(header)[-1])
+                block_size = _bgzf_block_size(header, extra)
+
+                if block_size is None:
+                    raise OSError('Not a BGZF block')
+
+                body = self._file.read(block_size - len(header) - len(extra))
+
+                if len(body) != block_size - len(header) - len(extra):
+                    raise OSError('Truncated BGZF block')
+
+                crc, isize = struct.unpack_from('<II', body, len(body) - 8)
+                job = self._executor.submit(_inflate, body[:-8], crc, isize)
+
+                if not self._put(job):
+                    job.cancel()
+        except Exception as e:
+            self._put(e)
+
+        self._put(None)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._view:
+            job = self._jobs.get()
+
+            if job is None:
+                self._jobs.put(None)
+                return 0
+            elif isinstance(job, Exception):
+                raise job
+
+            self._view = memoryview(job.result())
+
+        size = min(len(buffer), len(self._view))
+        buffer[:size] = self._view[:size]
+        self._view = self._view[size:]
+
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self._reader.join()
+
+            # Blocks nobody will read, shutdown(cancel_futures=True) needs Python 3.9
+            while True:
+                try:
+                    job = self._jobs.get_nowait()
+                except queue.Empty:
+                    break
+
+                if job is not None and not isinstance(job, Exception):
+                    job.cancel()
+
+            self._executor.shutdown(wait=True)
+            self._file.close()
+
+        super().close()
+
+def open_text(path, threads=1):
+    """
+    Open a plain, gzip or BGZF compressed text file for reading.
+
+    BGZF files are decompressed by the given number of threads.
+    """
+    with open(path, 'rb') as f:
+        is_gzip = f.read(2) == GZIP_MAGIC
+
+    if not is_gzip:
+        return open(path, 'r')
+    elif is_bgzf(path):
+        return io.TextIOWrapper(io.BufferedReader(BgzfReader(path, threads), buffer_size=1 << 20))
+    else:
+        return gzip.open(path, 'rt')
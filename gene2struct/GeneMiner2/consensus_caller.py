@@ -0,0 +1,154 @@
+import re
+
+import numpy as np
+
+# Columns of the count matrices
+BASE_COLUMNS = 'ACGT'
+GAP_COLUMN = 4
+
+BASE_CODES = np.full(256, -1, dtype=np.int8)
+BASE_CODES[list(b'ACGT')] = np.arange(4)
+BASE_CODES[list(b'acgt')] = np.arange(4)
+
+# IUPAC code of every set of bases, indexed by a mask with A = 1, C = 2, G = 4 and T = 8,
+# the pairs match D_BASE_DICT of the assembler
+IUPAC_CODES = np.frombuffer(b'-ACMGRSVTWYHKDBN', dtype=np.uint8)
+BASE_MASKS = np.array([1, 2, 4, 8, 0], dtype=np.int64)
+
+CIGAR_OP = re.compile(r'(\d+)([MIDNSHP=X])')
+
+# Records that do not count, unmapped, secondary and failing quality checks
+SKIP_FLAGS = 0x4 | 0x100 | 0x200
+
+def _expand(starts, lengths):
+    # starts[i], starts[i] + 1, ..., starts[i] + lengths[i] - 1 for every i
+    ends = np.cumsum(lengths)
+
+    if not len(ends):
+        return np.zeros(0, dtype=np.int64)
+
+    return np.repeat(starts - ends + lengths, lengths) + np.arange(ends[-1])
+
+class Pileup:
+    """
+    Counts of A, C, G, T and deletions at every position of a set of contigs,
+    from the SAM records of the reads aligned to them.
+
+    The contigs are laid end to end, counts has one row per position of
+    all of them and offsets tells where each contig starts. Inserted and
+    clipped read bases are left out, as are letters other than ACGT.
+    """
+    __slots__ = ('names', 'seqs', 'offsets', 'counts')
+
+    def __init__(self, names, seqs, offsets, counts):
+        self.names = names
+        self.seqs = seqs
+        self.offsets = offsets
+        self.counts = counts
+
+    @classmethod
+    def from_records(cls, contigs, records):
+        """
+        Count the bases of SAM records, without header lines, aligned to
+        contigs, given as (title, sequence) pairs. Records are matched to the
+        contigs by the first word of their title.
+        """
+        names = [title for title, _ in contigs]
+        seqs = [seq for _, seq in contigs]
+        offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+        np.cumsum([len(seq) for seq in seqs], out=offsets[1:])
+        contig_idx = {title.split(maxsplit=1)[0] if title.strip() else title: i for i, title in enumerate(names)}
+
+        # Aligned blocks as (position, read base index, length, end of contig) and deletions as (position, length)
+        match_pos, match_read, match_len, match_end = [], [], [], []
+        del_pos, del_len = [], []
+        read_seqs = []
+        read_cnt = 0
+
+        for line in records:
+            fields = line.split('\t', 10)
+
+            if len(fields) < 10 or int(fields[1]) & SKIP_FLAGS or fields[5] == '*' or fields[9] == '*':
+                continue
+
+            idx = contig_idx.get(fields[2])
+
+            if idx is None:
+                continue
+
+            ref_pos = offsets[idx] + int(fields[3]) - 1
+            ref_end = offsets[idx + 1]
+            read_pos = read_cnt
+
+            for size, op in CIGAR_OP.findall(fields[5]):
+                size = int(size)
+
+                if op in 'M=X':
+                    match_pos.append(ref_pos)
+                    match_read.append(read_pos)
+                    match_len.append(size)
+                    match_end.append(ref_end)
+                    ref_pos += size
+                    read_pos += size
+                elif op == 'D':
+                    del_pos.append(ref_pos)
+                    del_len.append(size)
+                    ref_pos += size
+                elif op == 'N':
+                    ref_pos += size
+                elif op in 'IS':
+                    read_pos += size
+
+            read_seqs.append(fields[9])
+            read_cnt += len(fields[9])
+
+        read_codes = BASE_CODES[np.frombuffer(''.join(read_seqs).encode('ascii', 'replace'), dtype=np.uint8)]
+        match_len = np.array(match_len, dtype=np.int64)
+        ref_idx = _expand(np.array(match_pos, dtype=np.int64), match_len)
+        read_idx = _expand(np.array(match_read, dtype=np.int64), match_len)
+
+        # Blocks running past the end of their contig or of their read are cut there
+        keep = (ref_idx < np.repeat(np.array(match_end, dtype=np.int64), match_len)) & (ref_idx >= 0) & (read_idx < read_cnt)
+        ref_idx, read_idx = ref_idx[keep], read_idx[keep]
+        codes = read_codes[read_idx].astype(np.int64)
+        is_base = codes >= 0
+
+        gap_idx = _expand(np.array(del_pos, dtype=np.int64), np.array(del_len, dtype=np.int64))
+        gap_idx = gap_idx[(gap_idx >= 0) & (gap_idx < offsets[-1])]
+
+        cells = np.concatenate((ref_idx[is_base] * 5 + codes[is_base], gap_idx * 5 + GAP_COLUMN))
+        counts = np.bincount(cells, minlength=offsets[-1] * 5).reshape(-1, 5)
+
+        return cls(names, seqs, offsets, counts)
+
+    def consensus(self, threshold):
+        """
+        Consensus of each contig as (title, sequence) pairs.
+
+        At every covered position, the most frequent columns are taken until
+        they cover threshold of the depth, with any column tied with the last
+        one. These bases are written as their IUPAC code, a position where
+        only the deletion column is taken is left out. Uncovered positions
+        keep the base of the contig.
+        """
+        counts = self.counts
+        depth = counts.sum(axis=1)
+
+        # Number of top columns reaching the threshold, then the count they go down to
+        top = -np.sort(-counts, axis=1)
+        taken = (np.cumsum(top, axis=1) < threshold * depth[:, None] - 1e-9).sum(axis=1)
+        cutoff = top[np.arange(len(top)), np.minimum(taken, 4)]
+        is_taken = (counts >= cutoff[:, None]) & (counts > 0)
+
+        masks = is_taken @ BASE_MASKS
+        contig_bases = np.frombuffer(''.join(self.seqs).upper().encode('ascii', 'replace'), dtype=np.uint8)
+        bases = np.where(depth > 0, IUPAC_CODES[masks], contig_bases)
+        keep = (depth == 0) | (masks > 0)
+
+        result = []
+
+        for i, title in enumerate(self.names):
+            start, end = self.offsets[i], self.offsets[i + 1]
+            result.append((title, bases[start:end][keep[start:end]].tobytes().decode()))
+
+        return result
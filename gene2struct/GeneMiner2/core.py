@@ -41,6 +41,8 @@ def run(argv=None):
     parser.add_argument('--max-size', default=6, help='Maximum file size during re-filtering', metavar='INT', type=int)
     parser.add_argument('--min-ka', default=21, help='Minimum auto-estimated assembly k-mer size', metavar='INT', type=int)
     parser.add_argument('--max-ka', default=51, help='Maximum auto-estimated assembly k-mer size', metavar='INT', type=int)
+    parser.add_argument('--max-memory', default=0, help='Memory budget for running tasks in GB (default = 90%% of total memory)', metavar='FLOAT', type=float)
+    parser.add_argument('--ka-step', default=0, help='Retry failed genes with the auto-estimated k-mer size lowered by this step, down to --min-ka (default = 0, off)', metavar='INT', type=int)
     parser.add_argument('--msa-program', choices=('clustalo', 'mafft', 'muscle'), default='mafft', help='Program for multiple sequence alignment', type=str)
     parser.add_argument('--no-alignment', action='store_true', default=True, help='Do not perform multiple sequence alignment')
     parser.add_argument('--no-trimal', action='store_true', default=False, help='Do not run trimAl on alignments')
@@ -0,0 +1,131 @@
+import numpy as np
+
+# Bases are coded as A=0, C=1, G=2, T/U=3, like FWD_TRANS in the filter
+# Any other character is dropped from the sequence before k-mers are taken
+DROPPED = 255
+
+BASE_CODES = np.full(256, DROPPED, dtype=np.uint8)
+
+for bases, code in (('Aa', 0), ('Cc', 1), ('Gg', 2), ('TtUu', 3)):
+    BASE_CODES[list(map(ord, bases))] = code
+
+# Multipliers of the splitmix64 finalizer, used to fold k-mers longer than 32 bases
+MIX_MULT_1 = np.uint64(0xBF58476D1CE4E5B9)
+MIX_MULT_2 = np.uint64(0x94D049BB133111EB)
+
+def pack_sequences(seqs):
+    """
+    Concatenate sequences into one array of 2-bit base codes.
+
+    Returns (codes, offsets), read i occupies codes[offsets[i]:offsets[i + 1]].
+    """
+    seqs = list(seqs)
+    raw = np.frombuffer(''.join(seqs).encode('ascii', 'replace'), dtype=np.uint8)
+    codes = BASE_CODES[raw]
+    kept = codes != DROPPED
+
+    raw_offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs)), out=raw_offsets[1:])
+
+    kept_offsets = np.zeros(len(raw) + 1, dtype=np.int64)
+    np.cumsum(kept, out=kept_offsets[1:])
+
+    return codes[kept], kept_offsets[raw_offsets]
+
+def kmer_counts(offsets, kmer_size):
+    """
+    Number of k-mers in each packed sequence.
+    """
+    return np.maximum(np.diff(offsets) - kmer_size + 1, 0)
+
+def kmer_read_ids(offsets, kmer_size):
+    """
+    Index of the sequence each k-mer belongs to.
+    """
+    counts = kmer_counts(offsets, kmer_size)
+    return np.repeat(np.arange(len(counts)), counts)
+
+def _kmer_starts(offsets, kmer_size):
+    counts = kmer_counts(offsets, kmer_size)
+    first = np.repeat(offsets[:-1] - np.cumsum(counts) + counts, counts)
+    return first + np.arange(len(first))
+
+def _window_values(codes, width):
+    # Value of codes[i:i + width] packed 2 bits per base, first base highest,
+    # for every i; built by doubling, so it takes O(log(width)) passes
+    values = None
+    filled = 0
+    span_values = codes.astype(np.uint64)
+    span = 1
+
+    while span <= width:
+        if width & span:
+            if values is None:
+                values = span_values
+            else:
+                size = len(span_values) - filled
+                values = (values[:size] << np.uint64(span << 1)) | span_values[filled:]
+
+            filled += span
+
+        if span << 1 <= width:
+            span_values = (span_values[:len(span_values) - span] << np.uint64(span << 1)) | span_values[span:]
+
+        span <<= 1
+
+    return values
+
+def _mix(keys):
+    # Bijective, every input bit affects every output bit
+    keys = (keys ^ (keys >> np.uint64(30))) * MIX_MULT_1
+    keys = (keys ^ (keys >> np.uint64(27))) * MIX_MULT_2
+    return keys ^ (keys >> np.uint64(31))
+
+def window_keys(codes, kmer_size):
+    """
+    Keys of the k-mers starting at every position of a code array.
+
+    K-mers of up to 32 bases are stored exactly, longer ones are split into
+    32-base words and folded into a 64-bit key.
+    """
+    if len(codes) < kmer_size:
+        return np.zeros(0, dtype=np.uint64)
+
+    if kmer_size <= 32:
+        return _window_values(codes, kmer_size)
+
+    size = len(codes) - kmer_size + 1
+    head = kmer_size - ((kmer_size - 1) >> 5 << 5)
+    keys = _window_values(codes, head)[:size]
+    word_values = _window_values(codes, 32)
+
+    for start in range(head, kmer_size, 32):
+        keys = _mix(keys) ^ word_values[start:start + size]
+
+    return keys
+
+def forward_kmers(codes, offsets, kmer_size):
+    """
+    Keys of all k-mers, grouped by sequence and ordered by position.
+
+    For k <= 32 the key is the 2-bit packed k-mer itself.
+    """
+    return window_keys(codes, kmer_size)[_kmer_starts(offsets, kmer_size)]
+
+def reverse_kmers(codes, offsets, kmer_size):
+    """
+    Keys of the reverse complements of the k-mers from forward_kmers.
+    """
+    rc_keys = window_keys(3 - codes[::-1], kmer_size)[::-1]
+    return rc_keys[_kmer_starts(offsets, kmer_size)]
+
+def contains(ref_kmers, kmers):
+    """
+    Membership of each k-mer in a sorted array of reference k-mers.
+    """
+    if not len(ref_kmers):
+        return np.zeros(len(kmers), dtype=bool)
+
+    # Probing the sorted array leaves it untouched, np.isin would sort a copy of it
+    idx = np.searchsorted(ref_kmers, kmers)
+    return ref_kmers[np.minimum(idx, len(ref_kmers) - 1)] == kmers
@@ -0,0 +1,528 @@
+from collections import OrderedDict
+import hashlib
+import os
+
+import numpy as np
+
+import gene2struct.Geneminer2.kmer_codec as kmer_codec
+
+CODE_BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+UNKNOWN_POSITION = 1023
+
+# Bump REFERENCE_CACHE_VERSION whenever ReferenceKmers or the k-mer keys change
+REFERENCE_CACHE_VERSION = 2
+REFERENCE_ARRAYS = ('keys', 'positions', 'is_reverse', 'depths')
+
+def _strand_windows(offsets, kmer_size, skip):
+    # Window starts in the two-strand code array of the sequences, in the order
+    # the assembler visits them: per sequence the forward strand, then the reverse
+    # strand, each from its rightmost window, leaving out the leftmost `skip` ones
+    # Returns (start, sequence index, rank from the right end of the strand)
+    seq_cnt = len(offsets) - 1
+    win_cnt = np.maximum(np.diff(offsets) - kmer_size + 1, 0)
+    sizes   = np.repeat(np.maximum(win_cnt - skip, 0), 2)
+
+    base = np.empty(seq_cnt << 1, dtype=np.int64)
+    base[0::2] = offsets[:-1] + win_cnt - 1
+    base[1::2] = 2 * offsets[-1] - offsets[:-1] - kmer_size
+
+    first = np.cumsum(sizes) - sizes
+    rank  = np.arange(sizes.sum()) - np.repeat(first, sizes)
+
+    return np.repeat(base, sizes) - rank, np.repeat(np.arange(seq_cnt).repeat(2), sizes), rank
+
+def _two_strands(seqs):
+    # The sequences followed by the reverse complement of all of them
+    # The array is its own reverse complement, so the reverse complement
+    # of the window at s starts at len(both) - s - kmer_size
+    codes, offsets = kmer_codec.pack_sequences(seqs)
+    return codes, offsets, np.concatenate((codes, 3 - codes[::-1]))
+
+class ReferenceKmers:
+    """
+    K-mers of the reference sequences of one gene on both strands, sorted by key.
+
+    Each k-mer keeps the relative position (per mille, counted from the right
+    end of its strand) and strand of its first occurrence, and the number of
+    occurrences.
+    """
+    __slots__ = ('kmer_size', 'keys', 'positions', 'is_reverse', 'depths')
+
+    def __init__(self, kmer_size, keys, positions, is_reverse, depths):
+        self.kmer_size = kmer_size
+        self.keys = keys
+        self.positions = positions
+        self.is_reverse = is_reverse
+        self.depths = depths
+
+    @classmethod
+    def from_sequences(cls, ref_seqs, kmer_size):
+        codes, offsets, both = _two_strands(ref_seqs)
+        starts, seq_ids, rank = _strand_windows(offsets, kmer_size, 0)
+
+        if not len(starts):
+            return cls(kmer_size, np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.uint16),
+                       np.zeros(0, dtype=bool), np.zeros(0, dtype=np.uint32))
+
+        win_cnt = np.diff(offsets) - kmer_size + 1
+        keys = kmer_codec.window_keys(both, kmer_size)[starts]
+        positions = ((rank + 1) / win_cnt[seq_ids] * 1000).astype(np.uint16)
+
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        heads = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+        first = order[heads]
+
+        return cls(kmer_size, keys[heads], positions[first], starts[first] >= len(codes),
+                   np.diff(np.append(heads, len(keys))).astype(np.uint32))
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in REFERENCE_ARRAYS)
+
+    def save(self, path):
+        """
+        Write each array to '<path>.<name>.npy' atomically, readers never see a partial file.
+        """
+        for name in REFERENCE_ARRAYS:
+            array_path = f'{path}.{name}.npy'
+            tmp_path = f'{array_path}.{os.getpid()}.tmp'
+
+            try:
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, getattr(self, name))
+
+                os.replace(tmp_path, array_path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+
+    @classmethod
+    def load(cls, path, kmer_size):
+        """
+        Map the arrays written by save read-only, so that every process loading
+        them shares one copy in the page cache. None if any is missing or unreadable.
+        """
+        try:
+            arrays = [np.load(f'{path}.{name}.npy', mmap_mode='r') for name in REFERENCE_ARRAYS]
+        except (OSError, ValueError):
+            return None
+
+        if any(array.ndim != 1 or len(array) != len(arrays[0]) for array in arrays):
+            return None
+
+        return cls(kmer_size, *arrays)
+
+class ReferenceKmerCache:
+    """
+    ReferenceKmers by reference file content and k-mer size.
+
+    The most recently used tables are kept in memory, and with a cache_dir
+    every table is also stored there, so that the assembler runs of all
+    samples share one build per gene and k-mer size. Tables on disk are
+    memory-mapped, parallel workers share them whatever k-mer size they
+    pick.
+    """
+    __slots__ = ('cache_dir', 'max_entries', 'entries', 'digests')
+
+    def __init__(self, cache_dir=None, max_entries=64):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.digests = {}
+
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def digest(self, file_path):
+        """
+        Content hash of a reference file, remembered by path, size and mtime.
+        """
+        stat = os.stat(file_path)
+        stamp = (os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+
+        if stamp not in self.digests:
+            digest = hashlib.blake2b(f'{REFERENCE_CACHE_VERSION}:'.encode(), digest_size=16)
+
+            with open(file_path, 'rb') as f:
+                while chunk := f.read(1 << 20):
+                    digest.update(chunk)
+
+            self.digests[stamp] = digest.hexdigest()
+
+        return self.digests[stamp]
+
+    def get(self, file_path, kmer_size, build):
+        """
+        The table of file_path for kmer_size, calls build(file_path, kmer_size)
+        only if it is neither in memory nor on disk.
+        """
+        key = (self.digest(file_path), kmer_size)
+
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        path = os.path.join(self.cache_dir, f'{key[0]}_k{kmer_size}') if self.cache_dir else None
+        ref_kmers = ReferenceKmers.load(path, kmer_size) if path else None
+
+        if ref_kmers is None:
+            ref_kmers = build(file_path, kmer_size)
+
+            if path:
+                ref_kmers.save(path)
+                ref_kmers = ReferenceKmers.load(path, kmer_size) or ref_kmers
+
+        self.entries[key] = ref_kmers
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+        return ref_kmers
+
+def _merge_tables(tables):
+    # Merge per-block node tables, which must be given in read order
+    # Counts are added up, everything else is kept from the first occurrence
+    merged = {name: np.concatenate([table[name] for table in tables]) for name in tables[0]}
+    order = np.argsort(merged['keys'], kind='stable')
+    keys = merged['keys'][order]
+    heads = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+
+    for name, values in merged.items():
+        if name == 'counts':
+            merged[name] = np.add.reduceat(values[order], heads) if len(heads) else values
+        else:
+            merged[name] = values[order[heads]]
+
+    return merged
+
+class KmerGraph:
+    """
+    Weighted de Bruijn graph over the read k-mers of one gene, both strands,
+    stored as parallel arrays indexed by node and sorted by k-mer key.
+
+    counts: number of reads containing the k-mer
+    positions: relative position in the reference, UNKNOWN_POSITION if absent
+    is_reverse: k-mer only found on the reverse strand of the reference, or absent
+    depths: number of occurrences in the reference
+    ranks: order of first occurrence in the reads
+    successors: node of each possible next base A, C, G, T, or -1
+    reverse_nodes: node of the reverse complement, or -1
+
+    K-mers longer than 32 bases are compared by 64-bit hash, see kmer_codec.
+    """
+    __slots__ = ('kmer_size', 'codes', 'keys', 'counts', 'positions', 'is_reverse', 'depths',
+                 'ranks', 'origins', 'successors', 'reverse_nodes')
+
+    def __init__(self, kmer_size, codes, keys, counts, positions, is_reverse, depths,
+                 ranks, origins, successors, reverse_nodes):
+        self.kmer_size = kmer_size
+        self.codes = codes
+        self.keys = keys
+        self.counts = counts
+        self.positions = positions
+        self.is_reverse = is_reverse
+        self.depths = depths
+        self.ranks = ranks
+        self.origins = origins
+        self.successors = successors
+        self.reverse_nodes = reverse_nodes
+
+    @classmethod
+    def from_reads(cls, codes, offsets, ref_kmers, block_size=8192):
+        """
+        Build the graph from reads packed by kmer_codec and the reference k-mers.
+
+        Like the dictionary it replaces, the leftmost k-mer of each strand
+        of a read is left out and a k-mer is counted once per read. The
+        graph keeps a reference to codes to decode node sequences.
+        """
+        kmer_size = ref_kmers.kmer_size
+        rank_base = 0
+        table     = None
+
+        for first_read in range(0, len(offsets) - 1, block_size):
+            block_offsets = offsets[first_read:first_read + block_size + 1]
+            code_base = block_offsets[0]
+            block_codes = codes[code_base:block_offsets[-1]]
+            block_offsets = block_offsets - code_base
+            both = np.concatenate((block_codes, 3 - block_codes[::-1]))
+            starts, read_ids, _ = _strand_windows(block_offsets, kmer_size, 1)
+
+            if len(starts):
+                kmer_keys  = kmer_codec.window_keys(both, kmer_size)
+                infix_keys = kmer_codec.window_keys(both, kmer_size - 1)
+                keys = kmer_keys[starts]
+
+                # Windows are in read order, so reads of equal keys stay sorted
+                order = np.argsort(keys, kind='stable')
+                keys = keys[order]
+                read_ids = read_ids[order]
+                key_head = np.concatenate(([True], keys[1:] != keys[:-1]))
+                read_head = key_head.copy()
+                read_head[1:] |= read_ids[1:] != read_ids[:-1]
+                heads = np.flatnonzero(key_head)
+                first = order[heads]
+                node_starts = starts[first]
+                is_forward = node_starts < len(block_codes)
+
+                block_table = {
+                    'keys': keys[heads],
+                    'counts': np.add.reduceat(read_head.astype(np.uint32), heads),
+                    'ranks': rank_base + first,
+                    'origins': code_base + np.where(is_forward, node_starts, len(both) - node_starts - kmer_size),
+                    'is_forward': is_forward,
+                    'prefix_keys': infix_keys[node_starts],
+                    'suffix_keys': infix_keys[node_starts + 1],
+                    'reverse_keys': kmer_keys[len(both) - node_starts - kmer_size],
+                    'last_bases': both[node_starts + kmer_size - 1]
+                }
+
+                table = _merge_tables([table, block_table] if table else [block_table])
+
+            rank_base += len(starts)
+
+        if table is None:
+            empty = np.zeros(0, dtype=np.int64)
+            return cls(kmer_size, codes, empty.astype(np.uint64), empty.astype(np.uint32), empty.astype(np.uint16),
+                       empty.astype(bool), empty.astype(np.uint32), empty, empty,
+                       np.zeros((0, 4), dtype=np.int32), empty.astype(np.int32))
+
+        keys = table['keys']
+        node_cnt = len(keys)
+
+        # Reference information, absent k-mers are marked as reverse
+        ref_idx = np.minimum(np.searchsorted(ref_kmers.keys, keys), max(len(ref_kmers) - 1, 0))
+        in_ref = ref_kmers.keys[ref_idx] == keys if len(ref_kmers) else np.zeros(node_cnt, dtype=bool)
+        ref_pos = ref_kmers.positions[ref_idx] if len(ref_kmers) else np.zeros(node_cnt, dtype=np.uint16)
+        ref_rev = ref_kmers.is_reverse[ref_idx] if len(ref_kmers) else np.zeros(node_cnt, dtype=bool)
+
+        positions  = np.where(in_ref, np.where(ref_rev, 1000 - ref_pos, ref_pos), UNKNOWN_POSITION).astype(np.uint16)
+        is_reverse = np.where(in_ref, ref_rev, True)
+        depths     = np.where(in_ref, ref_kmers.depths[ref_idx] if len(ref_kmers) else 0, 0).astype(np.uint32)
+
+        # Node j follows node i if the first k - 1 bases of j are the last k - 1 bases of i
+        prefix_order = np.argsort(table['prefix_keys'], kind='stable')
+        prefix_keys  = table['prefix_keys'][prefix_order]
+        lo = np.searchsorted(prefix_keys, table['suffix_keys'], 'left')
+        succ_cnt = np.searchsorted(prefix_keys, table['suffix_keys'], 'right') - lo
+        src = np.repeat(np.arange(node_cnt), succ_cnt)
+        dst = prefix_order[np.repeat(lo - np.cumsum(succ_cnt) + succ_cnt, succ_cnt) + np.arange(succ_cnt.sum())]
+
+        successors = np.full((node_cnt, 4), -1, dtype=np.int32)
+        successors[src, table['last_bases'][dst]] = dst
+
+        graph = cls(kmer_size, codes, keys, table['counts'], positions, is_reverse, depths,
+                    table['ranks'], np.where(table['is_forward'], table['origins'], ~table['origins']),
+                    successors, None)
+        graph.reverse_nodes = graph.find(table['reverse_keys']).astype(np.int32)
+
+        return graph
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def nbytes(self):
+        """
+        Size of the node arrays, the read codes are shared and not counted.
+        """
+        return sum(getattr(self, name).nbytes for name in self.__slots__[2:])
+
+    def select(self, mask):
+        """
+        Subgraph of the nodes where mask is true.
+        """
+        new_index = (np.cumsum(mask) - 1).astype(np.int32)
+
+        def remap(nodes):
+            is_kept = nodes >= 0
+            is_kept[is_kept] = mask[nodes[is_kept]]
+            return np.where(is_kept, new_index[nodes], -1).astype(np.int32)
+
+        return KmerGraph(self.kmer_size, self.codes, self.keys[mask], self.counts[mask], self.positions[mask],
+                         self.is_reverse[mask], self.depths[mask], self.ranks[mask], self.origins[mask],
+                         remap(self.successors[mask]), remap(self.reverse_nodes[mask]))
+
+    def find(self, keys):
+        """
+        Nodes of the given k-mer keys, -1 if absent.
+        """
+        idx = np.minimum(np.searchsorted(self.keys, keys), max(len(self.keys) - 1, 0))
+
+        if not len(self.keys):
+            return np.full(len(keys), -1, dtype=np.int64)
+
+        return np.where(self.keys[idx] == keys, idx, -1)
+
+    def node_codes(self, node):
+        origin = self.origins.item(node)
+
+        if origin >= 0:
+            return self.codes[origin:origin + self.kmer_size]
+
+        return 3 - self.codes[~origin:~origin + self.kmer_size][::-1]
+
+    def node_sequence(self, node):
+        return CODE_BASES[self.node_codes(node)].tobytes().decode()
+
+    def successors_of(self, codes):
+        """
+        Nodes following an arbitrary k-mer, given by its base codes, for bases A, C, G, T.
+        """
+        candidates = np.tile(np.append(codes[1:], 0).astype(np.uint8), 4)
+        candidates[self.kmer_size - 1::self.kmer_size] = np.arange(4)
+        offsets = np.arange(5, dtype=np.int64) * self.kmer_size
+
+        return self.find(kmer_codec.forward_kmers(candidates, offsets, self.kmer_size))
+
+    def last_bases(self):
+        """
+        Last base code of every node.
+        """
+        is_forward = self.origins >= 0
+        bases = self.codes[np.where(is_forward, self.origins + self.kmer_size - 1, ~self.origins)]
+        return np.where(is_forward, bases, 3 - bases).astype(np.uint8)
+
+def _chain_ranks(prev):
+    # Head of the chain of every node and its distance from the head, following
+    # prev links by pointer jumping; nodes on cycles never reach a head
+    jump = np.where(prev >= 0, prev, np.arange(len(prev)))
+    ranks = (prev >= 0).astype(np.int64)
+
+    for _ in range(len(prev).bit_length() + 1):
+        next_jump = jump[jump]
+
+        if np.array_equal(next_jump, jump):
+            break
+
+        ranks += ranks[jump]
+        jump = next_jump
+
+    return jump, ranks
+
+class Unitigs:
+    """
+    Maximal non-branching paths of a KmerGraph.
+
+    A link a -> b lies inside a unitig if b is the only successor of a and
+    a the only predecessor of b, so a path entering a unitig at its head
+    has to follow it to the end. Cycles of such links are cut at their
+    smallest node.
+
+    nodes: graph nodes ordered by unitig and position in it
+    bases: last base of each of these nodes
+    starts: index of the first node of each unitig in nodes, then len(nodes)
+    units: unitig of every graph node
+    index: position of every graph node in nodes
+    """
+    __slots__ = ('nodes', 'bases', 'starts', 'units', 'index')
+
+    def __init__(self, nodes, bases, starts, units, index):
+        self.nodes = nodes
+        self.bases = bases
+        self.starts = starts
+        self.units = units
+        self.index = index
+
+    @classmethod
+    def from_graph(cls, graph):
+        node_cnt = len(graph)
+        successors = graph.successors
+        out_cnt = (successors >= 0).sum(axis=1)
+        in_cnt = np.bincount(successors[successors >= 0], minlength=node_cnt)
+
+        src = np.flatnonzero(out_cnt == 1)
+        dst = successors[src].max(axis=1).astype(np.int64)
+        is_inner = (in_cnt[dst] == 1) & (dst != src)
+
+        prev = np.full(node_cnt, -1, dtype=np.int64)
+        prev[dst[is_inner]] = src[is_inner]
+        heads, ranks = _chain_ranks(prev)
+
+        # Only nodes on cycles are left without a head
+        on_cycle = prev[heads] >= 0
+
+        if on_cycle.any():
+            for node in np.flatnonzero(on_cycle).tolist():
+                if not on_cycle[node]:
+                    continue
+
+                cycle = [node]
+
+                while prev.item(cycle[-1]) != node:
+                    cycle.append(prev.item(cycle[-1]))
+
+                on_cycle[cycle] = False
+                prev[min(cycle)] = -1
+
+            heads, ranks = _chain_ranks(prev)
+
+        order = np.lexsort((ranks, heads))
+        sorted_heads = heads[order]
+        is_start = np.concatenate(([True], sorted_heads[1:] != sorted_heads[:-1]))[:node_cnt]
+
+        units = np.empty(node_cnt, dtype=np.int64)
+        units[order] = np.cumsum(is_start) - 1
+        index = np.empty(node_cnt, dtype=np.int64)
+        index[order] = np.arange(node_cnt)
+
+        return cls(order, graph.last_bases()[order], np.append(np.flatnonzero(is_start), node_cnt), units, index)
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+class SeedIndex:
+    """
+    Seed nodes of a KmerGraph in assembly order, with the seeds already
+    covered by a contig marked in a bitmap.
+
+    A seed is used up once the seed or its reverse complement is part of
+    a contig, the reverse complement of each node is looked up in the
+    graph instead of being recomputed for every seed.
+    """
+    __slots__ = ('seeds', 'is_seed', 'is_used', 'reverse_nodes', 'cursor', 'remaining')
+
+    def __init__(self, graph, seeds):
+        self.seeds = seeds
+        self.is_seed = np.zeros(len(graph), dtype=bool)
+        self.is_seed[seeds] = True
+        self.is_used = np.zeros(len(graph), dtype=bool)
+        self.reverse_nodes = graph.reverse_nodes
+        self.cursor = 0
+        self.remaining = len(seeds)
+
+    def __len__(self):
+        return self.remaining
+
+    def first(self):
+        """
+        The first seed not used up yet.
+        """
+        while self.is_used.item(self.seeds.item(self.cursor)):
+            self.cursor += 1
+
+        return self.seeds.item(self.cursor)
+
+    def consume(self, nodes):
+        """
+        Mark the seeds covered by a contig made of the given nodes.
+
+        Returns the number of seeds among the nodes.
+        """
+        nodes = np.fromiter(nodes, dtype=np.int64, count=len(nodes))
+        reverse_nodes = self.reverse_nodes[nodes]
+        reverse_nodes = reverse_nodes[reverse_nodes >= 0]
+
+        seed_nodes = nodes[self.is_seed[nodes]]
+        used = np.concatenate((seed_nodes, reverse_nodes[self.is_seed[reverse_nodes]]))
+        used = np.unique(used[~self.is_used[used]])
+
+        self.is_used[used] = True
+        self.remaining -= len(used)
+
+        return len(seed_nodes)
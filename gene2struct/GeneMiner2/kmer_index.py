@@ -0,0 +1,198 @@
+import hashlib
+import json
+import os
+import struct
+
+import numpy as np
+
+import gene2struct.Geneminer2.kmer_codec as kmer_codec
+
+# On-disk layout: magic, format version and header length, a JSON header
+# then the k-mer, gene and flag arrays, each aligned to ARRAY_ALIGNMENT
+# Bump INDEX_VERSION whenever the layout or the k-mer keys change
+INDEX_MAGIC = b'GMKIDX\0\0'
+INDEX_VERSION = 1
+ARRAY_ALIGNMENT = 64
+PREFIX_FORMAT = '<8sII'
+
+def reference_digest(names, ref_sets, kmer_size):
+    """
+    Content hash of a reference panel, independent of file names and
+    sequence order within a gene.
+    """
+    digest = hashlib.blake2b(f'{INDEX_VERSION}:{kmer_size}'.encode(), digest_size=16)
+
+    for name, ref_set in zip(names, ref_sets):
+        digest.update(b'>' + name.encode())
+
+        for seq in sorted(ref_set):
+            digest.update(b'\n' + seq.encode())
+
+    return digest.hexdigest()
+
+def _align(offset):
+    return -(-offset // ARRAY_ALIGNMENT) * ARRAY_ALIGNMENT
+
+class KmerIndex:
+    """
+    Reference k-mers of one or several genes, stored as parallel arrays
+    sorted by k-mer and gene.
+
+    Flags: 1=forward; 2=reverse; 3=both
+    """
+    __slots__ = ('kmer_size', 'kmers', 'genes', 'flags', 'names', 'digest')
+
+    def __init__(self, kmer_size, kmers, genes, flags, names=None, digest=None):
+        self.kmer_size = kmer_size
+        self.kmers = kmers
+        self.genes = genes
+        self.flags = flags
+        self.names = names
+        self.digest = digest
+
+    @classmethod
+    def from_references(cls, ref_sets, kmer_size):
+        """
+        Build an index over a list of reference sequence sets, one per gene.
+        """
+        gene_dtype = np.uint16 if len(ref_sets) <= 1 << 16 else np.uint32
+        kmer_list, gene_list, flag_list = [], [], []
+
+        for gene_idx, ref_set in enumerate(ref_sets):
+            codes, offsets = kmer_codec.pack_sequences(ref_set)
+            fwd_kmers = kmer_codec.forward_kmers(codes, offsets, kmer_size)
+            rev_kmers = kmer_codec.reverse_kmers(codes, offsets, kmer_size)
+
+            kmer_list.extend((fwd_kmers, rev_kmers))
+            gene_list.append(np.full(len(fwd_kmers) << 1, gene_idx, dtype=gene_dtype))
+            flag_list.append(np.repeat(np.array([1, 2], dtype=np.uint8), len(fwd_kmers)))
+
+        if not kmer_list or not sum(map(len, kmer_list)):
+            return cls(kmer_size, np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=gene_dtype), np.zeros(0, dtype=np.uint8))
+
+        kmers = np.concatenate(kmer_list)
+        genes = np.concatenate(gene_list)
+        flags = np.concatenate(flag_list)
+
+        order = np.lexsort((genes, kmers))
+        kmers = kmers[order]
+        genes = genes[order]
+        first = np.flatnonzero(np.concatenate(([True], (kmers[1:] != kmers[:-1]) | (genes[1:] != genes[:-1]))))
+
+        return cls(kmer_size, kmers[first], genes[first], np.bitwise_or.reduceat(flags[order], first))
+
+    def __len__(self):
+        return len(self.kmers)
+
+    @property
+    def nbytes(self):
+        return self.kmers.nbytes + self.genes.nbytes + self.flags.nbytes
+
+    def contains(self, kmers):
+        """
+        Whether each k-mer occurs in any gene.
+        """
+        return kmer_codec.contains(self.kmers, kmers)
+
+    def lookup(self, kmers):
+        """
+        All (k-mer, gene) entries matching the queried k-mers.
+
+        Returns (query index, gene, flags), ordered by query index.
+        """
+        lo = np.searchsorted(self.kmers, kmers, 'left')
+        cnt = np.searchsorted(self.kmers, kmers, 'right') - lo
+        query_idx = np.flatnonzero(cnt)
+        lo, cnt = lo[query_idx], cnt[query_idx]
+
+        entry = np.repeat(lo - np.cumsum(cnt) + cnt, cnt) + np.arange(cnt.sum())
+
+        return np.repeat(query_idx, cnt), self.genes[entry], self.flags[entry]
+
+    def save(self, path):
+        """
+        Write the index to path atomically, readers never see a partial file.
+        """
+        arrays = (self.kmers, self.genes, self.flags)
+        header = {
+            'kmer_size': self.kmer_size,
+            'names': self.names,
+            'digest': self.digest,
+            'arrays': []
+        }
+
+        offset = 0
+
+        # Offsets are relative to the first aligned position after the header
+        for arr in arrays:
+            header['arrays'].append((arr.dtype.str, len(arr), offset))
+            offset = _align(offset + arr.nbytes)
+
+        header_bytes = json.dumps(header).encode()
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(struct.pack(PREFIX_FORMAT, INDEX_MAGIC, INDEX_VERSION, len(header_bytes)))
+                f.write(header_bytes)
+                data_start = _align(f.tell())
+
+                for arr, (_, _, arr_offset) in zip(arrays, header['arrays']):
+                    f.write(bytes(data_start + arr_offset - f.tell()))
+                    f.write(np.ascontiguousarray(arr).tobytes())
+
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """
+        Open an index written by save, with the arrays memory-mapped read-only.
+
+        Returns None if the file is missing or was written by another version.
+        """
+        try:
+            with open(path, 'rb') as f:
+                prefix = f.read(struct.calcsize(PREFIX_FORMAT))
+                magic, version, header_len = struct.unpack(PREFIX_FORMAT, prefix)
+
+                if magic != INDEX_MAGIC or version != INDEX_VERSION:
+                    return None
+
+                header = json.loads(f.read(header_len))
+                data_start = _align(f.tell())
+        except (OSError, struct.error, ValueError):
+            return None
+
+        arrays = [np.memmap(path, dtype=np.dtype(dtype), mode='r', offset=data_start + offset, shape=(length, ))
+                  if length else np.zeros(0, dtype=np.dtype(dtype))
+                  for dtype, length, offset in header['arrays']]
+
+        return cls(header['kmer_size'], *arrays, header['names'], header['digest'])
+
+    @classmethod
+    def cached(cls, path, names, ref_sets, kmer_size):
+        """
+        Load the index at path if it was built from the same references and
+        k-mer size, otherwise build it and store it at path.
+
+        Without a path the index is only built in memory.
+        """
+        digest = reference_digest(names, ref_sets, kmer_size)
+
+        if path:
+            index = cls.load(path)
+
+            if index is not None and index.digest == digest and index.kmer_size == kmer_size:
+                return index
+
+        index = cls.from_references(ref_sets, kmer_size)
+        index.names = list(names)
+        index.digest = digest
+
+        if path:
+            index.save(path)
+
+        return index
@@ -9,16 +9,18 @@ import os
 import sys
 import time
 
+import numpy as np
+
+import gene2struct.Geneminer2.kmer_codec as kmer_codec
+from gene2struct.Geneminer2.kmer_graph import KmerGraph, ReferenceKmerCache, ReferenceKmers, SeedIndex, Unitigs
+from gene2struct.Geneminer2.read_store import ReadStore
+
 D_BASE_DICT = {'AG':'R','CT':'Y', 'GT':'K', 'GC':'S','AC':'M', 'AT':'W','GA':'R','TC':'Y','TG':'K', 'CG':'S','CA':'M', 'TA':'W',}
 ACGT_DICT = {0: 'A', 1: 'C', 2: 'G', 3: 'T'}
 ACGT_REV   = str.maketrans('ACGT', 'TGCA')
-FWD_TRANS  = str.maketrans("ACGTU", "01233", "RYMKSWHBVDN\n\r")
-REV_TRANS  = str.maketrans("ACGTU", "32100", "RYMKSWHBVDN\n\r")
-BIN_DICT   = {'00': 'A', '01': 'C', '10': 'G', '11': 'T'}
 
-ref_path_dict = {}  # 序列路径字典
-ref_count_dict = {} # 参考序列条数字典
 kmer_dict = {}  # kmer字典
+ref_kmer_cache = None  # 参考序列kmer表的缓存，每个进程一个
 ref_reads_count_dict = {}  # reads计数的字典
 
 def Write_Print(log_path, *log_str, sep = " "):
@@ -30,39 +32,6 @@ def Write_Print(log_path, *log_str, sep = " "):
         out.write(line + '\n')
     print(line)
 
-def Seq_To_Int(dna_str, trans=FWD_TRANS, rtrans=REV_TRANS):
-    """
-    将基因转换为整数
-    """
-    dna_fw_str = dna_str.translate(trans)
-    dna_rc_str = dna_str.translate(rtrans)[::-1]
-
-    if not dna_fw_str:
-        return (), 0
-
-    return (int(dna_fw_str, 4), int(dna_rc_str, 4)), len(dna_fw_str)
-
-def Int_To_Seq(seq_bin, seq_length, seq_dict=BIN_DICT):
-    """
-    将整数转换为基因
-    :param seq_bin: 序列的整数形式
-    :param seq_length: 序列的长度，用来补0
-    :return: 返回整数序列的基因形式
-    """
-    seq_bin_str = bin(seq_bin)[2:].rjust(seq_length << 1, '0')
-    return ''.join(seq_dict[seq_bin_str[j << 1:(j << 1) + 2]] for j in range(seq_length))
-
-def Reverse_Int(dna_int, dna_length):
-    """
-    将基因的整数型转换为反向互补的基因的整数型
-    :param dna_int: 序列的整数形式
-    :param dna_length: 序列的长度，用来补0
-    :return: 返回整数序列的基因形式
-    """
-    bin_str = bin(dna_int ^ ((1 << (dna_length << 1)) - 1))[2:].rjust(dna_length << 1, '0')
-    new_list = [bin_str[i:i + 2] for i in range(0, dna_length << 1, 2)]
-    return int(''.join(reversed(new_list)), 2)
-
 def Reverse_Complement_ACGT(seq, table=ACGT_REV):
     """
     简化版反向互补
@@ -79,41 +48,28 @@ def Judge_Type(path):
                    'fa': 2, '.fas': 2, '.fasta': 2}
     return suffix_dict.get(os.path.splitext(path)[-1].lower(), 3)
 
-def Make_Kmer_Dict(_kmer_dict, file_path, kmer_size):
+def Make_Kmer_Dict(file_path, kmer_size):
     """
-    制作整数型Kmer字典
-    :param _kmer_dict: 用来保存kmer的字典变量
+    制作参考序列的kmer表
     :param file_path: 参考序列的文件名
     :param kmer_size: kmer的长度
+    :return: 按kmer排序的ReferenceKmers，保存首次出现的位置千分比、方向和深度
     """
-    MASK_BIN = (1 << (kmer_size << 1)) - 1  # kmer的掩码
-    DEPTH_BIN = 1 << 10  # kmer深度的递增
-
     with open(file_path, 'r') as f:
-        # 1-10位为位置千分比，11-30为深度，31-35为预留符号位，36及以后为文件
-        file_id = 1 << 35  # 设置当前文件的符号位
-
-        for _, seq in SimpleFastaParser(f):
-            # 序列转整数，获取长度
-            intseqs, ref_len = Seq_To_Int(''.join(filter(str.isalpha, seq)).upper())
-            ref_kmer_count = ref_len - kmer_size + 1
-
-            for x, y in enumerate(intseqs):
-                # 初始化符号位和文件位，反向互补序列的31位符号位为1
-                SIGN_BIN = (1 << 30) + (1 << 10) + file_id if x else (1 << 10) + file_id
-
-                for j in range(0, ref_kmer_count):
-                    temp_int = SIGN_BIN  # 初始化文件位和深度
-                    kmer_int = y >> (j << 1) & MASK_BIN  # 获取kmer的整数形式
-
-                    if kmer_int in _kmer_dict:
-                        temp_int = _kmer_dict[kmer_int]
-                        temp_int += DEPTH_BIN  # 深度加1，深度大于2**20会溢出,不太可能这么深的kmer
-                        temp_int |= file_id  # 赋值文件位
-                    else:
-                        temp_int += int((j + 1) / ref_kmer_count * 1000)
+        return ReferenceKmers.from_sequences((''.join(filter(str.isalpha, seq)).upper() for _, seq in SimpleFastaParser(f)), kmer_size)
 
-                    _kmer_dict[kmer_int] = temp_int
+def Get_Kmer_Dict(file_path, kmer_size, cache_dir = None):
+    """
+    从缓存获取参考序列的kmer表，按文件内容和kmer长度索引，没有时再制作
+    :param file_path: 参考序列的文件名
+    :param kmer_size: kmer的长度
+    :param cache_dir: 保存kmer表的文件夹，同一次运行的所有拼接进程共用，None时只缓存在内存中
+    :return: ReferenceKmers
+    """
+    global ref_kmer_cache
+    if ref_kmer_cache is None or ref_kmer_cache.cache_dir != cache_dir:
+        ref_kmer_cache = ReferenceKmerCache(cache_dir)
+    return ref_kmer_cache.get(file_path, kmer_size, Make_Kmer_Dict)
 
 def Get_Ref_Info(ref_path, _ref_path_dict, _ref_count_dict):
     """
@@ -142,19 +98,14 @@ def Get_Ref_Info(ref_path, _ref_path_dict, _ref_count_dict):
         _ref_count_dict[file_name] = ref_seq_count
         _ref_path_dict[file_name] = file
 
-def Make_Assemble_Dict(file_list, kmer_size, _kmer_dict, _ref_dict, Filted_File_Ext = '.fq'):
+def Read_Seqs(file, Filted_File_Ext = '.fq'):
     """
-    构建拼接用的字典
-    :param file_list: 文件列表
-    :param kmer_size: kmer的长度
-    :param _kmer_dict: 待生成的字典value的格式为[深度，位置（1000以内的整数）]
-    :param _ref_dict: 参考序列的字典
-    :return: 返回kmer的总数量
+    逐条读取过滤后的reads序列
+    :param file: 文件名
+    :param Filted_File_Ext: 文件的扩展名
     """
-    MASK_BIN = (1 << (kmer_size << 1)) - 1 # kmer的掩码
     fasta_file = Filted_File_Ext == '.fasta'
-    for file in file_list:
-        infile = open(file, 'r', encoding='utf-8', errors='ignore')
+    with open(file, 'r', encoding='utf-8', errors='ignore') as infile:
         infile.readline()
         for line in infile:
             if fasta_file:
@@ -162,29 +113,29 @@ def Make_Assemble_Dict(file_list, kmer_size, _kmer_dict, _ref_dict, Filted_File_
                 while line and line[0] != '>':
                     temp_str.append(line)
                     line = infile.readline()
-                read_seq = ''.join(filter(str.isalpha, ''.join(temp_str).upper()))
+                yield ''.join(filter(str.isalpha, ''.join(temp_str).upper()))
             else:
-                read_seq = ''.join(filter(str.isalpha, line)).upper()
+                yield ''.join(filter(str.isalpha, line)).upper()
                 infile.readline()
                 infile.readline()
                 infile.readline()
-            intseqs, read_len = Seq_To_Int(read_seq) # 序列转整数，获取长度
-            kmer_set = {x >> (j << 1) & MASK_BIN for x in intseqs for j in range(0, read_len - kmer_size)}
-            for kmer in kmer_set:
-                if kmer in _kmer_dict:
-                    _kmer_dict[kmer][0] += 1
-                elif kmer in _ref_dict: # kmer的位置
-                    temp_int = int(_ref_dict[kmer])
-                    temp_depth = (temp_int >> 10) & ((1<<20) -1) #在参考序列中的深度
-                    temp_pos = temp_int & 1023
-                    is_reverse = bool(temp_int & 1073741824) # 判断是否为反向互补的序列
-                    if is_reverse:
-                        # 标记为反向的的kmer
-                        temp_pos = 1000 - temp_pos
-                    _kmer_dict[kmer] = [1, temp_pos, is_reverse, temp_depth]
-                else:
-                    _kmer_dict[kmer] = [1, 1023, 1, 0]
-        infile.close()
+
+def Make_Read_Store(file_list, Filted_File_Ext = '.fq'):
+    """
+    读取过滤后的reads，转换为2-bit编码的reads库，只解析一次
+    :param file_list: 文件列表
+    :return: ReadStore
+    """
+    return ReadStore.from_seqs(chain.from_iterable(Read_Seqs(file, Filted_File_Ext) for file in file_list))
+
+def Make_Assemble_Dict(read_store, ref_kmers):
+    """
+    构建拼接用的kmer图
+    :param read_store: reads库
+    :param ref_kmers: 参考序列的kmer表
+    :return: KmerGraph，每个节点保存reads计数、位置（1000以内的整数）、方向和参考序列深度
+    """
+    return KmerGraph.from_reads(read_store.codes, read_store.offsets, ref_kmers)
 
 def Get_Middle_Fragment(text, slice_len):
     """
@@ -194,43 +145,31 @@ def Get_Middle_Fragment(text, slice_len):
     end = start + slice_len
     return text[start:end]
 
-def Make_Reads_Dict(file_list, _reads_dict, Filted_File_Ext = '.fq'):
+def Make_Reads_Dict(read_store, with_codes = True):
     """
-    截取reads中间的片段，构建高质量的reads字典
-    :param file_list: 文件列表
-    :param _reads_dict: 待生成的字典value的格式为seq
-    :return: 返回切片的长度
+    截取reads中间的片段，构建高质量的reads切片索引，切片以2-bit编码的整数（超过32个碱基时为64位哈希）保存
+    :param read_store: reads库
+    :param with_codes: 是否返回所有不同切片的编码，估算kmer大小时需要
+    :return: 切片的长度，按哈希排序的切片数组，对应的切片数，所有不同切片的编码和偏移
     """
-    read_len = 0
-    slice_len = 0
-    for file in file_list:
-        infile = open(file, 'r', encoding='utf-8', errors='ignore')
-        infile.readline()
-        paried_count = True
-        for line in infile:
-            temp_str = []
-            if Filted_File_Ext == '.fasta':
-                while line and line[0] != '>':
-                    temp_str.append(line)
-                    line = infile.readline()
-            else:
-                temp_str.append(line.strip())
-                infile.readline()
-                infile.readline()
-                infile.readline()
-            read_seq = ''.join(filter(str.isalpha, ''.join(temp_str))).upper()
-            if not read_len:
-                read_len = len(read_seq)
-                slice_len = int(read_len * 0.9)
-            intseqs = [read_seq, Reverse_Complement_ACGT(read_seq)] # 加入反向互补序列
-            for x in intseqs:
-                slice_reads = Get_Middle_Fragment(x, slice_len)
-                if slice_reads in _reads_dict:
-                    _reads_dict[slice_reads] += 1
-                else:
-                    _reads_dict[slice_reads] = 1
-        infile.close()
-    return slice_len
+    slice_len = int(read_store.first_length() * 0.9)
+    return (slice_len, *read_store.middle_slices(slice_len, with_codes))
+
+def Slice_Hits(seqs, slice_index, slice_len):
+    """
+    用滚动哈希计算序列中每个切片在reads中出现的次数
+    :param seqs: 只含ACGT的序列列表
+    :param slice_index: Make_Reads_Dict生成的切片哈希数组和切片数
+    :param slice_len: 切片的长度
+    :return: 每个切片的次数（按序列和位置排列），每条序列在其中的起点
+    """
+    slice_keys, slice_counts = slice_index
+    codes, offsets = kmer_codec.pack_sequences(seqs)
+    keys = kmer_codec.forward_kmers(codes, offsets, slice_len)
+    idx = np.minimum(np.searchsorted(slice_keys, keys), max(len(slice_keys) - 1, 0))
+    hits = np.where(slice_keys[idx] == keys, slice_counts[idx], 0) if len(slice_keys) else np.zeros(len(keys), dtype=np.int64)
+    window_cnt = kmer_codec.kmer_counts(offsets, slice_len)
+    return hits, np.append(0, np.cumsum(window_cnt))
 
 def Median(x):
     """
@@ -263,26 +202,31 @@ def Get_Weight(_pos, new_pos, weight = 4):
     """ 
     return int.bit_length((1024 - abs(_pos - new_pos)) >> 2) if (_pos and new_pos) else weight
 
-def Get_Forward_Contig_v6(_dict, seed, kmer_size, iteration = 1024):
+def Get_Forward_Contig_v6(graph, unitigs, weights, seed, iteration = 1024, seed_next = None):
     """
-    带权重的DBG贪婪拼接
-    :param _pos: 当前kmer在参考序列的位置
-    :param seed: 新的kmer位置
-    :param kmer_size: kmer的大小
+    带权重的DBG贪婪拼接，每次沿unitig延伸一整段无分支路径
+    :param graph: 用于拼接的kmer图
+    :param unitigs: kmer图的unitig
+    :param weights: 节点的拼接权重
+    :param seed: 种子节点，种子不在图中时为-1
     :param iteration: 最大循环数量
-    :param weight: 默认权重
-    :return: best_seq, kmer_set, best_kmc, best_pos, best_snp
+    :param seed_next: 种子不在图中时，其ACGT四个后继节点
+    :return: contigs, kmer_set, pos_list, best_kmc_sum
     """ 
-    temp_list, kmer_set, stack_list, pos_list = [seed], set([seed]), [], []
-    temp_dict = Counter(temp_list)
-    cur_kmc, cur_seq, contigs = deque(), deque(), []
-    _pos, node_distance, best_kmc_sum = 0, 0, 0
-    MASK = (1 << ((kmer_size << 1) - 2)) - 1
+    successors, positions = graph.successors, graph.positions
+    nodes, bases, starts, units, index = unitigs.nodes, unitigs.bases, unitigs.starts, unitigs.units, unitigs.index
+    # 路径上的片段(起始节点, 起点, 终点)，起点和终点为unitigs.nodes的下标
+    root = index.item(seed) if seed >= 0 else -1
+    temp_list, kmer_set, stack_list, pos_list = [(seed, root, root + 1)], set([seed]) if seed >= 0 else set(), [], []
+    temp_dict = Counter([seed])
+    cur_kmc, cur_seq, contigs = [], [], []
+    node_distance, best_kmc_sum = 0, 0
     while iteration:
-        next_kmer = (temp_list[-1] & MASK) << 2
-        node = [(i, _dict[i][1], _dict[i][0] + _dict[i][3])
-                for i in range(next_kmer, next_kmer + 4)
-                if i in _dict and not temp_dict[i]]
+        next_nodes = successors[nodes.item(temp_list[-1][2] - 1)].tolist() if seed_next is None else seed_next
+        seed_next = None
+        node = [(i, positions.item(i), weights.item(i))
+                for i in next_nodes
+                if i >= 0 and not temp_dict[i]]
         node.sort(key=itemgetter(2), reverse=True)
         if not node: 
             iteration -= 1
@@ -291,22 +235,31 @@ def Get_Forward_Contig_v6(_dict, seed, kmer_size, iteration = 1024):
             if cur_kmc_sum > best_kmc_sum:
                 best_kmc_sum = cur_kmc_sum
             for _ in range(node_distance):
-                temp_dict[temp_list.pop()] -= 1
-                cur_kmc.pop()
-                cur_seq.pop()
+                start_node, start, end = temp_list.pop()
+                temp_dict[start_node] -= 1
+                del cur_kmc[start - end:]
+                del cur_seq[start - end:]
             if not stack_list:
                 break
-            node, node_distance, _pos = stack_list.pop()
+            node, node_distance = stack_list.pop()
         if len(node) >= 2:
-            stack_list.append((node[1:], node_distance, _pos))
+            stack_list.append((node[1:], node_distance))
             node_distance = 0
-        if node[0][1] > 0: _pos = node[0][1]
-        temp_list.append(node[0][0])
-        temp_dict[node[0][0]] += 1
-        kmer_set.add(node[0][0])
-        pos_list.append(node[0][1])
-        cur_kmc.append(node[0][2])
-        cur_seq.append(node[0][0] & 3)
+        # 延伸到unitig末端，从头进入起点所在的unitig时在起点之前停止
+        start_node = node[0][0]
+        start = index.item(start_node)
+        end = starts.item(units.item(start_node) + 1)
+        if len(temp_list) > 1 or seed >= 0:
+            root = temp_list[0][1] if seed >= 0 else temp_list[1][1]
+            if start < root < end:
+                end = root
+        segment = nodes[start:end]
+        temp_list.append((start_node, start, end))
+        temp_dict[start_node] += 1
+        kmer_set.update(segment.tolist())
+        pos_list.extend(positions[segment].tolist())
+        cur_kmc.extend(weights[segment].tolist())
+        cur_seq.extend(bases[start:end].tolist())
         node_distance += 1
     return contigs, kmer_set, pos_list, int(best_kmc_sum)
 
@@ -316,13 +269,13 @@ def find_position(dq, n):
             return i
     return -1
 
-def Process_Contigs(contigs, max_weight, slice_len, reads_dict, soft_boundary = 0):
+def Process_Contigs(contigs, max_weight, slice_len, slice_index, soft_boundary = 0):
     """
     通过将contigs与reads进行map，来检测contig的可靠性
     :param contigs: 拼接过程获取的contigs
     :param max_weight: 最大的权重，只考虑大于最大权重一半的contigs
     :param slice_len: reads的高质量切片的长度
-    :param reads_dict: reads的高质量切片的词典
+    :param slice_index: reads的高质量切片的索引
     :return: 按照map上的reads的数量倒序排序过后的contigs
     """ 
     # 基于soft_boundary和四分位点切割序列两端
@@ -336,122 +289,129 @@ def Process_Contigs(contigs, max_weight, slice_len, reads_dict, soft_boundary =
                     contig[1].pop()
 
     processed_contigs = sorted([[''.join(ACGT_DICT[k] for k in x[1]), sum(x[0]), 0] for x in contigs if sum(x[0]) > max_weight >> 1], key=itemgetter(1), reverse=True)
-    for x in processed_contigs:
-        contig_len = len(x[0])
-        for j in range(contig_len - slice_len):
-            if contig_len - slice_len - j >= 0:
-                slice_str = x[0][contig_len - slice_len - j:contig_len - j]
-                if slice_str in reads_dict:
-                    x[2] += reads_dict[slice_str]
+    # 不计contig开头的切片
+    hits, starts = Slice_Hits([x[0] for x in processed_contigs], slice_index, slice_len)
+    hit_sums = np.append(0, np.cumsum(hits))
+    for x, start, end in zip(processed_contigs, starts[:-1].tolist(), starts[1:].tolist()):
+        x[2] = int(hit_sums[end] - hit_sums[min(start + 1, end)])
     processed_contigs.sort(key=itemgetter(2), reverse=True)
     return processed_contigs
 
 
-def Get_Contig_v6(_reads_dict, slice_len, _dict, seed, kmer_size, iteration = 1024, soft_boundary = 0):
+def Get_Contig_v6(_slice_index, slice_len, graph, unitigs, weights, seed, iteration = 1024, soft_boundary = 0):
     """
     获取最优的contig
-    :param _reads_dict: reads的高质量切片的词典
+    :param _slice_index: reads的高质量切片的索引
     :param slice_len: reads的高质量切片的长度
-    :param _dict: 用于拼接的kmer字典
-    :param seed: 拼接种子
-    :param kmer_size: kmer的长度
+    :param graph: 用于拼接的kmer图
+    :param unitigs: kmer图的unitig
+    :param weights: 节点的拼接权重
+    :param seed: 拼接种子节点
     :param iteration: 构建contig时允许的最大路径分支数
     :param weight: 没有ref时的默认权重
     :return: contigs的集合，用到所有的kmer的集合，contig的大概位置
     """ 
-    contigs_1, kmer_set_1, pos_list_1, weight_1 = Get_Forward_Contig_v6(_dict, seed, kmer_size, iteration)
-    contigs_2, kmer_set_2, pos_list_2, weight_2 = Get_Forward_Contig_v6(_dict, Reverse_Int(seed, kmer_size), kmer_size, iteration)
+    contigs_1, kmer_set_1, pos_list_1, weight_1 = Get_Forward_Contig_v6(graph, unitigs, weights, seed, iteration)
+    # 反向互补的种子可能不在图中，此时直接给出其后继节点
+    reverse_seed = graph.reverse_nodes.item(seed)
+    if reverse_seed >= 0:
+        contigs_2, kmer_set_2, pos_list_2, weight_2 = Get_Forward_Contig_v6(graph, unitigs, weights, reverse_seed, iteration)
+    else:
+        seed_next = graph.successors_of(3 - graph.node_codes(seed)[::-1]).tolist()
+        contigs_2, kmer_set_2, pos_list_2, weight_2 = Get_Forward_Contig_v6(graph, unitigs, weights, -1, iteration, seed_next)
     # 清理位置列表
     pos_list = [x for x in chain(pos_list_1, pos_list_2) if x > 0 and x < 1000]
     # 获取位置中位数
     contig_pos = int(Quartile(pos_list)[1] if len(pos_list)>1 else -1)
     # 获取最可能的两侧的contig
-    contigs_1_16 = Process_Contigs(contigs_1, weight_1, slice_len, _reads_dict, soft_boundary)
-    contigs_2_16 = Process_Contigs(contigs_2, weight_2, slice_len, _reads_dict, soft_boundary)
-    processed_contigs = []
+    contigs_1_16 = Process_Contigs(contigs_1, weight_1, slice_len, _slice_index, soft_boundary)
+    contigs_2_16 = Process_Contigs(contigs_2, weight_2, slice_len, _slice_index, soft_boundary)
     if not contigs_1_16: contigs_1_16.append(['',0,0])
     if not contigs_2_16: contigs_2_16.append(['',0,0])
     # 对最多前9种组合计算数量
-    for l in contigs_2_16[:3]:
-        for r in contigs_1_16[:3]:
-            c = Reverse_Complement_ACGT(l[0]) + Int_To_Seq(seed, kmer_size) + r[0]
-            c_weight = l[1] + r[1]
-            contig_len = len(c)
-            r_count = 0
-            for j in range(contig_len - slice_len):
-                if contig_len - slice_len - j >= 0:
-                    slice_str = c[contig_len - slice_len - j:contig_len - j]
-                    if slice_str in _reads_dict:
-                        r_count += _reads_dict[slice_str]
+    # 组合contig = 左半边 + 种子 + 右半边，切片按起点分为三部分：
+    # 落在左半边+种子内的，落在种子+右半边内的，以及跨过整个种子的
+    # 前两部分由每个半边的切片前缀和得到，只有跨过种子的切片需要按组合计算
+    seed_seq = graph.node_sequence(seed)
+    seed_len = len(seed_seq)
+    lefts, rights = contigs_2_16[:3], contigs_1_16[:3]
+    hits, starts = Slice_Hits([Reverse_Complement_ACGT(l[0]) + seed_seq for l in lefts] + [seed_seq + r[0] for r in rights], _slice_index, slice_len)
+    hit_sums = np.append(0, np.cumsum(hits)).tolist()
+    combos, junctions = [], []
+    for i, l in enumerate(lefts):
+        for j, r in enumerate(rights):
+            c = Reverse_Complement_ACGT(l[0]) + seed_seq + r[0]
+            left_len, right_len = len(l[0]), len(r[0])
+            # 切片起点的范围为1到len(c) - slice_len
+            left_end = left_len + seed_len - slice_len
+            left_start = starts[i]
+            r_count = hit_sums[left_start + left_end + 1] - hit_sums[left_start + 1] if left_end >= 1 else 0
+            right_start = starts[len(lefts) + j]
+            right_lo = max(0, seed_len - slice_len + 1, 1 - left_len)
+            right_hi = seed_len + right_len - slice_len
+            if right_hi >= right_lo:
+                r_count += hit_sums[right_start + right_hi + 1] - hit_sums[right_start + right_lo]
+            cross_lo = max(1, left_end + 1)
+            cross_hi = min(left_len - 1, len(c) - slice_len)
+            junctions.append(c[cross_lo:cross_hi + slice_len] if cross_hi >= cross_lo else '')
             # 序列，序列的拼接权重，切片数
-            processed_contigs.append([c, c_weight, r_count])
+            combos.append([c, l[1] + r[1], r_count])
+    hits, starts = Slice_Hits(junctions, _slice_index, slice_len)
+    hit_sums = np.append(0, np.cumsum(hits)).tolist()
+    processed_contigs = []
+    for combo, start, end in zip(combos, starts[:-1].tolist(), starts[1:].tolist()):
+        combo[2] = int(combo[2] + hit_sums[end] - hit_sums[start])
+        processed_contigs.append(combo)
     return processed_contigs, kmer_set_1 | kmer_set_2, contig_pos
 
-def Calculate_Kmer_Size(ref_path, reads, slice_len, k_min, k_max, error_limit):
-    mask_bin  = (1 << (k_min << 1)) - 1
-    kmer_dict = Counter()
-    trans = FWD_TRANS
-    rtrans = REV_TRANS
-
+def Calculate_Kmer_Size(ref_path, codes, offsets, slice_len, k_min, k_max, error_limit):
     if slice_len <= k_min:
         return k_min
 
     if k_min % 2 == 0:
         k_min += 1
 
-    for seq in reads:
-        seq_str   = seq.translate(trans)
-        seq_str_r = seq.translate(rtrans)[::-1]
-
-        if not seq_str:
-            continue
+    kmers, kmer_cnts = np.unique(np.concatenate((kmer_codec.forward_kmers(codes, offsets, k_min),
+                                                 kmer_codec.reverse_kmers(codes, offsets, k_min))),
+                                 return_counts=True)
+    solid_kmers = kmers[kmer_cnts > error_limit]
 
-        seq_int   = int(seq_str, 4)
-        seq_int_r = int(seq_str_r, 4)
-
-        for _ in range(0, len(seq_str) - k_min + 1):
-            kmer_dict[seq_int   & mask_bin] += 1
-            kmer_dict[seq_int_r & mask_bin] += 1
-            seq_int   >>= 2
-            seq_int_r >>= 2
-
-    kmer_dict = {k for k, v in kmer_dict.items() if v > error_limit}
     run_length_stats = [0] * (k_max - k_min + 1)
     run_maximum = k_max - k_min + 1
 
     with open(ref_path, 'r') as f:
-        for _, seq in SimpleFastaParser(f):
-            seq       = ''.join(filter(str.isalpha, seq)).upper()
-            seq_str   = seq.translate(trans)
+        codes, offsets = kmer_codec.pack_sequences(''.join(filter(str.isalpha, seq)).upper() for _, seq in SimpleFastaParser(f))
 
-            if not seq_str:
-                continue
+    # Runs of consecutive solid k-mers along each reference sequence
+    is_solid = kmer_codec.contains(solid_kmers, kmer_codec.forward_kmers(codes, offsets, k_min))
+    read_ids = kmer_codec.kmer_read_ids(offsets, k_min)
+    run_head = is_solid.copy()
+    run_head[1:] &= ~(is_solid[:-1] & (read_ids[1:] == read_ids[:-1]))
+    run_lengths = np.bincount(np.cumsum(run_head)[is_solid])[1:]
 
-            seq_int   = int(seq_str, 4)
+    # Runs reaching the maximum restart from half of it
+    run_length_list = []
 
-            run_length_list = [0]
-
-            for _ in range(0, len(seq_str) - k_min + 1):
-                if (seq_int & mask_bin) in kmer_dict:
-                    run_length_list[-1] += 1
-                    if run_length_list[-1] >= run_maximum:
-                        run_length_list.append(run_maximum // 2)
-                elif run_length_list[-1] != 0:
-                    run_length_list.append(0)
-                seq_int >>= 2
+    for run_len in run_lengths.tolist():
+        if run_len < run_maximum:
+            run_length_list.append(run_len)
+        else:
+            q, r = divmod(run_len - run_maximum, run_maximum - run_maximum // 2)
+            run_length_list.extend([run_maximum] * (q + 1))
+            run_length_list.append(run_maximum // 2 + r)
 
-            for k, v in Counter(run_length_list).items():
-                if k == 0:
-                    continue
+    for k, v in Counter(run_length_list).items():
+        if k == 0:
+            continue
 
-                kp = k - 1
-                odd = kp % 2
-                kp = kp - odd
+        kp = k - 1
+        odd = kp % 2
+        kp = kp - odd
 
-                run_length_stats[kp] += v
+        run_length_stats[kp] += v
 
-                for i in range(2, kp + 1, 2):
-                    run_length_stats[kp - i] += v
+        for i in range(2, kp + 1, 2):
+            run_length_stats[kp - i] += v
 
     for k, n in reversed(tuple(enumerate(run_length_stats, k_min))):
         if n > 0:
@@ -488,6 +448,28 @@ def Write_Dict(_dict, file_name):
                 f.writelines([str(key), ",", str(value), ",", '\n'])
 
 def process_key_value(args, key, ref_path, ref_count, iteration, soft_boundary, loop_count, total_count):
+    """
+    拼接一个基因，并记录用时和主要数据结构的内存
+    :return: 是否成功，基因名，结果字典（status, value, seconds, read_bytes, graph_bytes）
+    """
+    t0 = time.time()
+    stats = {"read_bytes": 0, "graph_bytes": 0}
+    success, key, result = Assemble_Gene(args, key, ref_path, ref_count, iteration, soft_boundary, loop_count, total_count, stats)
+    if result["status"] != "skipped":
+        result["seconds"] = round(time.time() - t0, 3)
+        result.update(stats)
+    return success, key, result
+
+# 拼接失败的状态和日志
+FAIL_LOGS = {"insufficient genomic kmers": 'Could not get enough reads from filter.',
+             "no seed": 'Could not get enough seeds.',
+             "no contigs": "Insufficient reads coverage, unable to build contigs."}
+
+def Assemble_Gene(args, key, ref_path, ref_count, iteration, soft_boundary, loop_count, total_count, stats):
+    """
+    拼接一个基因
+    :param stats: 用来记录reads库和kmer图占用内存的字典
+    """
     contig_best_path = os.path.join(args.o, "results", key + ".fasta")
     contig_all_path = os.path.join(args.o, "contigs_all", key + ".fasta")
     current_ka = args.ka
@@ -515,116 +497,143 @@ def process_key_value(args, key, ref_path, ref_count, iteration, soft_boundary,
         if os.path.isfile(contig_all_path): os.remove(contig_all_path)
         return False, key, {"status": "no filtered file", "value": 0}
 
-    # 获取种子列表
-    ref_dict, filtered_dict, reads_dict = {}, {}, {}
-
-    # 获取最大切片长度，建立reads切片字典
-    slice_len = Make_Reads_Dict([filtered_file_path], reads_dict)
+    # 读取reads，只解析一次
+    read_store = Make_Read_Store([filtered_file_path])
+    stats["read_bytes"] = read_store.nbytes
 
-    if not reads_dict:
+    if not len(read_store):
         if os.path.isfile(contig_best_path): os.remove(contig_best_path)
         if os.path.isfile(contig_all_path): os.remove(contig_all_path)
         Write_Print(os.path.join(args.o,  "log.txt"), "No reads were obtained for gene", key)
         return False, key, {"status": "no reads", "value": 0}
 
+    # 获取最大切片长度，建立切片索引，用滚动哈希统计contig上的reads切片
+    slice_len, slice_keys, slice_counts, slice_codes, slice_offsets = Make_Reads_Dict(read_store, not current_ka)
+    slice_index = (slice_keys, slice_counts)
+
     # 自动调整soft_boundary
     if soft_boundary == -1:
         soft_boundary = slice_len // 2
 
     # 如果不指定ka, 估算最大ka，执行动态高精度拼接
     if not current_ka:
-        current_ka = Calculate_Kmer_Size(ref_path, reads_dict.keys(), slice_len, args.k_min, args.k_max, limit)
-
-    Write_Print(os.path.join(args.o,  "log.txt"), "Use k=", current_ka, " for assembling gene ", key ,".", sep='')
-    Write_Print(os.path.join(args.o,  "log.txt"), 'Assembling', key, loop_count, '/', total_count)
+        current_ka = Calculate_Kmer_Size(ref_path, slice_codes, slice_offsets, slice_len, args.k_min, args.k_max, limit)
+    slice_codes, slice_offsets = None, None
+
+    # 拼接失败时，在更小的kmer上重试，复用已经解析的reads和切片索引
+    kmer_sizes = [current_ka]
+    if not args.ka and args.k_step > 0:
+        kmer_sizes.extend(range(current_ka - args.k_step, args.k_min - 1, -args.k_step))
+
+    status, contigs_all = None, []
+    for current_ka in kmer_sizes:
+        if status:
+            Write_Print(os.path.join(args.o,  "log.txt"), FAIL_LOGS[status])
+            Write_Print(os.path.join(args.o,  "log.txt"), "Retry k=", current_ka, " for assembling gene ", key ,".", sep='')
+        else:
+            Write_Print(os.path.join(args.o,  "log.txt"), "Use k=", current_ka, " for assembling gene ", key ,".", sep='')
+            Write_Print(os.path.join(args.o,  "log.txt"), 'Assembling', key, loop_count, '/', total_count)
 
-    # 制作参考序列的kmer字典
-    Make_Kmer_Dict(ref_dict, ref_path, current_ka)
-    # 制作用于拼接的kmer字典
-    Make_Assemble_Dict([filtered_file_path], current_ka, filtered_dict, ref_dict)
-    # 缩减filtered_dict，保留大于limit和有深度信息的
-    if limit > 0:
-        filtered_dict = {k: v for k, v in filtered_dict.items() if v[0] > limit or v[3] > 0}
+        status, contigs_all = Assemble_Kmer(read_store, ref_path, ref_count, current_ka, limit, slice_index, slice_len, iteration, soft_boundary, stats, args.kmer_cache)
+        if contigs_all:
+            break
 
-    if len(filtered_dict) < 3:
+    if not contigs_all:
         if os.path.isfile(contig_best_path): os.remove(contig_best_path)
         if os.path.isfile(contig_all_path): os.remove(contig_all_path)
-        Write_Print(os.path.join(args.o,  "log.txt"), 'Could not get enough reads from filter.')
-        return False, key, {"status": "insufficient genomic kmers", "value": 0}
+        Write_Print(os.path.join(args.o, "log.txt"), FAIL_LOGS[status])
+        return False, key, {"status": status, "value": 0}
+
+    # 排序第一位作为 best contig
+    contigs_best = contigs_all[:1]
+
+    with open(contig_best_path, 'w') as out:
+        for x in contigs_best:
+            out.write(f'>contig_{len(x[0])}_{x[1]}_{x[2]}_{x[3]}_{x[4]}\n')
+            out.write(x[0] + '\n')
+    with open(contig_all_path, 'w') as out:
+        for x in contigs_all:
+            out.write(f'>contig_{len(x[0])}_{x[1]}_{x[2]}_{x[3]}_{x[4]}\n')
+            out.write(x[0] + '\n')
+
+    read_store = None
+    gc.collect()
+    return True, key, {"status": status, "value": contigs_best[0][4]}
+
+def Assemble_Kmer(read_store, ref_path, ref_count, kmer_size, limit, slice_index, slice_len, iteration, soft_boundary, stats, cache_dir = None):
+    """
+    用一个kmer长度拼接一个基因
+    :param read_store: 解析好的reads
+    :param kmer_size: kmer的长度
+    :param stats: 用来记录kmer图占用内存的字典，保留最大值
+    :return: 状态，按切片数排序的contigs_all，失败时为空
+    """
+    # 获取参考序列的kmer表，同一基因和kmer长度只制作一次
+    ref_kmers = Get_Kmer_Dict(ref_path, kmer_size, cache_dir)
+    # 制作用于拼接的kmer图
+    graph = Make_Assemble_Dict(read_store, ref_kmers)
+    stats["graph_bytes"] = max(stats["graph_bytes"], graph.nbytes)
+    # 缩减graph，保留大于limit和有深度信息的
+    if limit > 0:
+        graph = graph.select((graph.counts > limit) | (graph.depths > 0))
+
+    if len(graph) < 3:
+        return "insufficient genomic kmers", []
 
     # 纠正深度上限, 获取参考序列的深度修正权重
-    # filtered_dict[0排除了上限的过滤深度，1位置，2方向，3修正参考序列深度]
-    read_quar = Quartile([v[0] for v in filtered_dict.values()])
+    # counts排除了上限的过滤深度，depths修正参考序列深度
+    counts = graph.counts.astype(np.int64)
+    depths = graph.depths.astype(np.int64)
+    read_quar = Quartile(np.sort(counts).tolist())
     depth_upper = int((read_quar[2] - read_quar[0]) * 1.5 + read_quar[2])
-    for k, v in filtered_dict.items():
-        if v[3] != 0:
-            v[3] = (v[0] > limit) * int(ref_count / (abs(v[3] - ref_count) + 1) * depth_upper) + 1
-        v[0] = min(v[0], depth_upper)
+    has_depth = depths != 0
+    depths[has_depth] = (counts[has_depth] > limit) * (ref_count / (np.abs(depths[has_depth] - ref_count) + 1) * depth_upper).astype(np.int64) + 1
+    np.minimum(counts, depth_upper, out=counts)
+    weights = counts + depths
+    # 合并无分支路径，拼接时整段延伸
+    unitigs = Unitigs.from_graph(graph)
 
     # 在每个参考序列中出现且只出现一次的kmer优先作为种子
-    # 长度位置在1~1000之间，与参考序列方向一致v[2] == 0
-    seed_list = [(k, v[0], v[1], v[3]) for k, v in filtered_dict.items() if v[1] > 1 and v[1] < 1000 and not v[2]]
-    seed_list.sort(key=lambda x: (x[3], x[1]), reverse=True)
+    # 长度位置在1~1000之间，与参考序列方向一致
+    # 深度和计数相同时按kmer在reads中首次出现的顺序
+    seed_rows = np.flatnonzero((graph.positions > 1) & (graph.positions < 1000) & ~graph.is_reverse)
+    seed_list = seed_rows[np.lexsort((graph.ranks[seed_rows], -counts[seed_rows], -depths[seed_rows]))]
 
     # 必须有seed_list, 否则意味着跟参考序列差别过大
-    if not seed_list:
-        if os.path.isfile(contig_best_path): os.remove(contig_best_path)
-        if os.path.isfile(contig_all_path): os.remove(contig_all_path)
-        Write_Print(os.path.join(args.o,  "log.txt"), 'Could not get enough seeds.')
-        return False, key, {"status": "no seed", "value": 0}
+    if not len(seed_list):
+        return "no seed", []
 
-    # 获取seed集合，用来加速集合操作
+    # 建立种子索引，用来标记已经用过的种子
     seed_list_len = len(seed_list)
-    seed_set = set(i[0] for i in seed_list)
+    seed_index = SeedIndex(graph, seed_list)
 
     # 获取contigs
     contigs_all = []
     contigs_all_low = []
-    contigs_best = []
 
-    while len(seed_list) > seed_list_len * 0.5: # 已经耗费了大于一半的seed就没必要再做了 
+    while len(seed_index) > seed_list_len * 0.5: # 已经耗费了大于一半的seed就没必要再做了 
         # org_contigs: 0序列 1序列的拼接权重 2切片数 3配对的切片数
-        org_contigs, kmer_set, contig_pos = Get_Contig_v6(reads_dict, slice_len, filtered_dict, seed_list[0][0], current_ka, iteration=iteration, soft_boundary=soft_boundary)
-        seed_list = [item for item in seed_list if (item[0] not in kmer_set) and (Reverse_Int(item[0], current_ka) not in kmer_set)]
+        org_contigs, kmer_set, contig_pos = Get_Contig_v6(slice_index, slice_len, graph, unitigs, weights, seed_index.first(), iteration=iteration, soft_boundary=soft_boundary)
+        seed_count = seed_index.consume(kmer_set)
         for contig in org_contigs:
             if contig[2] * slice_len > len(contig[0]): # 起码要有reads高质量切片能够覆盖contig，否则就是错误的拼接
                 # contigs_all: 0序列 1使用的种子数量 2序列位置 3序列的拼接权重 4切片数
-                contigs_all.append([contig[0], len(seed_set & kmer_set), contig_pos, contig[1], contig[2]])
+                contigs_all.append([contig[0], seed_count, contig_pos, contig[1], contig[2]])
             else:
-                contigs_all_low.append([contig[0], len(seed_set & kmer_set), contig_pos, contig[1], contig[2]])
+                contigs_all_low.append([contig[0], seed_count, contig_pos, contig[1], contig[2]])
 
     low_qual = not contigs_all
     if low_qual:
         contigs_all = contigs_all_low
 
     # 设计规则重新排序，此处使用切片数排序
-    # 排序第一位作为 best contig
-    if contigs_all:
-        contigs_all.sort(key=lambda x: (x[4], x[3]), reverse=True)
-        contigs_best.append(contigs_all[0])
-    else:
-        if os.path.isfile(contig_best_path): os.remove(contig_best_path)
-        if os.path.isfile(contig_all_path): os.remove(contig_all_path)
-        Write_Print(os.path.join(args.o, "log.txt"), "Insufficient reads coverage, unable to build contigs.")
-        return False, key, {"status": "no contigs", "value": 0}
-
-    with open(contig_best_path, 'w') as out:
-        for x in contigs_best:
-            out.write(f'>contig_{len(x[0])}_{x[1]}_{x[2]}_{x[3]}_{x[4]}\n')
-            out.write(x[0] + '\n')
-    with open(contig_all_path, 'w') as out:
-        for x in contigs_all:
-            out.write(f'>contig_{len(x[0])}_{x[1]}_{x[2]}_{x[3]}_{x[4]}\n')
-            out.write(x[0] + '\n')
-
-    ref_dict, filtered_dict = None, None
-    gc.collect()
-    return True, key, {"status": "low quality" if low_qual else "success", "value": contigs_best[0][4]}
-
-if __name__ == '__main__':
-    if sys.platform.startswith('win'):
-        multiprocessing.freeze_support()
+    contigs_all.sort(key=lambda x: (x[4], x[3]), reverse=True)
+    return ("no contigs" if not contigs_all else "low quality" if low_qual else "success"), contigs_all
 
+def Make_Parser():
+    """
+    拼接器的命令行参数
+    """
     pars = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description='''Assembler by YY 20230314''')
     pars.add_argument('-r', metavar='<str>', type=str, help='''input ref file or dir''')
     pars.add_argument('-o', metavar='<str>', type=str, help='''out dir''')
@@ -634,44 +643,120 @@ if __name__ == '__main__':
     pars.add_argument('-limit_count', metavar='<int>', type=int, help='''limit of kmer count''', required=False, default=2)
     pars.add_argument('-iteration', metavar='<int>', type=int, help='''iteration''', required=False, default=8192)
     pars.add_argument('-sb', '--soft_boundary', metavar='<int>', type=int, help='''soft boundary，default = [0], -1时为切片长度的一半''', required=False, default=0)
+    pars.add_argument('-k_step', metavar='<int>', type=int, help='''when ka is 0, retry failed genes with k reduced by this step down to k_min, 0 to disable''', required=False, default=0)
+    pars.add_argument('-kmer_cache', metavar='<str>', type=str, help='''dir to cache the kmers of references, shared by runs''', required=False, default=None)
     pars.add_argument('-p', '--processes', metavar='<int>', type=int, help='Number of processes for multiprocessing', default= 1)#max(multiprocessing.cpu_count()-1,2))
-    args = pars.parse_args()
+    return pars
 
-    try:
-        # 初始化文件夹
-        if not os.path.isdir(os.path.join(args.o, 'results')):
-            os.mkdir(os.path.join(args.o, 'results'))
-        if not os.path.isdir(os.path.join(args.o, 'contigs_all')):
-            os.mkdir(os.path.join(args.o, 'contigs_all'))
-        print("Do not close this window manually, please!")
-        # 载入参考序列信息
-        Get_Ref_Info(args.r, ref_path_dict, ref_count_dict)
-        t0 = time.time()
-    except Exception as e:
-        Write_Print(os.path.join(args.o,  "log.txt"), "error:" , e)
+def Load_References(ref_path, kmer_size = 0, cache_dir = None):
+    """
+    载入参考序列信息，给定kmer长度时预先制作所有基因的kmer表
+    在创建进程池之前调用，子进程通过fork共享这些只读的kmer表
+    不给定kmer长度时，每个kmer长度的表由第一个用到的进程制作并存入cache_dir，
+    各进程以内存映射读取，同样只占一份内存
+    :param ref_path: 参考序列文件或文件夹
+    :param kmer_size: kmer的长度，0时不预先制作
+    :param cache_dir: 保存kmer表的文件夹
+    :return: 序列路径字典，参考序列条数字典
+    """
+    global ref_kmer_cache
+    _ref_path_dict, _ref_count_dict = {}, {}
+    Get_Ref_Info(ref_path, _ref_path_dict, _ref_count_dict)
 
-    try:
-        Write_Print(os.path.join(args.o,  "log.txt"), '======================== Assemble =========================')
+    if kmer_size:
+        ref_kmer_cache = ReferenceKmerCache(cache_dir, max(len(_ref_path_dict), 64))
+        for path in _ref_path_dict.values():
+            Get_Kmer_Dict(path, kmer_size, cache_dir)
+
+    return _ref_path_dict, _ref_count_dict
+
+def Prepare_Sample(args):
+    """
+    初始化样本的文件夹并记录日志
+    :return: 开始拼接的时间
+    """
+    if not os.path.isdir(os.path.join(args.o, 'results')):
+        os.mkdir(os.path.join(args.o, 'results'))
+    if not os.path.isdir(os.path.join(args.o, 'contigs_all')):
+        os.mkdir(os.path.join(args.o, 'contigs_all'))
+    print("Do not close this window manually, please!")
+    Write_Print(os.path.join(args.o,  "log.txt"), '======================== Assemble =========================')
+    return time.time()
+
+def Gene_Tasks(args, refs):
+    """
+    样本中每个基因的拼接任务
+    :param refs: Load_References的结果
+    :return: process_key_value的参数列表，按基因顺序
+    """
+    _ref_path_dict, _ref_count_dict = refs
+    return [(args, key, ref_path, _ref_count_dict[key], args.iteration, args.soft_boundary, loop_count, len(_ref_path_dict))
+            for loop_count, (key, ref_path) in enumerate(_ref_path_dict.items(), start=1)]
 
+def Write_Results(args, results, t0):
+    """
+    写入result_dict.txt并记录用时
+    :param results: 按基因顺序的process_key_value结果
+    :param t0: Prepare_Sample返回的开始时间
+    :return: 结果字典
+    """
+    result_dict = {}
+    for success, key_update, result_dict_entry in results:
+        if result_dict_entry.get("status") != "skipped":
+            # 状态，切片数，用时（秒），reads库和kmer图的内存（字节）
+            result_dict[key_update] = [result_dict_entry[x] for x in ("status", "value", "seconds", "read_bytes", "graph_bytes")]
+
+    Write_Dict(result_dict, os.path.join(args.o, "result_dict.txt"))
+    t1 = time.time()
+    Write_Print(os.path.join(args.o,  "log.txt"), '\nTime cost:', t1 - t0, '\n') # 拼接所用的时间
+    return result_dict
+
+def Assemble_Sample(args, refs = None, pool = None, max_pending = None):
+    """
+    拼接一个样本的所有基因，写入results、contigs_all和result_dict.txt
+    可以在同一个进程池中同时拼接多个样本，每个基因是一个任务
+    :param args: Make_Parser解析的参数
+    :param refs: Load_References的结果，None时重新载入
+    :param pool: 进程池，None时按args.processes创建，processes为1时在本进程拼接
+    :param max_pending: 本样本同时提交到进程池的基因数，None时不限制
+    :return: 结果字典
+    """
+    # 初始化文件夹，载入参考序列信息
+    t0 = Prepare_Sample(args)
+    tasks = Gene_Tasks(args, refs or Load_References(args.r))
+
+    own_pool = pool is None and args.processes > 1
+    if own_pool:
+        pool = multiprocessing.Pool(args.processes)
+
+    try:
         results = []
-        if args.processes > 1:
-            pool = multiprocessing.Pool(args.processes)
-            for loop_count, (key, ref_path) in enumerate(ref_path_dict.items(), start=1):
-                results.append(pool.apply_async(process_key_value, (args, key, ref_path, ref_count_dict[key], args.iteration, args.soft_boundary, loop_count, len(ref_path_dict))))
+        pending = deque()
+        for task in tasks:
+            if pool is None:
+                results.append(process_key_value(*task))
+                continue
+            # 限制提交的任务数，等待最早提交的任务完成
+            if max_pending and len(pending) >= max_pending:
+                pending.popleft().wait()
+            results.append(pool.apply_async(process_key_value, task))
+            pending.append(results[-1])
+        if own_pool:
             pool.close()
             pool.join()
-        else:
-            for loop_count, (key, ref_path) in enumerate(ref_path_dict.items(), start=1):
-                results.append(process_key_value(args, key, ref_path, ref_count_dict[key], args.iteration, args.soft_boundary, loop_count, len(ref_path_dict)))
-
-        result_dict = {}
-        for result in results:
-            success, key_update, result_dict_entry = result if type(result) == tuple else result.get()
-            if result_dict_entry.get("status") != "skipped":
-                result_dict[key_update] = [result_dict_entry["status"], result_dict_entry["value"]]
-
-        Write_Dict(result_dict, os.path.join(args.o, "result_dict.txt"))
-        t1 = time.time()
-        Write_Print(os.path.join(args.o,  "log.txt"), '\nTime cost:', t1 - t0, '\n') # 拼接所用的时间
+    finally:
+        if own_pool:
+            pool.terminate()
+
+    return Write_Results(args, [result if type(result) == tuple else result.get() for result in results], t0)
+
+if __name__ == '__main__':
+    if sys.platform.startswith('win'):
+        multiprocessing.freeze_support()
+
+    args = Make_Parser().parse_args()
+
+    try:
+        Assemble_Sample(args)
     except Exception as e:
         Write_Print(os.path.join(args.o,  "log.txt"), "error:" , e)
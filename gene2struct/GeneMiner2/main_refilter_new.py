@@ -3,10 +3,19 @@ from Bio.SeqIO.QualityIO import FastqGeneralIterator
 import argparse
 import collections
 import contextlib
+import hashlib
+import io
+import itertools
 import math
 import os
 import shutil
 
+import numpy as np
+
+import gene2struct.Geneminer2.compressed_reader as compressed_reader
+import gene2struct.Geneminer2.kmer_codec as kmer_codec
+from gene2struct.Geneminer2.kmer_index import KmerIndex
+
 FILE_EXTENSION = {
     'fasta': '.fasta',
     'fastq': '.fq'
@@ -20,6 +29,8 @@ FILE_TYPES = {
     '.fastq': 'fastq'
 }
 
+COMPRESSED_EXTENSIONS = ('.gz', '.bgz', '.bgzf')
+
 FORMAT_FUNCTIONS = {
     'fasta': lambda t: f'>{t[0]}\n{t[1]}\n',
     'fastq': lambda t: f'@{t[0]}\n{t[1]}\n+\n{t[2]}\n'
@@ -30,8 +41,10 @@ READ_ITERATORS = {
    'fastq': FastqGeneralIterator
 }
 
-FWD_TRANS = collections.defaultdict(lambda: None, str.maketrans("ACGTUacgtu", "0123301233"))
-REV_TRANS = collections.defaultdict(lambda: None, str.maketrans("ACGTUacgtu", "3210032100"))
+RUN_LEN_CONST = 0.5772156649 / math.log(2) - 1.5
+THR_P95_2T = 1.96
+THR_1e5_1T = 3.74
+TOLERANCE = 1e-5
 
 def print_log(log_path, *args, **kwargs):
     if log_path:
@@ -40,16 +53,27 @@ def print_log(log_path, *args, **kwargs):
 
     print(*args, **kwargs)
 
+def split_extension(name):
+    # Returns (base name, full extension, file type extension)
+    # e.g. 'S_1.fq.gz' -> ('S_1', '.fq.gz', '.fq')
+    basename, extname = os.path.splitext(name)
+
+    if extname in COMPRESSED_EXTENSIONS:
+        basename, type_ext = os.path.splitext(basename)
+        return basename, type_ext + extname, type_ext
+
+    return basename, extname, extname
+
 def get_read_dict(se_dir, pe_dir):
     read_dict = {}
-    walk_directory = lambda path: ((os.path.dirname(ent.path), *os.path.splitext(ent.name)) for ent in os.scandir(path) if ent.is_file())
+    walk_directory = lambda path: ((os.path.dirname(ent.path), *split_extension(ent.name)) for ent in os.scandir(path) if ent.is_file())
 
     if se_dir:
         if not os.path.isdir(se_dir):
             raise ValueError('Argument --se-dir does not refer to a directory.')
 
-        for dirname, basename, extname in walk_directory(se_dir):
-            if extname not in FILE_TYPES:
+        for dirname, basename, extname, type_ext in walk_directory(se_dir):
+            if type_ext not in FILE_TYPES:
                 continue
 
             if basename in read_dict:
@@ -61,8 +85,8 @@ def get_read_dict(se_dir, pe_dir):
         if not os.path.isdir(pe_dir):
             raise ValueError('Argument --pe-dir does not refer to a directory.')
 
-        for dirname, basename, extname in walk_directory(pe_dir):
-            if extname not in FILE_TYPES or not basename.endswith('_1'):
+        for dirname, basename, extname, type_ext in walk_directory(pe_dir):
+            if type_ext not in FILE_TYPES or not basename.endswith('_1'):
                 continue
 
             gene_name = basename[:-2]
@@ -80,6 +104,57 @@ def get_read_dict(se_dir, pe_dir):
     print(read_dict)
     return read_dict
 
+def stage_read_file(path, stage_dir, stage_name):
+    # Returns (path to read, bytes copied)
+    # Files are read in place, except when their name does not tell their type: these
+    # are linked, or copied as a last resort, under a name with the sniffed type
+    if split_extension(os.path.basename(path))[2] in FILE_TYPES:
+        return path, 0
+
+    with compressed_reader.open_text(path) as f:
+        first = f.read(1)
+
+    if first not in ('@', '>'):
+        raise ValueError(f"Read file '{path}' is neither FASTA nor FASTQ.")
+
+    os.makedirs(stage_dir, exist_ok=True)
+    staged_path = os.path.join(stage_dir, stage_name + FILE_EXTENSION['fastq' if first == '@' else 'fasta'])
+
+    if os.path.lexists(staged_path):
+        os.remove(staged_path)
+
+    for link in (os.link, lambda src, dst: os.symlink(os.path.abspath(src), dst)):
+        try:
+            link(path, staged_path)
+            return staged_path, 0
+        except OSError:
+            pass
+
+    shutil.copyfile(path, staged_path)
+    return staged_path, os.path.getsize(staged_path)
+
+def get_read_files(read_files, sample_name=None, stage_dir=None):
+    # Returns ({sample name: read paths}, bytes copied while staging)
+    if len(read_files) > 2:
+        raise ValueError('Argument --read-files takes one or two files.')
+
+    for path in read_files:
+        if not os.path.isfile(path):
+            raise ValueError(f"Read file '{path}' does not exist.")
+
+    if not sample_name:
+        sample_name = split_extension(os.path.basename(read_files[0]))[0]
+
+        if len(read_files) == 2 and sample_name.endswith('_1'):
+            sample_name = sample_name[:-2]
+
+    if stage_dir is None:
+        return {sample_name: tuple(read_files)}, 0
+
+    staged = [stage_read_file(path, stage_dir, f'{sample_name}_{i + 1}') for i, path in enumerate(read_files)]
+
+    return {sample_name: tuple(path for path, _ in staged)}, sum(size for _, size in staged)
+
 def get_ref_dict(ref_dir):
     ref_dict = {}
 
@@ -108,205 +183,415 @@ def load_reference(ref_path, kmer_size):
     effective_len = int(max(length_list) * (math.log10(len(length_list)) + 1))
     return ref_set, effective_len
 
-def build_kmer_dict(ref_set, kmer_size, trans=FWD_TRANS, rtrans=REV_TRANS):
-    # Values: 0=unused; 1=forward; 2=reverse; 3=both
-    kmer_dict = collections.defaultdict(lambda: 0)
-    mask_bin  = (1 << (kmer_size << 1)) - 1
+def load_references(ref_dict, kmer_size, log_path=None):
+    # Genes without any reference sequence of at least kmer_size bases are left out
+    gene_names, ref_sets, ref_lengths = [], [], []
 
-    for seq in ref_set:
-        seq_str   = seq.translate(trans)
-        seq_str_r = seq.translate(rtrans)[::-1]
+    for gene_name, ref_path in ref_dict.items():
+        ref_set, effective_len = load_reference(ref_path, kmer_size)
 
-        if not seq_str:
+        if not effective_len:
+            print_log(log_path, f'Gene {gene_name} has no valid reference.')
             continue
 
-        seq_int   = int(seq_str, 4)
-        seq_int_r = int(seq_str_r, 4)
+        gene_names.append(gene_name)
+        ref_sets.append(ref_set)
+        ref_lengths.append(effective_len)
 
-        for _ in range(0, len(seq_str) - kmer_size + 1):
-            kmer_dict[seq_int   & mask_bin] |= 1
-            kmer_dict[seq_int_r & mask_bin] |= 2
-            seq_int   >>= 2
-            seq_int_r >>= 2
+    return gene_names, ref_sets, ref_lengths
 
-    return kmer_dict
+def run_length_kmer_size(kmer_size):
+    # On the weird choice of k-mer size
+    # Assume the sequencing error rate to be 0.95
+    # 1 - 0.95^13 = 0.4867 < 0.5
+    # On average, one of two clusters of biological k-mer matches is error-free
+    return max(kmer_size // 2, kmer_size - 13) | 1
+
+def read_name_hash(title):
+    # 64-bit hash of a read name, equal for both mates of a pair
+    # The name ends at the first whitespace, /1 and /2 suffixes are ignored
+    name = title.split(None, 1)[0] if title else ''
+
+    if name.endswith(('/1', '/2')):
+        name = name[:-2]
+
+    return int.from_bytes(hashlib.blake2b(name.encode(), digest_size=8).digest(), 'little')
+
+def iter_blocks(iterable, block_size=8192):
+    iterator = iter(iterable)
+
+    while block := list(itertools.islice(iterator, block_size)):
+        yield block
+
+def collect_runs_stats(reads, kmer_index):
+    # Returns (read index, gene index, stats) for every read and gene sharing a k-mer
+    # Stats: [0:4]=best length; [4:8]=run count; [8:12]=hit count; [12]=k-mer count
+    # where the states along the read are 0=mismatch; 1=forward; 2=reverse; 3=both
+    kmer_size = kmer_index.kmer_size
+    codes, offsets = kmer_codec.pack_sequences(tp[1] for tp in reads)
+    kmer_cnts = kmer_codec.kmer_counts(offsets, kmer_size)
+    kmers     = kmer_codec.forward_kmers(codes, offsets, kmer_size)
+
+    hit_idx, genes, flags = kmer_index.lookup(kmers)
+    read_ids = kmer_codec.kmer_read_ids(offsets, kmer_size)[hit_idx]
+    kmer_pos = hit_idx - (np.cumsum(kmer_cnts) - kmer_cnts)[read_ids]
+
+    order = np.lexsort((kmer_pos, genes, read_ids))
+    read_ids, genes, flags, kmer_pos = read_ids[order], genes[order], flags[order], kmer_pos[order]
+
+    # Hits of one read against one gene form a segment, and adjacent
+    # hits of the same orientation within a segment form a run
+    seg_head = np.ones(len(order), dtype=bool)
+    seg_head[1:] = (read_ids[1:] != read_ids[:-1]) | (genes[1:] != genes[:-1])
+    seg_tail = np.ones(len(order), dtype=bool)
+    seg_tail[:-1] = seg_head[1:]
+    is_gap = np.zeros(len(order), dtype=bool)
+    is_gap[1:] = kmer_pos[1:] - kmer_pos[:-1] > 1
+    run_head = seg_head | is_gap
+    run_head[1:] |= flags[1:] != flags[:-1]
+
+    seg_ids  = np.cumsum(seg_head) - 1
+    seg_cnt  = int(seg_head.sum())
+    seg_read = read_ids[seg_head]
+    run_len  = np.bincount(np.cumsum(run_head) - 1)
+    run_seg  = seg_ids[run_head]
+    run_dir  = flags[run_head]
+    stats    = np.zeros((seg_cnt, 13), dtype=np.int64)
+
+    for state in (1, 2, 3):
+        is_state = run_dir == state
+        np.maximum.at(stats[:, state], run_seg[is_state], run_len[is_state])
+        stats[:, state + 4] = np.bincount(run_seg[is_state], minlength=seg_cnt)
+        stats[:, state + 8] = np.bincount(seg_ids[flags == state], minlength=seg_cnt)
+
+    # Mismatch runs: one before the first hit (counted even if empty),
+    # one per gap between hits and one after the last hit if any
+    stats[:, 4]  = np.bincount(seg_ids[is_gap & ~seg_head], minlength=seg_cnt) + 1
+    stats[:, 4] += kmer_pos[seg_tail] < kmer_cnts[seg_read] - 1
+    stats[:, 12] = kmer_cnts[seg_read]
+
+    return seg_read, genes[seg_head].astype(np.int64), stats
+
+def isclose(a, b, abs_tol):
+    # Elementwise math.isclose with the default relative tolerance
+    diff = np.abs(b - a)
+    return (diff <= np.abs(1e-09 * b)) | (diff <= np.abs(1e-09 * a)) | (diff <= abs_tol)
+
+def mutation_rate_orientation(fwd_l, rev_l, fwd_n, rev_n):
+    # If the longest forward and reverse runs are both much longer
+    # than the expected run-length, assume all forward and reverse
+    # matches are contiguous and calculate an approximate mutation
+    # rate (https://math.stackexchange.com/a/5027331)
+    # If the mutation rates are too similar, we consider matches in
+    # both directions 'similarly good', thereby calling a chimera
+    # As a rule of thumb, we reject reads if the forward region and
+    # the reverse region share the same distribution, because their
+    # chimeric appearance impedes reference-guided assembly
+    lpf = math.exp(math.log(1 / (1 - fwd_l + fwd_n)) / fwd_l)
+    lpr = math.exp(math.log(1 / (1 - rev_l + rev_n)) / rev_l)
+    fpz = math.isclose(lpf, 0.0, abs_tol=TOLERANCE)
+    rpz = math.isclose(lpr, 0.0, abs_tol=TOLERANCE)
+
+    if fpz:
+        return 2 - 2 * rpz
+    elif rpz:
+        return 1
+    elif math.isclose(lpf, 1.0, abs_tol=TOLERANCE) and math.isclose(lpr, 1.0, abs_tol=TOLERANCE):
+        return 0
+    elif abs(lpf - lpr) / math.sqrt(lpf ** 2 * (1 - lpf) / fwd_n + lpr ** 2 * (1 - lpr) / rev_n) < THR_P95_2T:
+        return 0
+
+    return 3
+
+def call_orientations(stats):
+    # Verdict for each row of runs statistics from collect_runs_stats
+    # Return values: 0=reject; 1=forward; 2=reverse; 3=ambiguous
+    # Logarithms and exponentials go through math on the few values that need them,
+    # numpy may round them differently and flip a verdict on the threshold
+    (_, fwd_l, rev_l, _,
+     _, fwd_r, rev_r, _,
+     _, fwd_n, rev_n, amb_n, tot_n) = stats.T
+
+    # Forward hits    Reverse hits    Ambiguous hits    Verdict
+    # -----------------------------------------------------------
+    # <= 1            <= 1            <= 1              reject
+    # <= 1            <= 1            > 1               ambiguous
+    # <= 1            > 1             *                 reverse
+    # > 1             <= 1            *                 forward
+    # > 1             > 1             *                 continue
+    results = np.where(fwd_n <= 1, np.where(rev_n <= 1, (amb_n > 1) * 3, 2), 1).astype(np.int8)
+    rows    = np.flatnonzero((fwd_n > 1) & (rev_n > 1))
+
+    if not len(rows):
+        return results
+
+    fwd_l, rev_l, fwd_r, rev_r, fwd_n, rev_n, tot_n = (col[rows] for col in (fwd_l, rev_l, fwd_r, rev_r, fwd_n, rev_n, tot_n))
+
+    # Note that we count the runs for all four states
+    # (mismatch, forward, reverse, ambiguous)
+    # but we calculate the expected number of runs with two states
+    # This is equivalent to spliting a run into two whenever
+    # a mismatch is encountered
+    # In principle, E(R) = 2*n1*n2/(n1+n2)+mutation_rate*(n1+n2)+1
+    # However, we choose to ignore the mutation term and tolerate
+    # a bounded multiplier on E(R), implying much higher stringency
+    npr = 2 * fwd_n * rev_n
+    nht = fwd_n + rev_n
+
+    # E(R) in standard runs test
+    # 2*n1*n2/(n1+n2)+1
+    erc = npr / nht + 1
+
+    # Var(R) in standard runs test
+    # 2*n1*n2*(2*n1*n2-n1-n2)/(n1+n2)^2*(n1+n2-1)
+    vrn = npr * (npr - nht) / (nht * nht * (nht - 1))
+
+    # The direction of runs does not autocorrelate enough
+    # i.e. the runs are either random or somehow periodic
+    is_random = (fwd_r + rev_r - erc) / np.sqrt(vrn) > -THR_1e5_1T
+
+    # Next, we assume some mismatches caused the difference of
+    # the numbers of runs
+    # Let pf be the error rate in the forward matching region
+    # pf = (fwd_r - true_fwd_r) / (fwd_n / (1 - pf))
+    ntt = np.where(fwd_r > rev_r, fwd_n + fwd_r - rev_r, fwd_n + rev_r - fwd_r)
+    rex = fwd_n / ntt
+
+    # If we cannot infer that the direction with more runs has
+    # a significant proportion of mismatches against reference
+    # then call a chimera
+    with np.errstate(divide='ignore', invalid='ignore'):
+        is_chimera = is_random & (isclose(rex, 1.0, TOLERANCE) | ((1 - rex) / np.sqrt(rex * (1 - rex) / ntt) < THR_P95_2T))
+
+    # Expected longest run, which depends on the read length only
+    uniq_n, uniq_idx = np.unique(tot_n, return_inverse=True)
+    erl = np.array([max(math.log2(n) + RUN_LEN_CONST, 0) + 4 for n in uniq_n.tolist()], dtype=np.float64)[uniq_idx]
+
+    orient = ((fwd_l > erl) + (rev_l > erl) * 2).astype(np.int8)
+    is_ambiguous = np.flatnonzero((orient == 3) & ~is_chimera)
+
+    orient[is_ambiguous] = [mutation_rate_orientation(*row)
+                            for row in zip(*(col[is_ambiguous].tolist() for col in (fwd_l, rev_l, fwd_n, rev_n)))]
+    orient[is_chimera] = 0
+    results[rows] = orient
+
+    return results
+
+def iter_chunks(read_files, file_type, max_reads=0, chunk_size=8192):
+    # Yields the raw text of the next chunk_size records of every file
+    # Chunks are cut at record boundaries and hold the same number of records per file
+    records_left = max_reads if max_reads > 0 else math.inf
+    held_lines   = [None] * len(read_files)
+    held_records = [collections.deque() for _ in read_files]
+
+    def read_fasta(file_idx, record_cnt):
+        lines = [held_lines[file_idx]] if held_lines[file_idx] else []
+        held_lines[file_idx] = None
+        header_cnt = len(lines)
+
+        for line in read_files[file_idx]:
+            if line.startswith('>'):
+                header_cnt += 1
+
+                if header_cnt > record_cnt:
+                    held_lines[file_idx] = line
+                    break
+
+            lines.append(line)
+
+        return ''.join(lines)
+
+    def read_fastq(file_idx, record_cnt):
+        # Sequence and quality may be wrapped over several lines, a record ends
+        # once its quality is as long as its sequence, as in FastqGeneralIterator
+        f, held = read_files[file_idx], held_records[file_idx]
+        take = lambda: held.popleft() if held else next(f, '')
+        lines = []
+
+        for _ in range(record_cnt):
+            if not held:
+                record = list(itertools.islice(f, 4))
+
+                if len(record) == 4 and record[2].startswith('+') and len(record[3].rstrip()) == len(record[1].rstrip()):
+                    lines += record
+                    continue
 
-def collect_runs_stats(reads, kmer_dict, kmer_size, trans=FWD_TRANS, zero_stats=(0, ) * 12):
-    # Return values: [0:4]=best length; [4:8]=run count; [8:12]=hit count; [12]=k-mer count
-    mask_bin = (1 << (kmer_size << 1)) - 1
+                held.extend(record)
 
-    for tp in reads:
-        read_str = tp[1].translate(trans)
-        kmer_cnt = len(read_str) - kmer_size + 1
-        results  = [*zero_stats, kmer_cnt]
+            header = take()
 
-        if kmer_cnt > 0:
-            curr_dir    = 0
-            curr_len    = 0
-            read_int    = int(read_str, 4)
+            if not header:
+                break
 
-            for _ in range(0, kmer_cnt):
-                kmer = read_int & mask_bin
-                orient = 0
-                read_int >>= 2
+            lines.append(header)
+            seq_len = 0
 
-                if kmer in kmer_dict:
-                    orient = kmer_dict[kmer]
+            while (line := take()) and not line.startswith('+'):
+                lines.append(line)
+                seq_len += len(line.rstrip())
 
-                if orient != curr_dir:
-                    if curr_len > results[curr_dir]:
-                        results[curr_dir] = curr_len
+            lines.append(line)
+            line = take() if line else ''
+            lines.append(line)
+            qual_len = len(line.rstrip())
 
-                    results[curr_dir + 4] += 1
-                    curr_dir = orient
-                    curr_len = 0
+            while line and qual_len < seq_len:
+                line = take()
+                lines.append(line)
+                qual_len += len(line.rstrip())
 
-                if curr_dir != 0:
-                    curr_len += 1
-                    results[curr_dir + 8] += 1
+        return ''.join(lines)
 
-            if curr_len > results[curr_dir]:
-                results[curr_dir] = curr_len
+    while records_left > 0:
+        record_cnt = min(chunk_size, records_left)
 
-            results[curr_dir + 4] += 1
+        if file_type == 'fastq':
+            chunk = tuple(read_fastq(file_idx, record_cnt) for file_idx in range(len(read_files)))
         else:
-            results[12] = 0
+            chunk = tuple(read_fasta(file_idx, record_cnt) for file_idx in range(len(read_files)))
+
+        if not all(chunk):
+            break
 
-        yield results
+        records_left -= record_cnt
+        yield chunk
 
-def run_length_filter(name, out_dir, ref_set, ref_length, read_info, file_type, kmer_size, keep_temporaries):
-    RUN_LEN_CONST = 0.5772156649 / math.log(2) - 1.5
-    THR_P95_2T = 1.96
-    THR_1e5_1T = 3.74
-    TOLERANCE = 1e-5
+def init_chunk_worker(kmer_index):
+    global chunk_index
+    chunk_index = kmer_index
 
-    output_ext  = FILE_EXTENSION[file_type]
-    output_path = os.path.join(out_dir, 'large_files', name + output_ext)
+def score_chunk(task):
+    # Returns (gene index, formatted read) for each read to keep, in input order
+    chunk, file_type, gene_cnt = task
     format_func = FORMAT_FUNCTIONS[file_type]
     read_iter   = READ_ITERATORS[file_type]
-    open_flags  = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    block       = list(zip(*(read_iter(io.StringIO(text)) for text in chunk)))
+
+    # Verdicts of each mate, keyed by read pair and gene
+    mate_keys    = []
+    mate_orients = []
+
+    for mate_reads in zip(*block):
+        read_ids, genes, stats = collect_runs_stats(mate_reads, chunk_index)
+        mate_keys.append(read_ids * gene_cnt + genes)
+        mate_orients.append(call_orientations(stats))
+
+    if not mate_keys:
+        return []
+
+    pair_keys = np.unique(np.concatenate(mate_keys))
+    orient    = np.zeros((len(mate_keys), len(pair_keys)), dtype=np.int8)
+
+    for mate_idx, keys in enumerate(mate_keys):
+        orient[mate_idx, np.searchsorted(pair_keys, keys)] = mate_orients[mate_idx]
+
+    is_kept = orient.any(axis=0)
+
+    # Discordant paired reads
+    if len(orient) == 2:
+        is_kept &= (orient[0] != orient[1]) | (orient[0] == 0) | (orient[0] == 3)
+
+    results = []
+
+    for key, linked_orient in zip(pair_keys[is_kept].tolist(), orient[:, is_kept].T.tolist()):
+        pair_idx, gene_idx = divmod(key, gene_cnt)
+
+        for tp, read_orient in zip(block[pair_idx], linked_orient):
+            if read_orient:
+                results.append((gene_idx, format_func(tp)))
+
+    return results
+
+def run_length_filter(names, out_dir, read_info, file_type, keep_temporaries, threads=1, max_reads=0, pool=None, flush_size=65536):
+    # Reads are streamed once for all genes and sorted into per-gene bins
+    # Chunks are scored by score_chunk, in the pool if given, after init_chunk_worker
+    output_ext   = FILE_EXTENSION[file_type]
+    output_paths = [os.path.join(out_dir, 'large_files', name + output_ext) for name in names]
+    open_flags   = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
 
     if os.name == 'nt' and not keep_temporaries:
         open_flags |= os.O_SHORT_LIVED
 
-    kmer_dict = build_kmer_dict(ref_set, kmer_size)
+    # Keep at most one output file open at a time, large reference panels
+    # would otherwise run into the open file limit
+    for path in output_paths:
+        os.close(os.open(path, open_flags))
+
+    output_bins  = [[] for _ in names]
+    buffered_cnt = 0
+
+    def flush_bins():
+        for path, output_bin in zip(output_paths, output_bins):
+            if output_bin:
+                with open(path, 'a') as output_file:
+                    output_file.writelines(output_bin)
+
+                output_bin.clear()
+
+    def collect(results):
+        nonlocal buffered_cnt
+
+        for gene_idx, text in results:
+            output_bins[gene_idx].append(text)
+
+        buffered_cnt += len(results)
+
+        if buffered_cnt >= flush_size:
+            flush_bins()
+            buffered_cnt = 0
 
     with contextlib.ExitStack() as stack:
-        read_iters  = [read_iter(stack.enter_context(open(path, 'r'))) for path in read_info]
-        output_file = stack.enter_context(os.fdopen(os.open(output_path, open_flags), 'w'))
-
-        for linked_reads in zip(*read_iters):
-            orient = [0] * len(linked_reads)
-
-            for i, (_, fwd_l, rev_l, _,
-                    _, fwd_r, rev_r, _,
-                    _, fwd_n, rev_n, amb_n, tot_n) in enumerate(collect_runs_stats(linked_reads, kmer_dict, kmer_size)):
-
-                # Forward hits    Reverse hits    Ambiguous hits    Verdict
-                # -----------------------------------------------------------
-                # <= 1            <= 1            <= 1              reject
-                # <= 1            <= 1            > 1               ambiguous
-                # <= 1            > 1             *                 reverse
-                # > 1             <= 1            *                 forward
-                # > 1             > 1             *                 continue
-                if fwd_n <= 1:
-                    orient[i] = (rev_n <= 1) * (1 - (amb_n <= 1) * 3) + 2
-                    continue
-                elif rev_n <= 1:
-                    orient[i] = 1
-                    continue
+        read_files = [stack.enter_context(compressed_reader.open_text(path, threads)) for path in read_info]
+        tasks      = ((chunk, file_type, len(names)) for chunk in iter_chunks(read_files, file_type, max_reads))
 
-                # Note that we count the runs for all four states
-                # (mismatch, forward, reverse, ambiguous)
-                # but we calculate the expected number of runs with two states
-                # This is equivalent to spliting a run into two whenever
-                # a mismatch is encountered
-                # In principle, E(R) = 2*n1*n2/(n1+n2)+mutation_rate*(n1+n2)+1
-                # However, we choose to ignore the mutation term and tolerate
-                # a bounded multiplier on E(R), implying much higher stringency
-                npr = 2 * fwd_n * rev_n
-                nht = fwd_n + rev_n
-
-                # E(R) in standard runs test
-                # 2*n1*n2/(n1+n2)+1
-                erc = npr / nht + 1
-
-                # Var(R) in standard runs test
-                # 2*n1*n2*(2*n1*n2-n1-n2)/(n1+n2)^2*(n1+n2-1)
-                vrn = npr * (npr - nht) / (nht * nht * (nht - 1))
-
-                # The direction of runs does not autocorrelate enough
-                # i.e. the runs are either random or somehow periodic
-                if (fwd_r + rev_r - erc) / math.sqrt(vrn) > -THR_1e5_1T:
-
-                    # Next, we assume some mismatches caused the difference of
-                    # the numbers of runs
-                    # Let pf be the error rate in the forward matching region
-                    # pf = (fwd_r - true_fwd_r) / (fwd_n / (1 - pf))
-                    if fwd_r > rev_r:
-                        ntt = fwd_n + fwd_r - rev_r
-                        rex = fwd_n / ntt
-                    else:
-                        ntt = fwd_n + rev_r - fwd_r
-                        rex = fwd_n / ntt
-
-                    # If we cannot infer that the direction with more runs has
-                    # a significant proportion of mismatches against reference
-                    # then call a chimera
-                    if math.isclose(rex, 1.0, abs_tol=TOLERANCE) or (1 - rex) / math.sqrt(rex * (1 - rex) / ntt) < THR_P95_2T:
-                        orient[i] = 0
-                        continue
-
-                erl = max(math.log2(tot_n) + RUN_LEN_CONST, 0) + 4
-                orient[i] = (fwd_l > erl) + (rev_l > erl) * 2
-
-                # The orientation is unambiguous
-                if orient[i] != 3:
-                    continue
+        if pool:
+            # Bound the chunks in flight, the pool would otherwise read ahead the whole file
+            pending = collections.deque()
 
-                # If the longest forward and reverse runs are both much longer
-                # than the expected run-length, assume all forward and reverse
-                # matches are contiguous and calculate an approximate mutation
-                # rate (https://math.stackexchange.com/a/5027331)
-                # If the mutation rates are too similar, we consider matches in
-                # both directions 'similarly good', thereby calling a chimera
-                # As a rule of thumb, we reject reads if the forward region and
-                # the reverse region share the same distribution, because their
-                # chimeric appearance impedes reference-guided assembly
-                lpf = math.exp(math.log(1 / (1 - fwd_l + fwd_n)) / fwd_l)
-                lpr = math.exp(math.log(1 / (1 - rev_l + rev_n)) / rev_l)
-                fpz = math.isclose(lpf, 0.0, abs_tol=TOLERANCE)
-                rpz = math.isclose(lpr, 0.0, abs_tol=TOLERANCE)
-
-                if fpz:
-                    orient[i] = 2 - 2 * rpz
-                elif rpz:
-                    orient[i] = 1
-                elif math.isclose(lpf, 1.0, abs_tol=TOLERANCE) and math.isclose(lpr, 1.0, abs_tol=TOLERANCE):
-                    orient[i] = 0
-                elif abs(lpf - lpr) / math.sqrt(lpf ** 2 * (1 - lpf) / fwd_n + lpr ** 2 * (1 - lpr) / rev_n) < THR_P95_2T:
-                    orient[i] = 0
-
-            # Discordant paired reads
-            if len(orient) == 2 and 1 <= orient[0] <= 2 and orient[0] == orient[1]:
-                continue
+            for task in tasks:
+                pending.append(pool.apply_async(score_chunk, (task, )))
+
+                if len(pending) >= threads << 1:
+                    collect(pending.popleft().get())
+
+            while pending:
+                collect(pending.popleft().get())
+        else:
+            for task in tasks:
+                collect(score_chunk(task))
+
+    flush_bins()
 
-            output_file.writelines(format_func(tp) for i, tp in enumerate(linked_reads) if orient[i])
+    return output_paths
 
-    return output_path
+def filter_reads(reads, kmer_index):
+    # Whether each read shares at least one k-mer with the reference
+    kmer_size = kmer_index.kmer_size
+    codes, offsets = kmer_codec.pack_sequences(tp[1] for tp in reads)
+    hits = kmer_index.contains(kmer_codec.forward_kmers(codes, offsets, kmer_size))
 
-def filter_read(read, kmer_dict, kmer_size, trans=FWD_TRANS):
-    mask_bin = (1 << (kmer_size << 1)) - 1
-    read_str = read.translate(trans)
+    return np.bincount(kmer_codec.kmer_read_ids(offsets, kmer_size), weights=hits, minlength=len(offsets) - 1) > 0
 
-    if len(read_str) < kmer_size:
-        return False
+def match_reads(temp_path, read_iter, kmer_index, candidates=None):
+    # Which reads of temp_path share a k-mer with the reference, and their total length
+    # Only reads set in candidates are checked, the others are counted as misses
+    is_hit_list = []
+    hit_length  = 0
+    start = 0
 
-    read_int = int(read_str, 4)
+    with open(temp_path, 'r') as f:
+        for block in iter_blocks(read_iter(f)):
+            is_hit = np.zeros(len(block), dtype=bool)
+            read_ids = np.arange(len(block)) if candidates is None else np.flatnonzero(candidates[start:start + len(block)])
+
+            if len(read_ids):
+                is_hit[read_ids] = filter_reads([block[i] for i in read_ids.tolist()], kmer_index)
+
+            hit_length += sum(len(block[i][1]) for i in np.flatnonzero(is_hit).tolist())
+            is_hit_list.append(is_hit)
+            start += len(block)
 
-    return any(True
-               for i in range(0, len(read_str) - kmer_size + 1)
-               if ((read_int >> (2 * i)) & mask_bin) in kmer_dict)
+    return (np.concatenate(is_hit_list) if is_hit_list else np.zeros(0, dtype=bool)), hit_length
 
 def kmer_filter(name, out_dir, log_path, ref_set, ref_length, temp_path, file_type, kmer_size, min_depth, max_depth, max_size, keep_temporaries):
     output_ext  = FILE_EXTENSION[file_type]
@@ -327,10 +612,16 @@ def kmer_filter(name, out_dir, log_path, ref_set, ref_length, temp_path, file_ty
     min_depth = min(min_depth, max_depth / 4)
     initial_kmer_size = kmer_size
 
+    # Reads matching at the current k-mer size, None while it is the initial one
+    # A read sharing a k-mer with the reference also shares all its shorter k-mers,
+    # so each step only checks the reads kept by the last one
+    is_kept = None
+
     # NOTE: the largest possible k-mer size is 63 + 6 = 69
     while kmer_size < 64 and (too_deep or too_large):
         last_kmer_size = kmer_size
         last_length = total_length
+        last_kept = is_kept
 
         if coverage > 8 * max_depth or total_length // 1e6 > 6 * max_size:
             kmer_size += 6
@@ -339,12 +630,8 @@ def kmer_filter(name, out_dir, log_path, ref_set, ref_length, temp_path, file_ty
 
         print_log(log_path, f'K-mer size for {name}: {kmer_size}')
 
-        kmer_dict = build_kmer_dict(ref_set, kmer_size)
-
-        with open(temp_path, 'r') as f:
-            total_length = sum(len(tp[1])
-                               for tp in read_iter(f)
-                               if filter_read(tp[1], kmer_dict, kmer_size))
+        kmer_index = KmerIndex.from_references([ref_set], kmer_size)
+        is_kept, total_length = match_reads(temp_path, read_iter, kmer_index, last_kept)
 
         coverage  = total_length / ref_length
         too_deep  = coverage > max_depth
@@ -353,6 +640,7 @@ def kmer_filter(name, out_dir, log_path, ref_set, ref_length, temp_path, file_ty
         if coverage < min_depth:
             kmer_size    = last_kmer_size
             total_length = last_length
+            is_kept      = last_kept
             coverage     = total_length / ref_length
             too_large    = total_length // 1e6 > max_size
             break
@@ -360,79 +648,76 @@ def kmer_filter(name, out_dir, log_path, ref_set, ref_length, temp_path, file_ty
     if kmer_size == initial_kmer_size and not too_large:
         return shutil.copyfile(temp_path, output_path)
 
-    kmer_dict = build_kmer_dict(ref_set, kmer_size)
-    interval = max(int(total_length / 1e6 / max_size), 2)
-    i = 0
+    if is_kept is None:
+        is_kept, _ = match_reads(temp_path, read_iter, KmerIndex.from_references([ref_set], kmer_size))
 
-    with open(temp_path, 'r') as f, open(output_path, 'w') as fo:
-        for tp in read_iter(f):
-            if filter_read(tp[1], kmer_dict, kmer_size):
-                i += 1
+    interval = max(int(total_length / 1e6 / max_size), 2)
 
-                if too_large and i % interval != 0:
-                    continue
+    # Keep about one in interval reads, chosen by name so that
+    # both mates of a pair are kept or dropped together
+    threshold = (1 << 64) // interval if too_large else 1 << 64
 
+    with open(temp_path, 'r') as f, open(output_path, 'w') as fo:
+        for tp, is_hit in zip(read_iter(f), is_kept.tolist()):
+            if is_hit and read_name_hash(tp[0]) < threshold:
                 fo.write(format_func(tp))
 
 def filter_gene(task):
-    file_ext = os.path.splitext(task.read_path[0])[1]
-
-    if file_ext not in FILE_TYPES:
-        print_log(task.log_path, f"File '{task.read_path[0]}' has invalid file type.")
-        return
-
     print_log(task.log_path, f'Filtering gene {task.name}.')
 
-    file_type = FILE_TYPES[file_ext]
-    ref_set, effective_len = load_reference(task.ref_path, task.kmer_size)
-
-    if not effective_len:
-        print_log(task.log_path, f'Gene {task.name} has no valid reference.')
-        return
-
-    # On the weird choice of k-mer size
-    # Assume the sequencing error rate to be 0.95
-    # 1 - 0.95^13 = 0.4867 < 0.5
-    # On average, one of two clusters of biological k-mer matches is error-free
-    tmp_path = run_length_filter(task.name, task.out_dir, ref_set, effective_len,
-                                 task.read_path, file_type, max(task.kmer_size // 2, task.kmer_size - 13) | 1,
-                                 task.keep_temporaries)
-
     kmer_filter(task.name, task.out_dir, task.log_path,
-                ref_set, effective_len, tmp_path, file_type,
+                task.ref_set, task.ref_length, task.tmp_path, task.file_type,
                 task.kmer_size, task.min_depth, task.max_depth,
                 task.max_size, task.keep_temporaries)
 
     if not task.keep_temporaries:
-        os.unlink(tmp_path)
+        os.unlink(task.tmp_path)
 
-Task = collections.namedtuple('Task', ('name', 'out_dir', 'ref_path', 'read_path',
-                                       'log_path', 'min_depth', 'max_depth',
+Task = collections.namedtuple('Task', ('name', 'out_dir', 'ref_set', 'ref_length', 'tmp_path',
+                                       'file_type', 'log_path', 'min_depth', 'max_depth',
                                        'max_size', 'keep_temporaries', 'kmer_size'))
 
 def run(args):
-    # print(read_dict)
-    tasks = []
-
-    # for name, ref_path in ref_dict.items():
-    #     if name not in read_dict:
-    #         print_log(args.log_file, f"No reads for gene {name}.")
-    #         continue
-    for sample_name, reads in read_dict.items():
-
-        for gene_name, ref_path in ref_dict.items():
-            print_log(args.log_file, f"Processing sample {sample_name} with gene {gene_name}...")
-            tasks.append(Task(gene_name, out_dir, ref_path, read_dict[sample_name], args.log_file,
+    gene_names, ref_sets, ref_lengths = load_references(ref_dict, args.kmer_size, args.log_file)
+    kmer_index = KmerIndex.cached(args.kmer_index, gene_names, ref_sets, run_length_kmer_size(args.kmer_size))
+
+    init_chunk_worker(kmer_index)
+    pool = multiprocessing.Pool(args.processes, init_chunk_worker, (kmer_index, )) if args.processes > 1 else None
+
+    try:
+        for sample_name, read_path in read_dict.items():
+            file_ext = split_extension(os.path.basename(read_path[0]))[2]
+
+            if file_ext not in FILE_TYPES:
+                print_log(args.log_file, f"File '{read_path[0]}' has invalid file type.")
+                continue
+
+            print_log(args.log_file, f'Processing sample {sample_name} with {len(gene_names)} genes...')
+            print_log(args.log_file, f'Reading {sum(map(os.path.getsize, read_path))} bytes from {", ".join(read_path)}, '
+                                     f'{copied_dict.get(sample_name, 0)} bytes copied.')
+
+            file_type = FILE_TYPES[file_ext]
+            tmp_paths = run_length_filter(gene_names, out_dir, read_path, file_type,
+                                          args.keep_temporaries, args.processes, args.max_reads, pool)
+
+            tmp_size = sum(os.path.getsize(path) for path in tmp_paths if os.path.isfile(path))
+            print_log(args.log_file, f'{tmp_size} bytes of candidate reads written for {len(tmp_paths)} genes.')
+
+            tasks = [Task(gene_name, out_dir, ref_set, ref_length, tmp_path, file_type, args.log_file,
                           args.min_depth, args.max_depth, args.max_size,
-                          args.keep_temporaries, args.kmer_size))
+                          args.keep_temporaries, args.kmer_size)
+                     for gene_name, ref_set, ref_length, tmp_path in zip(gene_names, ref_sets, ref_lengths, tmp_paths)]
 
-    if args.processes > 1:
-        with multiprocessing.Pool(args.processes) as pool:
-            for _ in pool.imap_unordered(filter_gene, tasks):
-                pass
-    else:
-        for task in tasks:
-            filter_gene(task)
+            if pool:
+                for _ in pool.imap_unordered(filter_gene, tasks):
+                    pass
+            else:
+                for task in tasks:
+                    filter_gene(task)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
 
     if not args.keep_temporaries:
         try:
@@ -440,6 +725,8 @@ def run(args):
         except OSError:
             pass
 
+        shutil.rmtree(os.path.join(out_dir, 'staged_reads'), ignore_errors=True)
+
 if __name__ == '__main__':
     import multiprocessing
 
@@ -451,25 +738,35 @@ if __name__ == '__main__':
     input_group = parser.add_mutually_exclusive_group(required=True)
     input_group.add_argument('-qs', '--se-dir', help='Directory with single-read sequencing data')
     input_group.add_argument('-qd', '--pe-dir', help='Directory with paired-end sequencing data')
+    input_group.add_argument('-qf', '--read-files', nargs='+', help='One single-read or two paired-end read files')
 
     parser.add_argument('-r', '--ref-dir', required=True, help='Directory with reference sequences')
     parser.add_argument('-o', '--out-dir', required=True, help='Output directory')
+    parser.add_argument('--sample-name', default=None, help='Sample name for --read-files')
 
     parser.add_argument('--log-file', default=None, help='Log file')
     parser.add_argument('--min-depth', default=50, help='Min allowed coverage', type=int)
     parser.add_argument('--max-depth', default=768, help='Max allowed coverage', type=int)
     parser.add_argument('--max-size', default=6, help='Max allowed size in million bases', type=int)
+    parser.add_argument('--max-reads', default=0, help='Max reads per file, 0 for no limit', type=int)
     parser.add_argument('--keep-temporaries', action='store_true', help='Keep temporary files')
     parser.add_argument('-kf', '--kmer-size', default=31, help='K-mer size', type=int)
+    parser.add_argument('--kmer-index', default=None, help='Reference k-mer index file, built if missing or outdated')
 
     parser.add_argument('-p', '--processes', default=1, help='Number of parallel processes', type=int)
 
     args = parser.parse_args()
 
     try:
-        read_dict = get_read_dict(args.se_dir, args.pe_dir)
-        ref_dict = get_ref_dict(args.ref_dir)
         out_dir = args.out_dir
+        copied_dict = {}
+
+        if args.read_files:
+            read_dict, copied = get_read_files(args.read_files, args.sample_name, os.path.join(out_dir, 'staged_reads'))
+            copied_dict = {name: copied for name in read_dict}
+        else:
+            read_dict = get_read_dict(args.se_dir, args.pe_dir)
+        ref_dict = get_ref_dict(args.ref_dir)
         os.makedirs(os.path.join(out_dir, 'large_files'), exist_ok=True)
     except (OSError, ValueError) as e:
         parser.error(str(e))
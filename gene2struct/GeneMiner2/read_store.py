@@ -0,0 +1,156 @@
+from collections import Counter
+
+import numpy as np
+
+import gene2struct.Geneminer2.kmer_codec as kmer_codec
+
+CODE_BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+REVERSE_TABLE = str.maketrans('ACGT', 'TGCA')
+
+IS_ACGT = np.zeros(256, dtype=bool)
+IS_ACGT[list(b'ACGT')] = True
+
+def _middle_bounds(lengths, slice_len):
+    # Bounds of text[start:start + slice_len] with start = (len - slice_len) >> 1,
+    # following Python slicing for texts shorter than the slice
+    start = (lengths - slice_len) >> 1
+    end = np.minimum(start + slice_len, lengths)
+    start = np.where(start < 0, np.maximum(start + lengths, 0), start)
+    return start, np.maximum(end, start)
+
+class ReadStore:
+    """
+    Reads of one gene as 2-bit base codes with offsets, parsed once and
+    shared by the k-mer graph, the read slices and the k-mer size estimate.
+
+    Letters other than ACGT are left out of codes like in kmer_codec, the
+    few reads that have any are also kept as text in irregular.
+    """
+    __slots__ = ('codes', 'offsets', 'lengths', 'irregular')
+
+    def __init__(self, codes, offsets, lengths, irregular):
+        self.codes = codes
+        self.offsets = offsets
+        self.lengths = lengths
+        self.irregular = irregular
+
+    @classmethod
+    def from_seqs(cls, seqs, block_size=65536):
+        """
+        Pack upper case read sequences.
+        """
+        seqs = iter(seqs)
+        code_list, offset_list, length_list = [], [np.zeros(1, dtype=np.int64)], []
+        irregular = {}
+        read_cnt = 0
+        code_cnt = 0
+
+        while block := [seq for _, seq in zip(range(block_size), seqs)]:
+            codes, offsets = kmer_codec.pack_sequences(block)
+            raw = np.frombuffer(''.join(block).encode('ascii', 'replace'), dtype=np.uint8)
+            lengths = np.fromiter(map(len, block), dtype=np.int64, count=len(block))
+
+            other_sums = np.zeros(len(raw) + 1, dtype=np.int64)
+            np.cumsum(~IS_ACGT[raw], out=other_sums[1:])
+            raw_offsets = np.append(0, np.cumsum(lengths))
+
+            for i in np.flatnonzero(other_sums[raw_offsets[1:]] != other_sums[raw_offsets[:-1]]).tolist():
+                irregular[read_cnt + i] = block[i]
+
+            code_list.append(codes)
+            offset_list.append(offsets[1:] + code_cnt)
+            length_list.append(lengths)
+            read_cnt += len(block)
+            code_cnt += len(codes)
+
+        codes = np.concatenate(code_list) if code_list else np.zeros(0, dtype=np.uint8)
+        lengths = np.concatenate(length_list) if length_list else np.zeros(0, dtype=np.int64)
+
+        return cls(codes, np.concatenate(offset_list), lengths.astype(np.int32), irregular)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @property
+    def nbytes(self):
+        return (self.codes.nbytes + self.offsets.nbytes + self.lengths.nbytes
+                + sum(len(seq) for seq in self.irregular.values()))
+
+    def first_length(self):
+        """
+        Length of the first non-empty read, 0 if there is none.
+        """
+        nonzero = np.flatnonzero(self.lengths)
+        return self.lengths.item(nonzero[0]) if len(nonzero) else 0
+
+    def read_seq(self, read):
+        if read in self.irregular:
+            return self.irregular[read]
+
+        return CODE_BASES[self.codes[self.offsets[read]:self.offsets[read + 1]]].tobytes().decode()
+
+    def middle_slices(self, slice_len, with_codes=True):
+        """
+        Distinct middle fragments of slice_len bases of the reads and of
+        their reverse complements, with the number of times each occurs.
+
+        Returns (keys, counts, codes, offsets). keys and counts cover the
+        fragments of exactly slice_len ACGT bases, sorted by kmer_codec key,
+        so each takes 12 bytes. Fragments longer than 32 bases are keyed
+        by their 64-bit hash. codes and offsets hold every distinct fragment,
+        other letters left out, or are None without with_codes.
+        """
+        lengths = self.lengths.astype(np.int64)
+        is_regular = (lengths >= slice_len) & (slice_len > 0)
+        is_regular[list(self.irregular)] = False
+
+        # Regular fragments are windows of the two-strand code array, the
+        # reverse complement of the window at s starts at 2 * len(codes) - s - slice_len
+        read_starts = self.offsets[:-1][is_regular]
+        start, end = _middle_bounds(lengths[is_regular], slice_len)
+        both = np.concatenate((self.codes, 3 - self.codes[::-1]))
+        starts = np.concatenate((read_starts + start, 2 * len(self.codes) - read_starts - lengths[is_regular] + start))
+
+        keys = kmer_codec.window_keys(both, slice_len)[starts] if len(starts) else np.zeros(0, dtype=np.uint64)
+        keys, first, counts = np.unique(keys, return_index=True, return_counts=True)
+        slice_codes = (np.lib.stride_tricks.sliding_window_view(both, slice_len)[starts[first]].ravel()
+                       if len(keys) and with_codes else np.zeros(0, dtype=np.uint8))
+
+        # Other fragments are cut from the text, like the reads dict did
+        others = Counter()
+
+        for read in np.flatnonzero(~is_regular).tolist():
+            seq = self.read_seq(read)
+
+            for text in (seq, seq.translate(REVERSE_TABLE)[::-1]):
+                start, end = _middle_bounds(np.array([len(text)]), slice_len)
+                others[text[start.item():end.item()]] += 1
+
+        regular = [text for text in others if len(text) == slice_len > 0 and not text.strip('ACGT')]
+        irregular = [text for text in others if not (len(text) == slice_len > 0 and not text.strip('ACGT'))]
+
+        if regular:
+            extra_codes, extra_offsets = kmer_codec.pack_sequences(regular)
+            extra_keys = kmer_codec.forward_kmers(extra_codes, extra_offsets, slice_len)
+            if with_codes:
+                is_new = ~np.isin(extra_keys, keys)
+                slice_codes = np.concatenate((slice_codes, extra_codes.reshape(-1, slice_len)[is_new].ravel()))
+
+            all_keys = np.concatenate((keys, extra_keys))
+            keys, inverse = np.unique(all_keys, return_inverse=True)
+            counts = np.bincount(inverse, weights=np.concatenate((counts, [others[text] for text in regular])),
+                                 minlength=len(keys))
+
+        counts = counts.astype(np.uint32)
+
+        if not with_codes:
+            return keys, counts, None, None
+
+        slice_offsets = np.arange(len(keys) + 1, dtype=np.int64) * slice_len
+
+        if irregular:
+            extra_codes, extra_offsets = kmer_codec.pack_sequences(irregular)
+            slice_codes = np.concatenate((slice_codes, extra_codes))
+            slice_offsets = np.concatenate((slice_offsets, slice_offsets[-1] + extra_offsets[1:]))
+
+        return keys, counts, slice_codes, slice_offsets
@@ -0,0 +1,163 @@
+import hashlib
+import json
+import os
+import threading
+
+# Bump MANIFEST_VERSION whenever the meaning of a record changes, older records are ignored
+MANIFEST_VERSION = 1
+
+def file_digest(path):
+    """
+    Content hash of a file, None if it does not exist.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+
+    try:
+        with open(path, 'rb') as f:
+            while chunk := f.read(1 << 20):
+                digest.update(chunk)
+    except FileNotFoundError:
+        return None
+
+    return digest.hexdigest()
+
+def same_file(stamp, current):
+    """
+    Whether two stamps are of the same file content, by hash where both
+    have one and by size and modification time otherwise.
+    """
+    if stamp is None or current is None:
+        return stamp is current
+
+    if stamp[2] is None or current[2] is None:
+        return tuple(stamp[:2]) == tuple(current[:2])
+
+    return stamp[2] == current[2]
+
+class RunManifest:
+    """
+    Append-only JSON-lines record of the finished tasks of a run, keyed by
+    (stage, sample, gene), with their parameters and the hashes of their
+    input and output files.
+
+    A task is fresh, and does not need to run again, while its parameters
+    and the hashes of its inputs and outputs all match its last record.
+    A missing file is recorded with a None hash, so a task that wrote
+    nothing stays fresh as long as the file stays missing. Hashes are
+    reused while a file keeps its size and modification time.
+
+    Files passed as quick, such as raw reads too large to read again for
+    each run, are not hashed and are only compared by size and
+    modification time.
+    """
+    __slots__ = ('path', 'entries', 'stamps', 'lock')
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.stamps = {}
+        self.lock = threading.Lock()
+
+        try:
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash
+                        continue
+
+                    if entry.get('version') != MANIFEST_VERSION:
+                        continue
+
+                    self.entries[(entry['stage'], entry['sample'], entry['gene'])] = entry
+
+                    for files in (entry['inputs'], entry['outputs']):
+                        for file_path, stamp in files.items():
+                            if stamp is not None:
+                                self.stamps[file_path] = tuple(stamp)
+        except FileNotFoundError:
+            pass
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stamp(self, path, quick=False):
+        """
+        (size, mtime_ns, hash) of a file, None if it does not exist.
+        The hash is None if quick and not already known.
+        """
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        with self.lock:
+            stamp = self.stamps.get(path)
+
+        if stamp is None or stamp[:2] != (stat.st_size, stat.st_mtime_ns) or not (quick or stamp[2]):
+            stamp = (stat.st_size, stat.st_mtime_ns, None if quick else file_digest(path))
+
+            with self.lock:
+                self.stamps[path] = stamp
+
+        return stamp
+
+    def stamp_inputs(self, paths, quick=()):
+        """
+        Stamps of the input files of a task, to be taken before it runs so
+        that a file changed while it ran does not look up to date.
+        """
+        return {path: self.stamp(path, path in quick) for path in paths}
+
+    def get(self, key):
+        """
+        Last record of a task, None if there is none.
+        """
+        with self.lock:
+            return self.entries.get(key)
+
+    def is_fresh(self, key, inputs, params):
+        """
+        Whether the task was recorded with these input files and parameters,
+        and neither its inputs nor its outputs changed since. Inputs are
+        given by their stamps from stamp_inputs.
+        """
+        entry = self.get(key)
+
+        if entry is None or entry['params'] != json.loads(json.dumps(params)):
+            return False
+
+        recorded = entry['inputs']
+
+        if recorded.keys() != inputs.keys() or not all(same_file(stamp, inputs[path]) for path, stamp in recorded.items()):
+            return False
+
+        outputs = entry['outputs']
+
+        return all(map(same_file, outputs.values(), map(self.stamp, outputs)))
+
+    def record(self, key, inputs, params, outputs, result=None):
+        """
+        Append the record of a finished task, hashing its output files.
+        Inputs are given by their stamps from stamp_inputs, taken before it ran.
+        """
+        stage, sample, gene = key
+        entry = {
+            'version': MANIFEST_VERSION,
+            'stage': stage,
+            'sample': sample,
+            'gene': gene,
+            'params': params,
+            'inputs': inputs,
+            'outputs': {path: self.stamp(path) for path in outputs},
+            'result': result
+        }
+        entry = json.loads(json.dumps(entry))
+        line = json.dumps(entry) + '\n'
+
+        with self.lock:
+            self.entries[key] = entry
+
+            with open(self.path, 'a') as f:
+                f.write(line)
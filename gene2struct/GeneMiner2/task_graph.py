@@ -0,0 +1,350 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import heapq
+import itertools
+import multiprocessing
+import os
+
+import psutil
+
+# How often a task waiting on a pool worker checks that the worker is alive
+POLL_SECONDS = 1.0
+
+class TaskKilled(Exception):
+    """
+    The process running a task was killed, e.g. by the OOM killer, the task
+    can be run again.
+    """
+
+def process_tree_rss(pid=None):
+    """
+    Resident memory of a process and all its descendants, in bytes.
+    """
+    try:
+        proc = psutil.Process(pid)
+        procs = [proc, *proc.children(recursive=True)]
+    except psutil.Error:
+        return 0
+
+    rss = 0
+
+    for proc in procs:
+        try:
+            rss += proc.memory_info().rss
+        except psutil.Error:
+            pass
+
+    return rss
+
+def _is_alive(pid):
+    try:
+        return psutil.Process(pid).status() != psutil.STATUS_ZOMBIE
+    except psutil.Error:
+        return False
+
+# Errors of a call to the manager once its process is gone
+MANAGER_ERRORS = (EOFError, OSError)
+
+# Entry of a task given up before any worker recorded it
+GIVEN_UP = 0
+
+def _run_tracked(started, token, func, args):
+    # Runs in a pool worker, records which worker took the task,
+    # unless the task was given up for lost in the meantime
+    pid = os.getpid()
+
+    try:
+        is_taken = started.setdefault(token, pid) == pid
+    except MANAGER_ERRORS as e:
+        raise TaskKilled('Task tracking was lost') from e
+
+    if not is_taken:
+        raise TaskKilled('Task was given up before it started')
+
+    return func(*args)
+
+class WorkerPool:
+    """
+    multiprocessing.Pool whose tasks record the worker running them, so a
+    task whose worker dies raises TaskKilled instead of waiting forever.
+
+    A worker may also die after taking a task but before recording it, so
+    a task not recorded yet is given up when a worker dies without a
+    recorded task. If the manager keeping the records dies, waiting tasks
+    raise TaskKilled too.
+    """
+    __slots__ = ('manager', 'started', 'pool', 'tokens', 'reaped')
+
+    def __init__(self, processes):
+        self.manager = multiprocessing.Manager()
+        self.started = self.manager.dict()
+        self.pool = multiprocessing.Pool(processes)
+        self.tokens = itertools.count()
+        # Dead workers whose task already raised TaskKilled
+        self.reaped = set()
+
+    def _live_workers(self):
+        # The pool replaces dead workers, so its list is read again each time
+        return {proc.pid for proc in list(self.pool._pool) if _is_alive(proc.pid)}
+
+    def run(self, func, *args):
+        """
+        Call func(*args) in a worker and wait for the result.
+        """
+        token = next(self.tokens)
+        workers = self._live_workers()
+        result = self.pool.apply_async(_run_tracked, (self.started, token, func, args))
+        pid = None
+
+        try:
+            while not result.ready():
+                result.wait(POLL_SECONDS)
+
+                if result.ready():
+                    break
+
+                try:
+                    if pid is None:
+                        pid = self.started.get(token)
+
+                    if pid is None:
+                        workers |= self._live_workers()
+                        lost = {worker for worker in workers if not _is_alive(worker)}
+                        lost -= self.reaped
+                        lost -= set(self.started.values())
+
+                        # Taking the entry keeps the task from starting once given up
+                        if lost and (pid := self.started.setdefault(token, GIVEN_UP)) == GIVEN_UP:
+                            raise TaskKilled(f'Worker {min(lost)} was killed before recording its task')
+                except MANAGER_ERRORS as e:
+                    raise TaskKilled('Task tracking was lost') from e
+
+                if pid is not None and not _is_alive(pid):
+                    self.reaped.add(pid)
+                    raise TaskKilled(f'Worker {pid} was killed')
+
+            return result.get()
+        finally:
+            # The entry of a task given up stays, so a worker taking it later skips it
+            if pid != GIVEN_UP:
+                try:
+                    self.started.pop(token, None)
+                except MANAGER_ERRORS:
+                    pass
+
+    def close(self):
+        """
+        Stop the workers, once every run call has returned.
+        """
+        # A task lost with a killed worker stays pending forever, join would wait for it
+        self.pool.terminate()
+        self.pool.join()
+        self.manager.shutdown()
+
+def describe(key):
+    """
+    Readable name of a (stage, sample, gene) task key.
+    """
+    return ' '.join(str(part) for part in key if part is not None)
+
+class TaskGraph:
+    """
+    Tasks keyed by (stage, sample, gene) tuples, each started on a thread
+    pool as soon as the tasks it depends on have finished.
+
+    Every running task holds some CPU tokens out of one shared budget, and
+    with a memory limit a task only starts while the projected memory stays
+    under it. Ready tasks start in order of priority, then of addition, and
+    one that does not fit holds back the ones after it. A task is skipped when one of its dependencies
+    failed, unless it was added with always, then it only waits for them.
+    A task raising TaskKilled is run again with less tasks around it.
+    """
+    __slots__ = ('funcs', 'deps', 'tokens', 'priorities', 'always', 'memory')
+
+    def __init__(self):
+        self.funcs = {}
+        self.deps = {}
+        self.tokens = {}
+        self.priorities = {}
+        self.always = {}
+        self.memory = {}
+
+    def __len__(self):
+        return len(self.funcs)
+
+    def __contains__(self, key):
+        return key in self.funcs
+
+    def add(self, key, func, deps=(), tokens=1, priority=0, always=False, memory=0):
+        """
+        Add a task calling func(), after the tasks in deps.
+
+        memory is the estimated peak memory of the task in bytes, or a
+        function returning it, called when the task is ready.
+        Dependencies must have been added before, None entries are ignored.
+        Returns key.
+        """
+        if key in self.funcs:
+            raise ValueError(f'Duplicate task {describe(key)}')
+
+        deps = [dep for dep in dict.fromkeys(deps) if dep is not None]
+
+        for dep in deps:
+            if dep not in self.funcs:
+                raise ValueError(f'Task {describe(key)} depends on unknown task {describe(dep)}')
+
+        self.funcs[key] = func
+        self.deps[key] = deps
+        self.tokens[key] = max(tokens, 1)
+        self.priorities[key] = priority
+        self.always[key] = always
+        self.memory[key] = memory
+
+        return key
+
+    def run(self, cpu_count, memory_limit=0, max_retries=2):
+        """
+        Run every task with at most cpu_count tokens in use, a task asking
+        for more gets all of them.
+
+        With a memory_limit in bytes, a task starts only if the resident
+        memory of this process and its children, or this memory at the start
+        plus the estimates of the running tasks if higher, stays under the
+        limit with the task's own estimate added. The first ready task always
+        starts when nothing else runs. Each time a task is killed, it is
+        queued again with twice its estimate, at most max_retries times, and
+        the CPU tokens are halved.
+
+        Returns the keys of the tasks that failed or were skipped.
+        """
+        cpu_count = max(cpu_count, 1)
+        cpu_limit = cpu_count
+        base_rss = process_tree_rss() if memory_limit else 0
+        estimates = {}
+        retries = {}
+        order = {key: i for i, key in enumerate(self.funcs)}
+        dependents = {key: [] for key in self.funcs}
+        waiting = {}
+        blocked = set()
+        failed = set()
+
+        for key, deps in self.deps.items():
+            waiting[key] = len(deps)
+
+            for dep in deps:
+                dependents[dep].append(key)
+
+        # Heap of (-priority, order, key)
+        ready = [(-self.priorities[key], order[key], key) for key in self.funcs if not waiting[key]]
+        heapq.heapify(ready)
+        running = {}
+        avail_cpu = cpu_count
+
+        def finish(done_key):
+            # Release the dependents of a finished task, skipping the blocked ones
+            stack = [done_key]
+
+            while stack:
+                key = stack.pop()
+
+                for dep_key in dependents[key]:
+                    if key in failed and not self.always[dep_key]:
+                        blocked.add(dep_key)
+
+                    waiting[dep_key] -= 1
+
+                    if waiting[dep_key]:
+                        continue
+
+                    if dep_key in blocked:
+                        failed.add(dep_key)
+                        stack.append(dep_key)
+                    else:
+                        heapq.heappush(ready, (-self.priorities[dep_key], order[dep_key], dep_key))
+
+        def estimate(key):
+            if key not in estimates:
+                memory = self.memory[key]
+                estimates[key] = memory() if callable(memory) else memory
+
+            return estimates[key] << retries.get(key, 0)
+
+        with ThreadPoolExecutor(max_workers=cpu_count) as executor:
+            while ready or running:
+                projected = 0
+
+                if memory_limit and ready:
+                    projected = max(process_tree_rss(), base_rss + sum(estimate(key) for key, _ in running.values()))
+
+                # Stop at the first task that does not fit, so a task asking for
+                # many tokens or much memory is not overtaken forever
+                while ready:
+                    key = ready[0][2]
+                    task_thr = min(self.tokens[key], cpu_limit)
+
+                    if task_thr > avail_cpu or (memory_limit and running and projected + estimate(key) > memory_limit):
+                        break
+
+                    heapq.heappop(ready)
+                    avail_cpu -= task_thr
+                    projected += estimate(key) if memory_limit else 0
+                    running[executor.submit(self.funcs[key])] = (key, task_thr)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    key, task_thr = running.pop(future)
+                    avail_cpu += task_thr
+
+                    try:
+                        future.result()
+                    except TaskKilled as e:
+                        if retries.get(key, 0) < max_retries:
+                            retries[key] = retries.get(key, 0) + 1
+                            avail_cpu -= cpu_limit - max(cpu_limit >> 1, 1)
+                            cpu_limit = max(cpu_limit >> 1, 1)
+                            print(f'{describe(key).capitalize()} was killed ({e}), retrying with {cpu_limit} CPUs')
+                            heapq.heappush(ready, (-self.priorities[key], order[key], key))
+                            continue
+
+                        print(f'An error occurred while processing {describe(key)}: {e}')
+                        failed.add(key)
+                    except Exception as e:
+                        print(f'An error occurred while processing {describe(key)}: {e}')
+                        failed.add(key)
+
+                    finish(key)
+
+        return failed
+
+class StageTracker:
+    """
+    The tasks a later stage has to wait for, per sample and per
+    (sample, gene) pair.
+
+    prepare holds the last set-up task of each sample, done the last task
+    covering a whole sample and genes the last task of each pair.
+    """
+    __slots__ = ('prepare', 'done', 'genes')
+
+    def __init__(self):
+        self.prepare = {}
+        self.done = {}
+        self.genes = {}
+
+    def add_prepare(self, sample, key):
+        self.prepare[sample] = key
+        return key
+
+    def add_sample(self, sample, key):
+        self.done[sample] = key
+        return key
+
+    def add_gene(self, sample, gene, key):
+        self.genes[(sample, gene)] = key
+        return key
+
+    def gene_dep(self, sample, gene):
+        """
+        Last task of the pair, or of the whole sample if the gene had none.
+        """
+        return self.genes.get((sample, gene), self.done.get(sample))
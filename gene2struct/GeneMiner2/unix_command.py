@@ -1,18 +1,29 @@
 from Bio.SeqIO.FastaIO import SimpleFastaParser
-from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from Bio.SeqIO.QualityIO import FastqGeneralIterator
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import argparse
 import csv
-import math
+import itertools
 import os
 import shlex
 import shutil
 import statistics
 import subprocess
 import sys
+import threading
+
+import psutil
 
 import gene2struct.Geneminer2.build_trimed as build_trimed
 import gene2struct.Geneminer2.fix_alignment as fix_alignment
+import gene2struct.Geneminer2.main_assembler as main_assembler
+import gene2struct.Geneminer2.main_refilter_new as main_refilter_new
 import gene2struct.Geneminer2.muscle_wrapper as muscle_wrapper
+from gene2struct.Geneminer2.consensus_caller import CIGAR_OP, Pileup
+from gene2struct.Geneminer2.kmer_index import KmerIndex
+from gene2struct.Geneminer2.run_manifest import RunManifest
+from gene2struct.Geneminer2.task_graph import StageTracker, TaskGraph, TaskKilled, WorkerPool
 
 COMMAND_HELP = '''
 filter    Reference-based filtering of raw reads
@@ -26,6 +37,13 @@ tree      Phylogenetic tree reconstruction
 
 SCRIPT_ROOT = os.path.join(sys._MEIPASS, os.pardir) if hasattr(sys, '_MEIPASS') else os.path.dirname(__file__)
 
+# Peak assembler memory per gene, estimated from the size of its filtered reads
+# Measured between 85 and 570 bytes per read file byte, depending on depth and errors
+ASSEMBLY_BASE_MEMORY = 64 << 20
+ASSEMBLY_MEMORY_PER_BYTE = 256
+
+COMPLEMENT_TABLE = str.maketrans('ACGTNacgtn', 'TGCANtgcan')
+
 def find_executable(prog, internal=False):
     bin_path = os.path.join(SCRIPT_ROOT, prog)
 
@@ -55,10 +73,21 @@ def get_ref_genes(ref_dir):
 
     return genes
 
+def list_files(path):
+    """
+    All files under a directory, sorted.
+    """
+    return sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+
+def remove_files(*paths):
+    for path in paths:
+        if os.path.isfile(path):
+            os.remove(path)
+
 def get_sample_ext(data_path):
     data_name, data_ext = os.path.splitext(data_path)
 
-    if data_ext == '.gz':
+    if data_ext in main_refilter_new.COMPRESSED_EXTENSIONS:
         data_name, data_ext = os.path.splitext(data_name)
 
     if data_ext == '.fq' or data_ext == '.fastq':
@@ -117,57 +146,73 @@ def prepare_workdir(args):
 
     return samples
 
-def do_filter_assemble(args, samples, do_filter, do_assemble, ignore_hook=lambda *_, **__: None):
+def add_filter_assemble_tasks(graph, args, samples, do_filter, do_assemble, stages, manifest):
+    """
+    One filter task per sample and one assembly task per (sample, gene).
+
+    Returns the assembler worker pool, None when assembling in this process.
+    """
     out_loc = args.o.strip()
-    kmer_dict_path = os.path.join(out_loc, f'kmer_dict_k{args.kf}.dict')
+    kmer_index_path = os.path.join(out_loc, f'kmer_index_k{args.kf}.idx')
 
     if do_filter:
-        # filter_bin = find_executable('MainFilterNew', internal=True)
-        # if os.path.isfile(kmer_dict_path):
-        #     os.remove(kmer_dict_path)
-        #
-        # try:
-        #     subprocess.run([sys.executable, filter_script, '-r', args.r, '-o', out_loc, '-kf', str(args.kf), '-s', str(args.step_size),
-        #                     '-gr', '-lkd', kmer_dict_path, '-m', '2'], check=True)
-        # except subprocess.SubprocessError as e:
-        #     raise RuntimeError(f"Unable to build k-mer dictionary: {e}")
+        # Build the reference k-mer index once, every filter run maps the same file
+        # It is rebuilt only when the references or the k-mer size change
+        try:
+            gene_names, ref_sets, _ = main_refilter_new.load_references(main_refilter_new.get_ref_dict(args.r), args.kf)
+            KmerIndex.cached(kmer_index_path, gene_names, ref_sets, main_refilter_new.run_length_kmer_size(args.kf))
+        except (OSError, ValueError) as e:
+            raise RuntimeError(f"Unable to build k-mer index: {e}")
 
         filter_script = os.path.join(os.path.dirname(__file__), 'main_refilter_new.py')
+        ref_files = sorted(os.path.join(args.r, name + ext) for name, ext in get_ref_genes(args.r))
+        filter_params = {'kf': args.kf, 'min_depth': args.min_depth, 'max_depth': args.max_depth,
+                         'max_size': args.max_size, 'max_reads': args.max_reads}
+
         def run_filter(name):
             q1, q2 = samples[name]
             # read_count_path = os.path.join(out_loc, name, 'ref_reads_count_dict.txt')   ####
             out_dir = os.path.join(out_loc, name, 'filtered')
-            temp_dir = os.path.join(out_loc, name, 'temp_reads')
-            os.makedirs(temp_dir, exist_ok=True)
-
-            # if os.path.isfile(read_count_path):   ####
-            #     os.remove(read_count_path)    #####
-
-            temp_q1 = os.path.join(temp_dir, os.path.basename(q1))
-            shutil.copy2(q1, temp_q1)
 
             try:
                 is_single = os.path.samefile(q1, q2)
             except FileNotFoundError:
                 is_single = (os.path.abspath(q1) == os.path.abspath(q2))
 
-            if not is_single:
-                temp_q2 = os.path.join(temp_dir, os.path.basename(q2))
-                shutil.copy2(q2, temp_q2)
+            # The filter runs again only if the reads, the references or the parameters changed
+            # Raw reads are compared by size and modification time rather than read in full
+            reads = [q1, *(() if is_single else (q2, ))]
+            inputs = manifest.stamp_inputs(reads + ref_files, quick=reads)
+            if manifest.is_fresh(('filter', name, None), inputs, filter_params):
+                return
+
+            # Files of the previous run would otherwise be taken for outputs of this one
+            if entry := manifest.get(('filter', name, None)):
+                remove_files(*entry['outputs'])
 
             params = [sys.executable, filter_script,
-                      '-qs' if is_single else '-qd', temp_dir,
+                      '-qf', *((q1, ) if is_single else (q1, q2)),
+                      '--sample-name', name,
                       '-r', args.r,
                       '-o', out_dir,
                       '--log-file', os.path.join(out_loc, name, 'log.txt'),
                       '--min-depth', str(args.min_depth),
                       '--max-depth', str(args.max_depth),
                       '--max-size', str(args.max_size),
+                      '--max-reads', str(args.max_reads),
                       '-kf', str(args.kf),
+                      '--kmer-index', kmer_index_path,
                       '-p', str(args.p)]
 
 
-            subprocess.run(params, check=True)
+            try:
+                subprocess.run(params, check=True)
+            except subprocess.CalledProcessError as e:
+                if e.returncode < 0:
+                    raise TaskKilled(f'signal {-e.returncode}') from e
+                raise
+
+            manifest.record(('filter', name, None), inputs, filter_params, list_files(out_dir))
 
 
             # if not os.path.isfile(read_count_path):   #####
@@ -203,8 +248,9 @@ def do_filter_assemble(args, samples, do_filter, do_assemble, ignore_hook=lambda
             #             with open(read_2, 'rb') as r:
             #                 shutil.copyfileobj(r, f)
 
-    else:
-        run_filter = ignore_hook
+        for name in samples.keys():
+            stages.add_sample(name, graph.add(('filter', name, None), partial(run_filter, name),
+                                              tokens=1 if args.p < 4 else 2))
 
     # if do_refilter:
     #     refilter_bin = find_executable('main_refilter_new', internal=True)
@@ -229,195 +275,303 @@ def do_filter_assemble(args, samples, do_filter, do_assemble, ignore_hook=lambda
     # else:
     #     run_refilter = ignore_hook
 
-    if do_assemble:
-        # assembler_bin = find_executable('main_assembler', internal=True)
-        assemble_script = os.path.join(os.path.dirname(__file__), 'main_assembler.py')
-
-        def run_assembler(name, thr=1):
-            in_dir = os.path.join(out_loc, name, 'filtered')
-            out_dir = os.path.join(out_loc, name, 'results')
-            result_path = os.path.join(out_loc, name, 'result_dict.txt')
+    if not do_assemble:
+        return None
 
-            if not os.path.isdir(in_dir):
-                raise RuntimeError('No successful filter run, cannot assemble')
+    # Reference k-mer tables depend only on the reference and k, all samples share them
+    # The assembler runs in this process, references are loaded once before the
+    # worker pool forks and every (sample, gene) pair is a task of that pool
+    # With -ka 0 the k-mer size is picked per gene, the tables of each size are
+    # then built once into the cache directory and memory-mapped by the workers
+    ref_kmer_cache_dir = os.path.join(out_loc, 'ref_kmer_cache')
+    asm_refs = main_assembler.Load_References(args.r, args.ka, ref_kmer_cache_dir)
+    asm_pool = WorkerPool(args.p) if args.p > 1 else None
 
-            soft_boundary = '0'
+    soft_boundary = '0'
 
-            if args.soft_boundary == 'auto':
-                soft_boundary = '-1'
-            elif args.soft_boundary == 'unlimited':
-                soft_boundary = '10000'
+    if args.soft_boundary == 'auto':
+        soft_boundary = '-1'
+    elif args.soft_boundary == 'unlimited':
+        soft_boundary = '10000'
 
-            if os.path.isdir(out_dir):
-                shutil.rmtree(out_dir, ignore_errors=True)
+    asm_args, asm_tasks, asm_results, asm_starts = {}, {}, {}, {}
 
-            params = [sys.executable, assemble_script,
-                      '-r', args.r, '-o', os.path.join(out_loc, name), '-ka', str(args.ka),
-                      '-k_min', str(args.min_ka), '-k_max', str(args.max_ka), '-limit_count', str(args.error_threshold),
-                      '-iteration', str(args.iteration), '-sb', soft_boundary, '-p', str(thr)]
+    # Genes whose reads, reference and parameters did not change keep their results
+    asm_params = {'ka': args.ka, 'min_ka': args.min_ka, 'max_ka': args.max_ka, 'ka_step': args.ka_step,
+                  'error_threshold': args.error_threshold, 'iteration': args.iteration, 'soft_boundary': soft_boundary}
 
-            subprocess.run(params)
+    def prepare_assembler(name):
+        in_dir = os.path.join(out_loc, name, 'filtered')
 
-            if not os.path.isfile(result_path):
-                raise RuntimeError('Assembly failed')
-
-    else:
-        run_assembler = ignore_hook
+        if not os.path.isdir(in_dir):
+            raise RuntimeError('No successful filter run, cannot assemble')
 
-    if args.p > 1:
-        avail_cpu = args.p
-        asm_thr   = max(min(args.p // 2, 6), 2)
-        filt_thr  = 1 if args.p < 4 else 2
-
-        def calc_task_thr():
-            min_thr = min(asm_thr, filt_thr) if filter_list else asm_thr
-            return avail_cpu if avail_cpu - asm_thr < min_thr else asm_thr
-
-        filter_list   = []
-        # refilter_list = []
-        assemble_list = []
-
-        executor      = ThreadPoolExecutor(max_workers=math.ceil(avail_cpu / filt_thr))
-        running_tasks = {}
-        task_metadata = {} # (stage, threads)
-
-        if do_filter:
-            filter_list.extend(reversed(samples.keys()))
-        # elif do_refilter:
-        #     refilter_list.extend(reversed(samples.keys()))
-        elif do_assemble:
-            assemble_list.extend(reversed(samples.keys()))
-
-        while True:
-            # while refilter_list and avail_cpu >= asm_thr:
-            #     sample = refilter_list.pop()
-            #     task_thr = calc_task_thr()
-            #     avail_cpu -= task_thr
-            #     running_tasks[sample] = executor.submit(run_refilter, sample, thr=task_thr)
-            #     task_metadata[sample] = (2, task_thr)
-
-            while assemble_list and avail_cpu >= asm_thr:
-                sample = assemble_list.pop()
-                task_thr = calc_task_thr()
-                avail_cpu -= task_thr
-                running_tasks[sample] = executor.submit(run_assembler, sample, thr=task_thr)
-                task_metadata[sample] = (3, task_thr)
-
-            while filter_list and avail_cpu >= filt_thr:
-                sample = filter_list.pop()
-                avail_cpu -= filt_thr
-                running_tasks[sample] = executor.submit(run_filter, sample)
-                task_metadata[sample] = (1, filt_thr)
-
-            if not running_tasks:
-                break
-
-            wait(running_tasks.values(), return_when=FIRST_COMPLETED)
-
-            processed_samples = set()
-
-            for sample, task in running_tasks.items():
-                if not task.done():
-                    continue
+        asm_starts[name] = main_assembler.Prepare_Sample(asm_args[name])
 
-                processed_samples.add(sample)
+    def assemble_gene(name, gene_idx):
+        task = asm_tasks[name][gene_idx]
+        gene = task[1]
+        key = ('assemble', name, gene)
+        inputs = manifest.stamp_inputs([os.path.join(out_loc, name, 'filtered', gene + ext) for ext in ('.fasta', '.fq')] + [task[2]])
+        outputs = [os.path.join(out_loc, name, out_name, gene + '.fasta') for out_name in ('results', 'contigs_all')]
 
-                stage, thr_cnt = task_metadata[sample]
-                avail_cpu += thr_cnt
+        if manifest.is_fresh(key, inputs, asm_params):
+            asm_results[name][gene_idx] = tuple(manifest.get(key)['result'])
+            return
 
-                try:
-                    task.result()
-                except Exception as e:
-                    print(f'An error occurred while processing {sample}: {e}')
-                    continue
+        # The assembler skips genes that already have a result file, even an empty one left by a crash
+        remove_files(*outputs)
 
-                # if stage == 1:
-                #     if do_refilter:
-                #         refilter_list.append(sample)
-                #     elif do_assemble:
-                #         assemble_list.append(sample)
-                # elif stage == 2 and do_assemble:
-                #     assemble_list.append(sample)
+        try:
+            if asm_pool is None:
+                asm_results[name][gene_idx] = main_assembler.process_key_value(*task)
+            else:
+                asm_results[name][gene_idx] = asm_pool.run(main_assembler.process_key_value, *task)
+        except TaskKilled:
+            remove_files(*outputs)
+            raise
+        except Exception as e:
+            main_assembler.Write_Print(os.path.join(out_loc, name, 'log.txt'), 'error:', gene, e)
+            return
 
-                if stage == 1 and do_assemble:
-                    assemble_list.append(sample)
+        manifest.record(key, inputs, asm_params, outputs, asm_results[name][gene_idx])
 
-            for sample in processed_samples:
-                del running_tasks[sample]
-                del task_metadata[sample]
+    def estimate_memory(name, gene):
+        read_size = sum(os.path.getsize(path) for path in (os.path.join(out_loc, name, 'filtered', gene + ext)
+                                                           for ext in ('.fasta', '.fq'))
+                        if os.path.isfile(path))
+        return ASSEMBLY_BASE_MEMORY + ASSEMBLY_MEMORY_PER_BYTE * read_size
 
-        executor.shutdown()
+    def finish_assembler(name):
+        main_assembler.Write_Results(asm_args[name], [result for result in asm_results[name] if result is not None], asm_starts[name])
 
-    else:
-        for name in samples.keys():
-            try:
-                if do_filter:
-                    run_filter(name)
-                if do_assemble:
-                    run_assembler(name)
-            except Exception as e:
-                print(f'An error occurred while processing {name}: {e}')
-                continue
+        if not os.path.isfile(os.path.join(out_loc, name, 'result_dict.txt')):
+            raise RuntimeError('Assembly failed')
 
-def generate_consensus(args, samples):
+    for name in samples.keys():
+        params = ['-r', args.r, '-o', os.path.join(out_loc, name), '-ka', str(args.ka),
+                  '-k_min', str(args.min_ka), '-k_max', str(args.max_ka), '-limit_count', str(args.error_threshold),
+                  '-iteration', str(args.iteration), '-sb', soft_boundary,
+                  '-k_step', str(args.ka_step), '-kmer_cache', ref_kmer_cache_dir]
+
+        asm_args[name] = main_assembler.Make_Parser().parse_args(params)
+        asm_tasks[name] = main_assembler.Gene_Tasks(asm_args[name], asm_refs)
+        asm_results[name] = [None] * len(asm_tasks[name])
+
+        prep_key = stages.add_prepare(name, graph.add(('assemble', name, None), partial(prepare_assembler, name),
+                                                      deps=(stages.prepare.get(name), stages.done.get(name)), priority=1))
+        gene_keys = [stages.add_gene(name, task[1], graph.add(('assemble', name, task[1]), partial(assemble_gene, name, gene_idx),
+                                                                deps=(prep_key, ), priority=1, memory=partial(estimate_memory, name, task[1])))
+                     for gene_idx, task in enumerate(asm_tasks[name])]
+
+        stages.add_sample(name, graph.add(('assemble results', name, None), partial(finish_assembler, name),
+                                          deps=gene_keys, priority=1))
+
+    return asm_pool
+
+def add_consensus_tasks(graph, args, samples, stages, manifest):
+    """
+    One consensus task per sample, started once all its genes are assembled.
+
+    The reads of every gene go through one minimap2 run against the contigs
+    of all genes, its SAM output is split by gene and piled up in this
+    process, so no SAM file is written.
+    """
     out_loc = args.o.strip()
 
-    consensus_bin = find_executable('build_consensus', internal=True)
     minimap2_bin = find_executable('minimap2')
 
     if args.consensus_threshold <= 0 or args.consensus_threshold > 1:
         raise RuntimeError(f"Invalid consensus threshold {args.consensus_threshold} (must be between 0.0 and 1.0)")
 
-    genes = get_ref_genes(args.r)
+    genes = sorted(get_ref_genes(args.r))
+    cns_params = {'consensus_threshold': args.consensus_threshold, 'caller': 'pileup'}
+    cns_threads = min(max(args.p, 1), 4)
 
-    def iterate_gene(sample):
+    def prepare_sample(sample):
         in_dir = os.path.join(out_loc, sample, 'results')
 
         if not os.path.isdir(in_dir):
-            print(f'Error: Sample {sample} has no assembled genes, cannot generate consensus')
-            return
+            raise RuntimeError(f'Sample {sample} has no assembled genes, cannot generate consensus')
 
-        cns_dir  = os.path.join(out_loc, sample, 'consensus')
-        filt_dir = os.path.join(out_loc, sample, 'filtered')
+        os.makedirs(os.path.join(out_loc, sample, 'consensus'), exist_ok=True)
 
-        if os.path.isdir(cns_dir):
-            shutil.rmtree(cns_dir, ignore_errors=True)
+    def process_sample(sample):
+        read_ext = get_sample_ext(samples[sample][0])
+        stale = []
 
-        os.makedirs(cns_dir, exist_ok=True)
+        for name, _ in genes:
+            asm_path = os.path.join(out_loc, sample, 'results', name + '.fasta')
+            read_path = os.path.join(out_loc, sample, 'filtered', name + read_ext)
+            out_path = os.path.join(out_loc, sample, 'consensus', name + '.fasta')
 
-        for name, ext in genes:
-            asm_path = os.path.join(in_dir, name + ext)
-            read_path = os.path.join(filt_dir, name + get_sample_ext(samples[sample][0]))
+            inputs = manifest.stamp_inputs((asm_path, read_path))
+
+            if manifest.is_fresh(('consensus', sample, name), inputs, cns_params):
+                continue
 
-            if os.path.isfile(asm_path) and os.path.isfile(read_path):
-                sam_path = os.path.join(cns_dir, name + '.sam')
-                yield (name, asm_path, read_path, sam_path)
+            remove_files(out_path)
+            stale.append((name, asm_path, read_path, out_path, inputs))
 
-    def process_gene(task):
-        gene, asm_path, read_path, sam_path = task
+        mapped = [(name, asm_path, read_path) for name, asm_path, read_path, _, _ in stale
+                  if os.path.isfile(asm_path) and os.path.isfile(read_path)]
 
-        subprocess.run([minimap2_bin, '-ax', 'sr', '-t', '1', '--sam-hit-only',
-                        '-o', sam_path, asm_path, read_path])
+        if mapped:
+            map_sample(os.path.join(out_loc, sample, 'consensus'), mapped, read_ext == '.fq')
 
-        if os.path.isfile(sam_path):
-            subprocess.run([consensus_bin, '-i', sam_path, '-c', str(args.consensus_threshold),
-                            '-o', os.path.dirname(sam_path), '-s', '0'])
+        for name, _, _, out_path, inputs in stale:
+            manifest.record(('consensus', sample, name), inputs, cns_params, (out_path, ))
 
-            os.remove(sam_path)
+    def map_sample(out_dir, mapped, is_fastq):
+        # Contigs are renamed '<gene index>_<name>' and reads '<gene index>_<read number>_<name>'
+        # to tell the genes, and mates with the same name, apart in the SAM output
+        ref_path = os.path.join(out_dir, '_references.fa')
+        contigs = []
 
-    if args.p > 1:
-        with ThreadPoolExecutor(max_workers=args.p) as executor:
-            for _ in executor.map(process_gene, (task
-                                                for sample in samples.keys()
-                                                for task in iterate_gene(sample))):
+        with open(ref_path, 'w') as f:
+            for gene_idx, (_, asm_path, _) in enumerate(mapped):
+                with open(asm_path) as asm:
+                    contigs.append(list(SimpleFastaParser(asm)))
+
+                for title, seq in contigs[-1]:
+                    f.write(f'>{gene_idx}_{title}\n{seq}\n')
+
+        try:
+            # Hits to the contigs of other genes must not hide the hits of a read to its own gene
+            proc = subprocess.Popen([minimap2_bin, '-ax', 'sr', '-t', str(cns_threads), '--sam-hit-only',
+                                     '--secondary=yes', '-N', '50', '-p', '0', ref_path, '-'],
+                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+            errors = []
+            feeder = threading.Thread(target=feed_reads,
+                                      args=(proc.stdin, [read_path for _, _, read_path in mapped], is_fastq, errors))
+            feeder.start()
+
+            try:
+                split_records(proc.stdout, out_dir, [name for name, _, _ in mapped], contigs)
+            finally:
+                # minimap2 and the feeder stop on the broken pipe if the records were not all read
+                proc.stdout.close()
+                feeder.join()
+                proc.wait()
+        finally:
+            remove_files(ref_path)
+
+        if errors:
+            raise errors[0]
+
+        if proc.returncode:
+            raise RuntimeError(f'minimap2 exited with code {proc.returncode}')
+
+    def feed_reads(pipe, read_paths, is_fastq, errors):
+        read_no = itertools.count()
+
+        try:
+            for gene_idx, read_path in enumerate(read_paths):
+                with open(read_path) as f:
+                    if is_fastq:
+                        for title, seq, qual in FastqGeneralIterator(f):
+                            pipe.write(f'@{gene_idx}_{next(read_no)}_{title}\n{seq}\n+\n{qual}\n')
+                    else:
+                        for title, seq in SimpleFastaParser(f):
+                            pipe.write(f'>{gene_idx}_{next(read_no)}_{title}\n{seq}\n')
+        except BrokenPipeError:
+            pass
+        except Exception as e:
+            errors.append(e)
+        finally:
+            try:
+                pipe.close()
+            except BrokenPipeError:
                 pass
 
-    else:
-        for sample in samples.keys():
-            for task in iterate_gene(sample):
-                process_gene(task)
+    def promote_secondary(primary, own):
+        # minimap2 leaves the sequence out of secondary records, it is taken from the primary one
+        best = max((fields for fields in own if int(fields[1]) & 0x100), key=alignment_score, default=None)
+
+        if best is None:
+            return
 
-def blast_trim(args, samples):
+        flag = int(best[1]) & ~0x100
+        seq, qual = primary[9], primary[10]
+
+        if (int(primary[1]) ^ flag) & 0x10:
+            seq, qual = seq.translate(COMPLEMENT_TABLE)[::-1], qual[::-1]
+
+        # Hard clipped records cannot get their sequence back
+        if sum(int(size) for size, op in CIGAR_OP.findall(best[5]) if op in 'MIS=X') != len(seq):
+            return
+
+        best[1], best[9], best[10] = str(flag), seq, qual
+
+    def alignment_score(fields):
+        return next((int(tag[5:]) for tag in fields[11:] if tag.startswith('AS:i:')), 0)
+
+    def split_records(stream, out_dir, names, contigs):
+        def own_records():
+            # Each read keeps its alignments to the contigs of its own gene, as if
+            # each gene had been mapped on its own. When the best hit of a read is on
+            # another gene, its best hit on its own gene becomes the primary one
+            records = (line.rstrip('\n').split('\t') for line in stream if not line.startswith('@'))
+
+            for _, read_records in itertools.groupby(records, key=lambda fields: fields[0]):
+                read_records = [fields for fields in read_records if len(fields) >= 11 and fields[2] != '*']
+
+                if not read_records:
+                    continue
+
+                read_idx = read_records[0][0].split('_', 1)[0]
+                own = [fields for fields in read_records if fields[2].split('_', 1)[0] == read_idx]
+                primary = next((fields for fields in read_records if not int(fields[1]) & 0x900), None)
+
+                if not own:
+                    continue
+
+                if primary is not None and all(fields is not primary for fields in own):
+                    promote_secondary(primary, own)
+
+                for fields in own:
+                    fields[0] = fields[0].split('_', 2)[2]
+                    fields[2] = fields[2].split('_', 1)[1]
+
+                    if fields[6] not in ('*', '='):
+                        fields[6] = fields[6].split('_', 1)[1]
+
+                    yield int(read_idx), '\t'.join(fields) + '\n'
+
+        # minimap2 writes the records in the order of the reads, grouped by gene
+        groups = itertools.groupby(own_records(), key=lambda record: record[0])
+        group = next(groups, None)
+
+        for gene_idx, name in enumerate(names):
+            while group is not None and group[0] < gene_idx:
+                group = next(groups, None)
+
+            records = ()
+
+            if group is not None and group[0] == gene_idx:
+                records = (line for _, line in group[1])
+
+            pileup = Pileup.from_records(contigs[gene_idx], records)
+
+            with open(os.path.join(out_dir, name + '.fasta'), 'w') as f:
+                for title, seq in pileup.consensus(args.consensus_threshold):
+                    if seq:
+                        f.write(f'>{title}\n{seq}\n')
+
+    for sample in samples.keys():
+        prep_key = stages.add_prepare(sample, graph.add(('consensus', sample, None), partial(prepare_sample, sample),
+                                                        deps=(stages.prepare.get(sample), ), priority=2))
+        sample_key = stages.add_sample(sample, graph.add(('consensus mapping', sample, None), partial(process_sample, sample),
+                                                         deps=(prep_key, *(stages.gene_dep(sample, name) for name, _ in genes)),
+                                                         tokens=cns_threads, priority=2))
+
+        for name, _ in genes:
+            stages.add_gene(sample, name, sample_key)
+
+def add_trim_tasks(graph, args, samples, stages, manifest):
+    """
+    One BLAST database task per gene and one trim task per (sample, gene).
+    """
     out_loc = args.o.strip()
 
     makeblastdb_bin = find_executable('makeblastdb')
@@ -439,77 +593,69 @@ def blast_trim(args, samples):
     else:
         criterion = 'all'
 
-    genes = get_ref_genes(args.r)
+    genes = sorted(get_ref_genes(args.r))
+    in_name = 'consensus' if args.trim_source == 'consensus' else 'results'
+    trim_params = {'trim_source': in_name, 'trim_mode': args.trim_mode, 'trim_retention': args.trim_retention}
 
     os.makedirs(os.path.join(out_loc, 'blast_db'), exist_ok=True)
 
-    def build_blast_db(name_tup):
-        name, ext = name_tup
+    def build_blast_db(name, ext):
         subprocess.run([makeblastdb_bin, "-in", f'"{os.path.realpath(os.path.join(args.r, name + ext))}"',
                         "-dbtype", "nucl", "-out", name],
                        cwd=os.path.join(out_loc, 'blast_db'))
 
-    def iterate_gene(sample):
-        if args.trim_source == 'consensus':
-            in_dir = os.path.join(out_loc, sample, 'consensus')
-        else:
-            in_dir = os.path.join(out_loc, sample, 'results')
+    def prepare_sample(sample):
+        if not os.path.isdir(os.path.join(out_loc, sample, in_name)):
+            raise RuntimeError(f'Sample {sample} has no {args.trim_source} sequences, cannot trim')
 
-        if not os.path.isdir(in_dir):
-            print(f'Error: Sample {sample} has no {args.trim_source} sequences, cannot trim')
-            return
+        os.makedirs(os.path.join(out_loc, sample, 'blast'), exist_ok=True)
 
-        blast_dir = os.path.join(out_loc, sample, 'blast')
+    gene_count = len(genes) * len(samples)
+    trimmed_count = itertools.count(1)
 
-        if os.path.isdir(blast_dir):
-            shutil.rmtree(blast_dir, ignore_errors=True)
+    def process_gene(sample, name, ext):
+        asm_path = os.path.join(out_loc, sample, in_name, name + '.fasta')
+        ref_path = os.path.join(args.r, name + ext)
+        out_path = os.path.join(out_loc, sample, 'blast', name + '.fasta')
+        key = ('trim', sample, name)
+        inputs = manifest.stamp_inputs((asm_path, ref_path))
 
-        os.makedirs(blast_dir, exist_ok=True)
+        if manifest.is_fresh(key, inputs, trim_params):
+            return
 
-        for name, ext in genes:
-            asm_path = os.path.join(in_dir, name + '.fasta')
-            ref_path = os.path.join(args.r, name + ext)
+        remove_files(out_path)
 
-            if os.path.isfile(asm_path):
-                yield (name, asm_path, ref_path, os.path.join(blast_dir, name + '.fasta'))
+        if not os.path.isfile(asm_path):
+            manifest.record(key, inputs, trim_params, (out_path, ))
+            return
 
-    def process_gene(task):
-        name, asm_path, ref_path, out_path = task
         blast_output = blast_iter(asm_path, os.path.join(out_loc, 'blast_db', name), executable_path=blast_bin)
         build_trimed.process_file(asm_path, ref_path, blast_output, out_path, args.trim_retention * 100, criterion)
+        manifest.record(key, inputs, trim_params, (out_path, ))
 
-    gene_count = len(genes) * len(samples)
-    trimmed_count = 0
+        count = next(trimmed_count)
 
-    if args.p > 1:
-        with ThreadPoolExecutor(max_workers=args.p) as executor:
-            for _ in executor.map(build_blast_db, genes):
-                pass
+        if count >= 2:
+            print(f'{count}/{gene_count} genes trimmed\r', end='')
 
-            for _ in executor.map(process_gene, (task
-                                                for sample in samples.keys()
-                                                for task in iterate_gene(sample))):
-                trimmed_count += 1
+    db_keys = {name: graph.add(('blast_db', None, name), partial(build_blast_db, name, ext), priority=3)
+               for name, ext in genes}
 
-                if trimmed_count >= 2:
-                    print(f'{trimmed_count}/{gene_count} genes trimmed\r', end='')
+    for sample in samples.keys():
+        prep_key = stages.add_prepare(sample, graph.add(('trim', sample, None), partial(prepare_sample, sample),
+                                                        deps=(stages.prepare.get(sample), ), priority=3))
 
-    else:
-        for gene_tup in genes:
-            build_blast_db(gene_tup)
-
-        for sample in samples.keys():
-            for task in iterate_gene(sample):
-                process_gene(task)
-
-                trimmed_count += 1
-
-                if trimmed_count >= 2:
-                    print(f'{trimmed_count}/{gene_count} genes trimmed\r', end='')
+        for name, ext in genes:
+            stages.add_gene(sample, name, graph.add(('trim', sample, name), partial(process_gene, sample, name, ext),
+                                                    deps=(prep_key, db_keys[name], stages.gene_dep(sample, name)), priority=3))
 
-    print('\n')
+def add_combine_tasks(graph, args, samples, stages):
+    """
+    One combine task per gene, started as soon as every sample is done with
+    the gene, then the concatenation of all genes.
 
-def combine_genes(args, samples):
+    Returns the key of the concatenation task.
+    """
     out_loc = args.o.strip()
 
     if not args.no_alignment:
@@ -555,7 +701,7 @@ def combine_genes(args, samples):
     else:
         in_name = 'results'
 
-    genes = {t[0] for t in get_ref_genes(args.r)}
+    genes = sorted({t[0] for t in get_ref_genes(args.r)})
 
     def merge_gene(gene):
         out_path = os.path.join(combine_dir, gene + '.fasta')
@@ -609,54 +755,42 @@ def combine_genes(args, samples):
         if os.path.isfile(in_path):
             subprocess.run([trimal_bin, '-in', in_path, '-out', out_path, '-automated1'])
 
-    alignment_count = 0
     gene_count = len(genes)
+    alignment_count = itertools.count(1)
 
-    if args.p > 1:
-        with ThreadPoolExecutor(max_workers=args.p) as executor:
-            for _ in executor.map(merge_gene, genes):
-                pass
-
-            if not args.no_alignment:
-                for _ in executor.map(align_gene, genes):
-                    alignment_count += 1
+    def process_gene(gene):
+        merge_gene(gene)
 
-                    if alignment_count >= 2:
-                        print(f'{alignment_count}/{gene_count} genes aligned\r', end='')
+        if not args.no_alignment:
+            align_gene(gene)
 
-                for _ in executor.map(clean_gene, genes):
-                    pass
+            count = next(alignment_count)
 
-                if not args.no_trimal:
-                    for _ in executor.map(trim_gene, genes):
-                        pass
+            if count >= 2:
+                print(f'{count}/{gene_count} genes aligned\r', end='')
 
-    else:
-        for gene in genes:
-            merge_gene(gene)
+            clean_gene(gene)
 
-            if not args.no_alignment:
-                align_gene(gene)
+            if not args.no_trimal:
+                trim_gene(gene)
 
-                alignment_count += 1
+    def concatenate_genes():
+        print('\n')
 
-                if alignment_count >= 2:
-                    print(f'{alignment_count}/{gene_count} genes aligned\r', end='')
+        if not args.no_alignment:
+            subprocess.run([sys.executable, merge_seq_bin, '-input', alignment_dir, '-exts', '.fasta', '-missing', '-',
+                            '-output', os.path.join(out_loc, 'combined_results.fasta')])
 
-                clean_gene(gene)
+            if not args.no_trimal:
+                subprocess.run([sys.executable, merge_seq_bin, '-input', trim_dir, '-exts', '.fasta', '-missing', '-',
+                                '-output', os.path.join(out_loc, 'combined_trimed.fasta')])
 
-                if not args.no_trimal:
-                    trim_gene(gene)
+    # A failed sample leaves its sequence out, it does not hold back the gene
+    gene_keys = [graph.add(('combine', None, gene), partial(process_gene, gene),
+                           deps=[stages.gene_dep(sample, gene) for sample in samples.keys()], priority=4, always=True)
+                 for gene in genes]
 
-    print('\n')
-
-    if not args.no_alignment:
-        subprocess.run([sys.executable, merge_seq_bin, '-input', alignment_dir, '-exts', '.fasta', '-missing', '-',
-                        '-output', os.path.join(out_loc, 'combined_results.fasta')])
-
-        if not args.no_trimal:
-            subprocess.run([sys.executable, merge_seq_bin, '-input', trim_dir, '-exts', '.fasta', '-missing', '-',
-                            '-output', os.path.join(out_loc, 'combined_trimed.fasta')])
+    return graph.add(('combine', None, None), concatenate_genes, deps=gene_keys, priority=4, always=True)
 
 def build_single_tree(prog_name, prog_bin, in_path, bootstrap=0, quiet=False, threads=1):
     if prog_name == 'raxmlng':
@@ -852,18 +986,27 @@ def execute_tasks(args, samples):
     do_combine = 'combine' in commands
     do_tree = 'tree' in commands
 
+    # Every stage adds its (stage, sample, gene) tasks to one graph, a gene moves
+    # on to the next stage as soon as its own previous stage is done
+    graph = TaskGraph()
+    stages = StageTracker()
+    # Finished (stage, sample, gene) tasks with the hashes of their files, reruns skip the fresh ones
+    manifest = RunManifest(os.path.join(args.o.strip(), 'manifest.jsonl'))
+    asm_pool = None
+    tree_deps = ()
+
     try:
         if do_filter  or do_assemble:
-            do_filter_assemble(args, samples, do_filter, do_assemble)
+            asm_pool = add_filter_assemble_tasks(graph, args, samples, do_filter, do_assemble, stages, manifest)
 
         if do_consensus:
-            generate_consensus(args, samples)
+            add_consensus_tasks(graph, args, samples, stages, manifest)
 
         if do_trim:
             if not args.trim_source:
                 args.trim_source = 'consensus' if do_consensus else 'assembly'
 
-            blast_trim(args, samples)
+            add_trim_tasks(graph, args, samples, stages, manifest)
 
         if do_combine:
             if not args.combine_source:
@@ -874,18 +1017,27 @@ def execute_tasks(args, samples):
                 else:
                     args.combine_source = 'assembly'
 
-            combine_genes(args, samples)
+            tree_deps = (add_combine_tasks(graph, args, samples, stages), )
 
         if do_tree:
             if args.tree_method == 'coalescent':
-                build_coalescent_tree(args)
+                build_tree = partial(build_coalescent_tree, args)
             else:
-                build_concatenation_tree(args)
+                build_tree = partial(build_concatenation_tree, args)
+
+            graph.add(('tree', None, None), build_tree, deps=tree_deps, tokens=args.p, priority=5)
+
+        memory_limit = int(args.max_memory * (1 << 30)) if args.max_memory > 0 else int(psutil.virtual_memory().total * 0.9)
+        graph.run(args.p, memory_limit)
 
     except RuntimeError as e:
         print(f'Error: {e}')
         return
 
+    finally:
+        if asm_pool is not None:
+            asm_pool.close()
+
 
 def cli(argv=None):
     parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
@@ -927,6 +1079,8 @@ def cli(argv=None):
     parser.add_argument('--max-size', default=6, help='Maximum file size during re-filtering', metavar='INT', type=int)
     parser.add_argument('--min-ka', default=21, help='Minimum auto-estimated assembly k-mer size', metavar='INT', type=int)
     parser.add_argument('--max-ka', default=51, help='Maximum auto-estimated assembly k-mer size', metavar='INT', type=int)
+    parser.add_argument('--max-memory', default=0, help='Memory budget for running tasks in GB (default = 90%% of total memory)', metavar='FLOAT', type=float)
+    parser.add_argument('--ka-step', default=0, help='Retry failed genes with the auto-estimated k-mer size lowered by this step, down to --min-ka (default = 0, off)', metavar='INT', type=int)
     parser.add_argument('--msa-program', choices=('clustalo', 'mafft', 'muscle'), default='mafft', help='Program for multiple sequence alignment', type=str)
     parser.add_argument('--no-alignment', action='store_true', default=True, help='Do not perform multiple sequence alignment')
     parser.add_argument('--no-trimal', action='store_true', default=False, help='Do not run trimAl on alignments')
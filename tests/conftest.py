@@ -0,0 +1,12 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gene2struct
+import gene2struct.GeneMiner2
+
+# The modules import each other as gene2struct.Geneminer2, which only resolves
+# on case-insensitive file systems, so that name is made an alias of the package
+sys.modules.setdefault('gene2struct.Geneminer2', gene2struct.GeneMiner2)
+gene2struct.Geneminer2 = sys.modules['gene2struct.Geneminer2']
@@ -0,0 +1,120 @@
+import math
+
+import numpy as np
+
+from gene2struct.Geneminer2.main_refilter_new import (RUN_LEN_CONST, THR_1e5_1T, THR_P95_2T, TOLERANCE,
+                                                      call_orientations)
+
+def scalar_orientation(row):
+    # Verdict of one read as computed per read by run_length_filter before call_orientations
+    (_, fwd_l, rev_l, _,
+     _, fwd_r, rev_r, _,
+     _, fwd_n, rev_n, amb_n, tot_n) = row
+
+    if fwd_n <= 1:
+        return (rev_n <= 1) * (1 - (amb_n <= 1) * 3) + 2
+    elif rev_n <= 1:
+        return 1
+
+    npr = 2 * fwd_n * rev_n
+    nht = fwd_n + rev_n
+    erc = npr / nht + 1
+    vrn = npr * (npr - nht) / (nht * nht * (nht - 1))
+
+    if (fwd_r + rev_r - erc) / math.sqrt(vrn) > -THR_1e5_1T:
+        if fwd_r > rev_r:
+            ntt = fwd_n + fwd_r - rev_r
+            rex = fwd_n / ntt
+        else:
+            ntt = fwd_n + rev_r - fwd_r
+            rex = fwd_n / ntt
+
+        if math.isclose(rex, 1.0, abs_tol=TOLERANCE) or (1 - rex) / math.sqrt(rex * (1 - rex) / ntt) < THR_P95_2T:
+            return 0
+
+    erl = max(math.log2(tot_n) + RUN_LEN_CONST, 0) + 4
+    orient = (fwd_l > erl) + (rev_l > erl) * 2
+
+    if orient != 3:
+        return orient
+
+    lpf = math.exp(math.log(1 / (1 - fwd_l + fwd_n)) / fwd_l)
+    lpr = math.exp(math.log(1 / (1 - rev_l + rev_n)) / rev_l)
+    fpz = math.isclose(lpf, 0.0, abs_tol=TOLERANCE)
+    rpz = math.isclose(lpr, 0.0, abs_tol=TOLERANCE)
+
+    if fpz:
+        return 2 - 2 * rpz
+    elif rpz:
+        return 1
+    elif math.isclose(lpf, 1.0, abs_tol=TOLERANCE) and math.isclose(lpr, 1.0, abs_tol=TOLERANCE):
+        return 0
+    elif abs(lpf - lpr) / math.sqrt(lpf ** 2 * (1 - lpf) / fwd_n + lpr ** 2 * (1 - lpr) / rev_n) < THR_P95_2T:
+        return 0
+
+    return 3
+
+def make_rows(fwd_l, rev_l, fwd_r, rev_r, fwd_n, rev_n, amb_n, tot_n):
+    rows = np.zeros((len(tot_n), 13), dtype=np.int64)
+    rows[:, 1], rows[:, 2], rows[:, 5], rows[:, 6] = fwd_l, rev_l, fwd_r, rev_r
+    rows[:, 9], rows[:, 10], rows[:, 11], rows[:, 12] = fwd_n, rev_n, amb_n, tot_n
+    return rows
+
+def random_rows(rng, count):
+    # Consistent statistics: a direction with n hits has 1 to n runs, the
+    # longest of them at most n - runs + 1 long
+    tot_n = rng.integers(1, 300, count)
+    fwd_n = rng.integers(0, tot_n + 1)
+    rev_n = rng.integers(0, tot_n - fwd_n + 1)
+    amb_n = rng.integers(0, tot_n - fwd_n - rev_n + 1)
+
+    def runs(hit_n):
+        run_n = np.where(hit_n > 0, rng.integers(1, np.maximum(hit_n, 1) + 1), 0)
+        longest = np.where(hit_n > 0, rng.integers(np.maximum(-(-hit_n // np.maximum(run_n, 1)), 1),
+                                                   hit_n - run_n + 2), 0)
+        # Few runs make long ones, which the mutation rate branch needs
+        is_single = rng.random(count) < 0.3
+        return np.where(is_single & (hit_n > 0), 1, run_n), np.where(is_single, hit_n, longest)
+
+    fwd_r, fwd_l = runs(fwd_n)
+    rev_r, rev_l = runs(rev_n)
+
+    return make_rows(fwd_l, rev_l, fwd_r, rev_r, fwd_n, rev_n, amb_n, tot_n)
+
+def edge_rows():
+    rows = []
+
+    for tot_n in (1, 2, 16, 150):
+        # All zero, single hits and ambiguous only
+        rows += [(0, 0, 0, 0, 0, 0, 0, tot_n), (1, 0, 1, 0, 1, 0, 0, tot_n), (0, 1, 0, 1, 0, 1, 0, tot_n),
+                 (1, 1, 1, 1, 1, 1, 1, tot_n), (0, 0, 0, 0, 0, 0, 2, tot_n)]
+
+        for n in range(2, min(tot_n >> 1, 60) + 1):
+            # One run per direction, ties in every field, then one side split in two
+            rows += [(n, n, 1, 1, n, n, 0, tot_n), (n, 1, 1, 1, n, 1, 0, tot_n), (1, n, 1, 1, 1, n, 0, tot_n),
+                     (n - 1, n, 2, 1, n, n, 0, tot_n), (n, n - 1, 1, 2, n, n, 0, tot_n),
+                     (1, 1, n, n, n, n, 0, tot_n)]
+
+    return make_rows(*np.array(rows, dtype=np.int64).T)
+
+def check(rows):
+    expected = np.array([scalar_orientation(row) for row in rows.tolist()], dtype=np.int8)
+    result = call_orientations(rows)
+
+    assert result.dtype == np.int8
+    assert (result == expected).all(), rows[result != expected][:5]
+
+    return expected
+
+def test_random_rows_match_scalar_verdict():
+    rng = np.random.default_rng(10)
+    verdicts = check(random_rows(rng, 200000))
+
+    # Every verdict, so every branch of the scalar path, is exercised
+    assert set(np.unique(verdicts).tolist()) == {0, 1, 2, 3}
+
+def test_edge_rows_match_scalar_verdict():
+    check(edge_rows())
+
+def test_empty_stats():
+    assert len(call_orientations(np.zeros((0, 13), dtype=np.int64))) == 0
@@ -0,0 +1,103 @@
+import random
+
+import numpy as np
+import pytest
+
+import gene2struct.Geneminer2.kmer_codec as kmer_codec
+
+# Scalar codec of the assembler before kmer_codec replaced it
+FWD_TRANS = str.maketrans("ACGTU", "01233", "RYMKSWHBVDN\n\r")
+REV_TRANS = str.maketrans("ACGTU", "32100", "RYMKSWHBVDN\n\r")
+BIN_DICT = {'00': 'A', '01': 'C', '10': 'G', '11': 'T'}
+
+def Seq_To_Int(dna_str, trans=FWD_TRANS, rtrans=REV_TRANS):
+    dna_fw_str = dna_str.translate(trans)
+    dna_rc_str = dna_str.translate(rtrans)[::-1]
+
+    if not dna_fw_str:
+        return (), 0
+
+    return (int(dna_fw_str, 4), int(dna_rc_str, 4)), len(dna_fw_str)
+
+def Int_To_Seq(seq_bin, seq_length, seq_dict=BIN_DICT):
+    seq_bin_str = bin(seq_bin)[2:].rjust(seq_length << 1, '0')
+    return ''.join(seq_dict[seq_bin_str[j << 1:(j << 1) + 2]] for j in range(seq_length))
+
+def Reverse_Int(dna_int, dna_length):
+    bin_str = bin(dna_int ^ ((1 << (dna_length << 1)) - 1))[2:].rjust(dna_length << 1, '0')
+    new_list = [bin_str[i:i + 2] for i in range(0, dna_length << 1, 2)]
+    return int(''.join(reversed(new_list)), 2)
+
+def random_seqs(rng, count, max_len):
+    # Mostly ACGT, with U and the IUPAC codes the old codec dropped
+    letters = 'ACGT' * 8 + 'U' + 'RYMKSWHBVDN'
+    return [''.join(rng.choice(letters) for _ in range(rng.randrange(max_len + 1))) for _ in range(count)]
+
+def test_pack_sequences_matches_seq_to_int():
+    rng = random.Random(14)
+    seqs = random_seqs(rng, 2000, 60)
+    codes, offsets = kmer_codec.pack_sequences(seqs)
+
+    for i, seq in enumerate(seqs):
+        seq_codes = codes[offsets[i]:offsets[i + 1]]
+        values, length = Seq_To_Int(seq)
+
+        assert len(seq_codes) == length
+
+        if length:
+            assert int(''.join(map(str, seq_codes.tolist())), 4) == values[0]
+
+@pytest.mark.parametrize('kmer_size', [1, 2, 7, 21, 31, 32])
+def test_kmer_keys_match_scalar_codec(kmer_size):
+    rng = random.Random(kmer_size)
+    seqs = random_seqs(rng, 300, 80)
+    codes, offsets = kmer_codec.pack_sequences(seqs)
+    fwd_keys = kmer_codec.forward_kmers(codes, offsets, kmer_size).tolist()
+    rev_keys = kmer_codec.reverse_kmers(codes, offsets, kmer_size).tolist()
+    read_ids = kmer_codec.kmer_read_ids(offsets, kmer_size).tolist()
+
+    expected_fwd, expected_rev, expected_ids = [], [], []
+
+    for i, seq in enumerate(seqs):
+        clean = seq.translate(FWD_TRANS).translate(str.maketrans('0123', 'ACGT'))
+
+        for start in range(len(clean) - kmer_size + 1):
+            (fwd, rev), _ = Seq_To_Int(clean[start:start + kmer_size])
+            assert Reverse_Int(fwd, kmer_size) == rev
+            expected_fwd.append(fwd)
+            expected_rev.append(rev)
+            expected_ids.append(i)
+
+    assert fwd_keys == expected_fwd
+    assert rev_keys == expected_rev
+    assert read_ids == expected_ids
+
+def test_codes_decode_like_int_to_seq():
+    rng = random.Random(3)
+    bases = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+    for seq in random_seqs(rng, 500, 40):
+        codes, _ = kmer_codec.pack_sequences([seq])
+        values, length = Seq_To_Int(seq)
+
+        if length:
+            assert bases[codes].tobytes().decode() == Int_To_Seq(values[0], length)
+
+def test_long_kmers_fold_words():
+    # Above 32 bases keys are hashed, equal k-mers must still get equal keys
+    seq = 'ACGTTGCAAGGCTTAC' * 8
+    codes, offsets = kmer_codec.pack_sequences([seq, seq])
+    keys = kmer_codec.forward_kmers(codes, offsets, 45)
+    half = len(keys) >> 1
+
+    assert (keys[:half] == keys[half:]).all()
+    assert keys[0] == keys[16]
+    assert len(np.unique(keys[:16])) == 16
+
+def test_contains_probes_sorted_reference():
+    rng = np.random.default_rng(5)
+    ref_kmers = np.unique(rng.integers(0, 5000, 800).astype(np.uint64))
+    kmers = rng.integers(0, 5200, 10000).astype(np.uint64)
+
+    assert (kmer_codec.contains(ref_kmers, kmers) == np.isin(kmers, ref_kmers)).all()
+    assert not kmer_codec.contains(ref_kmers[:0], kmers).any()